@@ -0,0 +1,780 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process fakes of the Google APIs used by the Cloud Functions.
+
+They replace texttospeech, storage, pubsub_v1 and the Sheets discovery service
+with in-memory implementations that simulate latency and inject errors, so the
+functions can be benchmarked without network access. install() must be called
+before the main.py of the functions is imported.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import base64
+import collections
+import enum
+import hashlib
+import importlib
+import io
+import itertools
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+class ServiceProfile:
+    """Latency and error injection settings of a fake service.
+
+    Args:
+      latency_ms: fixed latency added to every call.
+      jitter_ms: maximum random latency added to every call.
+      error_rate: probability of a call failing, between 0 and 1.
+      bandwidth_mb_s: transfer speed, only used by the storage fake. 0 means
+        that transfers are instantaneous.
+    """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0,
+                 error_rate: float = 0, bandwidth_mb_s: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.bandwidth_mb_s = bandwidth_mb_s
+
+
+class FakeServices:
+    """State shared by all the fakes: the profiles, the stored objects, the
+    spreadsheet and the published messages."""
+
+    def __init__(self, profiles: Optional[Dict[str, ServiceProfile]] = None,
+                 seed: int = 0):
+        self.profiles = profiles or {}
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.spreadsheet = FakeSpreadsheet()
+        self.published = []
+        self.tts_requests = 0
+        self.lock = threading.Lock()
+        self._generations = itertools.count(1)
+        self._signed_dir = tempfile.mkdtemp(prefix='fake_gcs_')
+
+    def simulate(self, service: str, size: int = 0):
+        """Sleeps the latency of a call to service, transferring size bytes,
+        and returns True if the call must fail."""
+        profile = self.profiles.get(service)
+        if not profile:
+            return False
+        with self.lock:
+            jitter = self.random.uniform(0, profile.jitter_ms)
+            fail = self.random.random() < profile.error_rate
+        delay = (profile.latency_ms + jitter) / 1000
+        if profile.bandwidth_mb_s and size:
+            delay += size / (profile.bandwidth_mb_s * 1024 * 1024)
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def next_generation(self) -> int:
+        with self.lock:
+            return next(self._generations)
+
+    def put_object(self, bucket: str, name: str, data: bytes,
+                   metadata: Optional[Dict] = None,
+                   content_type: Optional[str] = None):
+        """Stores an object, as the functions would find it in GCS."""
+        self.objects[(bucket, name)] = _StoredObject(
+            data, self.next_generation(), dict(metadata or {}), content_type)
+
+    def get_object(self, bucket: str, name: str) -> bytes:
+        return self.objects[(bucket, name)].data
+
+    def signed_path(self, bucket: str, name: str) -> str:
+        """Writes an object to the local disk, playing the role of a signed
+        URL that ffmpeg can read."""
+        path = os.path.join(self._signed_dir, bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(self.get_object(bucket, name))
+        return path
+
+
+class _StoredObject:
+
+    def __init__(self, data: bytes, generation: int, metadata: Dict,
+                 content_type: Optional[str]):
+        self.data = data
+        self.generation = generation
+        self.metadata = metadata
+        self.content_type = content_type
+
+
+SERVICES = None
+
+
+def install(services: FakeServices):
+    """Registers the fakes in sys.modules.
+
+    The Google client libraries are replaced by the fakes. The modules that
+    only provide types or exceptions are faked only when they are not
+    installed.
+
+    Args:
+      services: state of the fakes.
+    """
+    global SERVICES
+    SERVICES = services
+    for name in ('google', 'google.cloud'):
+        _ensure_package(name)
+    if not _importable('google.cloud.functions_v1.context'):
+        _ensure_package('google.cloud.functions_v1')
+        _register('google.cloud.functions_v1.context',
+                  types.SimpleNamespace(Context=object))
+    if not _importable('google.api_core.exceptions'):
+        _ensure_package('google.api_core')
+        _register('google.api_core.exceptions', _build_api_core_exceptions())
+    if not _importable('google.auth'):
+        _build_auth()
+    _ensure_package('googleapiclient')
+    if not _importable('googleapiclient.errors'):
+        _register('googleapiclient.errors', _build_googleapiclient_errors())
+    _register('googleapiclient.discovery', types.SimpleNamespace(build=_build_sheets))
+    _register('google.cloud.texttospeech', _build_texttospeech())
+    _register('google.cloud.storage', _build_storage())
+    _register('google.cloud.pubsub_v1', _build_pubsub())
+
+
+def _importable(name: str) -> bool:
+    try:
+        importlib.import_module(name)
+        return True
+    except ImportError:
+        return False
+
+
+def _ensure_package(name: str):
+    if name in sys.modules:
+        return
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__path__ = []
+        _register(name, module)
+
+
+def _register(name: str, module):
+    if not isinstance(module, types.ModuleType):
+        namespace = module
+        module = types.ModuleType(name)
+        module.__dict__.update(vars(namespace))
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+
+
+# ---------------------------------------------------------------------------
+# Errors
+# ---------------------------------------------------------------------------
+
+def _build_api_core_exceptions():
+
+    class GoogleAPICallError(Exception):
+        code = None
+
+    class PreconditionFailed(GoogleAPICallError):
+        code = 412
+
+    class NotFound(GoogleAPICallError):
+        code = 404
+
+    class TooManyRequests(GoogleAPICallError):
+        code = 429
+
+    class ServiceUnavailable(GoogleAPICallError):
+        code = 503
+
+    class InvalidArgument(GoogleAPICallError):
+        code = 400
+
+    return types.SimpleNamespace(
+        GoogleAPICallError=GoogleAPICallError, InvalidArgument=InvalidArgument,
+        PreconditionFailed=PreconditionFailed, NotFound=NotFound,
+        TooManyRequests=TooManyRequests,
+        ServiceUnavailable=ServiceUnavailable)
+
+
+def _build_googleapiclient_errors():
+
+    class HttpError(Exception):
+
+        def __init__(self, resp, content, uri=None):
+            super().__init__(f'HttpError {resp.status}')
+            self.resp = resp
+            self.content = content
+            self.uri = uri
+
+    return types.SimpleNamespace(HttpError=HttpError)
+
+
+def _exceptions():
+    return sys.modules['google.api_core.exceptions']
+
+
+def _build_auth():
+    _ensure_package('google.auth')
+    _ensure_package('google.auth.transport')
+
+    class Credentials:
+        valid = True
+        token = 'fake-token'
+        service_account_email = 'fake@example.com'
+
+        def refresh(self, request):
+            del request
+
+    sys.modules['google.auth'].default = lambda *args, **kwargs: (Credentials(), 'fake')
+    _register('google.auth.transport.requests',
+              types.SimpleNamespace(Request=lambda *args, **kwargs: None))
+
+
+# ---------------------------------------------------------------------------
+# Text-to-Speech
+# ---------------------------------------------------------------------------
+
+# Synthetic speech speed, used to decide the length of the generated audio.
+CHARACTERS_PER_SECOND = 15
+# Maximum size of the input of a request
+MAX_INPUT_BYTES = 5000
+MP3_FRAME_SAMPLES = 1152
+MP3_SAMPLE_RATE = 44100
+LINEAR16_SAMPLE_RATE = 24000
+
+
+class AudioEncoding(enum.IntEnum):
+    AUDIO_ENCODING_UNSPECIFIED = 0
+    LINEAR16 = 1
+    MP3 = 2
+    OGG_OPUS = 3
+    MULAW = 5
+    ALAW = 6
+
+
+def _build_texttospeech():
+
+    class TextToSpeechClient:
+
+        def __init__(self, *args, **kwargs):
+            del args, kwargs
+
+        def synthesize_speech(self, input=None, voice=None, audio_config=None,
+                              request=None, **kwargs):
+            del voice, kwargs
+            if request is not None:
+                input = request['input']
+                audio_config = request['audio_config']
+            with SERVICES.lock:
+                SERVICES.tts_requests += 1
+            text = input.ssml or input.text or ''
+            if len(text.encode('utf-8')) > MAX_INPUT_BYTES:
+                raise _exceptions().InvalidArgument(
+                    f'Input is longer than the limit of {MAX_INPUT_BYTES} bytes')
+            plain_text = re.sub(r'<[^>]+>', '', text)
+            seconds = max(len(plain_text.strip()), 1) / CHARACTERS_PER_SECOND
+            audio = synthesize_audio(audio_config.audio_encoding, seconds,
+                                     audio_config.sample_rate_hertz)
+            if SERVICES.simulate('tts', len(audio)):
+                raise _exceptions().ServiceUnavailable('Injected TTS error')
+            return types.SimpleNamespace(audio_content=audio)
+
+    return types.SimpleNamespace(
+        TextToSpeechClient=TextToSpeechClient,
+        AudioEncoding=AudioEncoding,
+        SynthesisInput=_record('SynthesisInput', text=None, ssml=None),
+        VoiceSelectionParams=_record('VoiceSelectionParams', language_code=None,
+                                     name=None, ssml_gender=None),
+        AudioConfig=_record('AudioConfig', audio_encoding=AudioEncoding.MP3,
+                            sample_rate_hertz=0, speaking_rate=1.0, pitch=0.0,
+                            volume_gain_db=0.0, effects_profile_id=()))
+
+
+def _record(class_name: str, **defaults):
+    """Builds a class whose instances are made of keyword arguments, like the
+    proto messages of the client libraries."""
+
+    def __init__(self, **kwargs):
+        for field, default in defaults.items():
+            setattr(self, field, kwargs.pop(field, default))
+        if kwargs:
+            raise TypeError(f'Unknown fields for {class_name}: {sorted(kwargs)}')
+
+    return type(class_name, (), {'__init__': __init__})
+
+
+def synthesize_audio(encoding, seconds: float, sample_rate: int = 0) -> bytes:
+    """Generates silent audio of the given length in the format returned by
+    the TTS API for encoding."""
+    encoding = AudioEncoding(int(encoding))
+    if encoding == AudioEncoding.MP3:
+        return _mp3_silence(seconds)
+    if encoding in (AudioEncoding.LINEAR16, AudioEncoding.MULAW, AudioEncoding.ALAW):
+        return _wav_silence(seconds, sample_rate or LINEAR16_SAMPLE_RATE, encoding)
+    if encoding == AudioEncoding.OGG_OPUS:
+        return _ogg_opus_silence(seconds)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+
+def _mp3_silence(seconds: float) -> bytes:
+    # MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono, no padding: 417 bytes/frame
+    header = bytes([0xFF, 0xFB, 0x90, 0xC4])
+    frame = header + bytes(417 - len(header))
+    frames = max(int(seconds * MP3_SAMPLE_RATE / MP3_FRAME_SAMPLES), 1)
+    return frame * frames
+
+
+def _wav_silence(seconds: float, sample_rate: int, encoding) -> bytes:
+    if encoding == AudioEncoding.LINEAR16:
+        format_tag, sample_width = 1, 2
+    else:
+        format_tag, sample_width = (7 if encoding == AudioEncoding.MULAW else 6), 1
+    data = bytes(int(seconds * sample_rate) * sample_width)
+    fmt = struct.pack('<HHIIHH', format_tag, 1, sample_rate,
+                      sample_rate * sample_width, sample_width, sample_width * 8)
+    return (b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(data)) +
+            b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+            b'data' + struct.pack('<I', len(data)) + data)
+
+
+def _ogg_opus_silence(seconds: float) -> bytes:
+    # Only the pages needed to read the length: OpusHead, OpusTags and a last
+    # page whose granule position is the number of 48 kHz samples.
+    pre_skip = 312
+    head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, pre_skip, 48000, 0, 0)
+    tags = b'OpusTags' + struct.pack('<I', 4) + b'fake' + struct.pack('<I', 0)
+    granule = int(seconds * 48000) + pre_skip
+    return (_ogg_page(head, 0, 0, 0x02) + _ogg_page(tags, 0, 1, 0) +
+            _ogg_page(bytes(3), granule, 2, 0x04))
+
+
+def _ogg_page(payload: bytes, granule: int, sequence: int, flags: int) -> bytes:
+    segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+    return (b'OggS' + struct.pack('<BBqIII', 0, flags, granule, 1, sequence, 0) +
+            bytes([len(segments)]) + bytes(segments) + payload)
+
+
+# ---------------------------------------------------------------------------
+# Cloud Storage
+# ---------------------------------------------------------------------------
+
+def _build_storage():
+    exceptions = _exceptions()
+
+    def check_precondition(key, if_generation_match):
+        if if_generation_match is None:
+            return
+        stored = SERVICES.objects.get(key)
+        current = stored.generation if stored else 0
+        if current != if_generation_match:
+            raise exceptions.PreconditionFailed(f'{key} is at generation {current}')
+
+    def simulate(size=0):
+        if SERVICES.simulate('storage', size):
+            raise exceptions.ServiceUnavailable('Injected storage error')
+
+    class _Writer(io.BytesIO):
+
+        def __init__(self, blob, upload_kwargs):
+            super().__init__()
+            self._blob = blob
+            self._upload_kwargs = upload_kwargs
+
+        def close(self):
+            if not self.closed:
+                self._blob.upload_from_string(self.getvalue(), **self._upload_kwargs)
+            super().close()
+
+    class Blob:
+
+        def __init__(self, name, bucket, chunk_size=None, generation=None):
+            del chunk_size
+            self.name = name
+            self.bucket = bucket
+            self.metadata = None
+            self.content_type = None
+            self._generation = generation
+            self._size = None
+            self.crc32c = None
+            self.md5_hash = None
+
+        @property
+        def _key(self):
+            return (self.bucket.name, self.name)
+
+        @property
+        def generation(self):
+            return self._generation
+
+        @property
+        def size(self):
+            return self._size
+
+        def _stored(self):
+            stored = SERVICES.objects.get(self._key)
+            if stored is None or (self._generation and stored.generation != self._generation):
+                raise exceptions.NotFound(f'gs://{self.bucket.name}/{self.name}')
+            return stored
+
+        def _load(self, stored):
+            self._generation = stored.generation
+            self._size = len(stored.data)
+            # Checksums with the format of the API, but not its CRC32C
+            digest = hashlib.md5(stored.data).digest()
+            self.crc32c = base64.b64encode(digest[:4]).decode('ascii')
+            self.md5_hash = base64.b64encode(digest).decode('ascii')
+            self.metadata = dict(stored.metadata) or None
+            self.content_type = stored.content_type
+
+        def exists(self, client=None, **kwargs):
+            del client, kwargs
+            simulate()
+            return self._key in SERVICES.objects
+
+        def reload(self, client=None, **kwargs):
+            del client, kwargs
+            simulate()
+            self._load(self._stored())
+
+        def patch(self, client=None, **kwargs):
+            del client, kwargs
+            simulate()
+            self._stored().metadata = dict(self.metadata or {})
+
+        def delete(self, client=None, **kwargs):
+            del client, kwargs
+            simulate()
+            self._stored()
+            del SERVICES.objects[self._key]
+
+        def download_as_bytes(self, client=None, start=None, end=None, **kwargs):
+            del client, kwargs
+            stored = self._stored()
+            data = stored.data
+            if start is not None or end is not None:
+                data = data[start or 0:(end + 1) if end is not None else None]
+            simulate(len(data))
+            return data
+
+        def download_to_filename(self, filename, client=None, **kwargs):
+            data = self.download_as_bytes(client, **kwargs)
+            with open(filename, 'wb') as f:
+                f.write(data)
+
+        def download_to_file(self, file_obj, client=None, start=None, end=None, **kwargs):
+            file_obj.write(self.download_as_bytes(client, start=start, end=end, **kwargs))
+
+        def upload_from_string(self, data, content_type=None, client=None,
+                               if_generation_match=None, **kwargs):
+            del client, kwargs
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            simulate(len(data))
+            with SERVICES.lock:
+                check_precondition(self._key, if_generation_match)
+                generation = next(SERVICES._generations)
+                stored = _StoredObject(bytes(data), generation, dict(self.metadata or {}),
+                                       content_type or self.content_type)
+                SERVICES.objects[self._key] = stored
+            self._load(stored)
+
+        def upload_from_filename(self, filename, content_type=None, **kwargs):
+            with open(filename, 'rb') as f:
+                self.upload_from_string(f.read(), content_type=content_type, **kwargs)
+
+        def upload_from_file(self, file_obj, content_type=None, **kwargs):
+            self.upload_from_string(file_obj.read(), content_type=content_type, **kwargs)
+
+        def compose(self, sources, client=None, if_generation_match=None, **kwargs):
+            del client, kwargs
+            data = b''.join(source._stored().data for source in sources)
+            self.upload_from_string(data, if_generation_match=if_generation_match)
+
+        def open(self, mode='r', chunk_size=None, ignore_flush=None, **kwargs):
+            del chunk_size, ignore_flush
+            if 'w' in mode:
+                return _Writer(self, kwargs)
+            return io.BytesIO(self.download_as_bytes())
+
+        def generate_signed_url(self, **kwargs):
+            del kwargs
+            return SERVICES.signed_path(self.bucket.name, self.name)
+
+    class Bucket:
+
+        def __init__(self, client, name):
+            self.client = client
+            self.name = name
+
+        def blob(self, blob_name, chunk_size=None, generation=None, **kwargs):
+            del kwargs
+            return Blob(blob_name, self, chunk_size, generation)
+
+        def get_blob(self, blob_name, client=None, **kwargs):
+            del client, kwargs
+            simulate()
+            stored = SERVICES.objects.get((self.name, blob_name))
+            if stored is None:
+                return None
+            blob = Blob(blob_name, self)
+            blob._load(stored)
+            return blob
+
+        def copy_blob(self, blob, destination_bucket, new_name=None,
+                      if_generation_match=None, **kwargs):
+            del kwargs
+            simulate()
+            stored = blob._stored()
+            key = (destination_bucket.name, new_name or blob.name)
+            with SERVICES.lock:
+                check_precondition(key, if_generation_match)
+                SERVICES.objects[key] = _StoredObject(
+                    stored.data, next(SERVICES._generations), dict(stored.metadata),
+                    stored.content_type)
+            return destination_bucket.get_blob(key[1])
+
+        def rename_blob(self, blob, new_name, **kwargs):
+            new_blob = self.copy_blob(blob, self, new_name, **kwargs)
+            blob.delete()
+            return new_blob
+
+        def list_blobs(self, prefix=None, **kwargs):
+            del kwargs
+            simulate()
+            blobs = []
+            for (bucket, name) in sorted(SERVICES.objects):
+                if bucket == self.name and name.startswith(prefix or ''):
+                    blobs.append(self.get_blob(name))
+            return blobs
+
+    class Client:
+
+        def __init__(self, *args, **kwargs):
+            del args, kwargs
+
+        def bucket(self, bucket_name, user_project=None):
+            del user_project
+            return Bucket(self, bucket_name)
+
+    return types.SimpleNamespace(Client=Client, Bucket=Bucket, Blob=Blob)
+
+
+# ---------------------------------------------------------------------------
+# Pub/Sub
+# ---------------------------------------------------------------------------
+
+def _build_pubsub():
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fake_pubsub')
+
+    class PublisherClient:
+
+        def __init__(self, batch_settings=None, publisher_options=None, **kwargs):
+            del publisher_options, kwargs
+            self.batch_settings = batch_settings
+
+        @staticmethod
+        def topic_path(project, topic):
+            return f'projects/{project}/topics/{topic}'
+
+        def publish(self, topic, data, ordering_key='', **attrs):
+            del ordering_key
+            future = Future()
+
+            def deliver():
+                if SERVICES.simulate('pubsub', len(data)):
+                    future.set_exception(
+                        _exceptions().ServiceUnavailable('Injected Pub/Sub error'))
+                    return
+                with SERVICES.lock:
+                    SERVICES.published.append((topic, data, attrs))
+                    message_id = str(len(SERVICES.published))
+                future.set_result(message_id)
+
+            executor.submit(deliver)
+            return future
+
+    def batch_settings(max_bytes=1000000, max_latency=0.01, max_messages=100):
+        return types.SimpleNamespace(max_bytes=max_bytes, max_latency=max_latency,
+                                     max_messages=max_messages)
+
+    return types.SimpleNamespace(
+        PublisherClient=PublisherClient,
+        types=types.SimpleNamespace(BatchSettings=batch_settings))
+
+
+# ---------------------------------------------------------------------------
+# Sheets
+# ---------------------------------------------------------------------------
+
+class FakeSpreadsheet:
+    """A grid of string cells that answers the Sheets values API."""
+
+    def __init__(self, values: Optional[List[List[str]]] = None):
+        self.values = [list(row) for row in values or []]
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+
+    def read(self, a1_range: str, major_dimension: str = 'ROWS') -> Dict:
+        col0, row0, col1, row1 = _parse_a1(a1_range)
+        with self.lock:
+            last_row = len(self.values) if row1 is None else min(row1 + 1, len(self.values))
+            rows = []
+            for row in self.values[row0:last_row]:
+                end = len(row) if col1 is None else col1 + 1
+                rows.append(row[col0:end])
+        for row in rows:
+            while row and row[-1] == '':
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        if major_dimension == 'COLUMNS':
+            width = max((len(row) for row in rows), default=0)
+            rows = [[row[i] if i < len(row) else '' for row in rows] for i in range(width)]
+        result = {'range': a1_range, 'majorDimension': major_dimension}
+        if rows:
+            result['values'] = rows
+        return result
+
+    def write(self, a1_range: str, values: List[List], major_dimension: str = 'ROWS'):
+        col0, row0, unused_col1, unused_row1 = _parse_a1(a1_range)
+        if major_dimension == 'COLUMNS':
+            width = max((len(column) for column in values), default=0)
+            values = [[column[i] if i < len(column) else '' for column in values]
+                      for i in range(width)]
+        with self.lock:
+            for r, row in enumerate(values):
+                while len(self.values) <= row0 + r:
+                    self.values.append([])
+                target = self.values[row0 + r]
+                for c, value in enumerate(row):
+                    while len(target) <= col0 + c:
+                        target.append('')
+                    target[col0 + c] = str(value)
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _parse_a1(a1_range: str):
+    """Parses a range like Sheet!A1:N, Sheet!C2:C or Sheet!M5 into zero based
+    (first column, first row, last column, last row), with None meaning
+    unbounded."""
+    cells = a1_range.split('!')[-1]
+    start, _, end = cells.partition(':')
+    start_match = re.fullmatch(r'([A-Z]*)(\d*)', start)
+    end_match = re.fullmatch(r'([A-Z]*)(\d*)', end or start)
+    col0 = _column_index(start_match.group(1)) if start_match.group(1) else 0
+    row0 = int(start_match.group(2)) - 1 if start_match.group(2) else 0
+    col1 = _column_index(end_match.group(1)) if end_match.group(1) else None
+    row1 = int(end_match.group(2)) - 1 if end_match.group(2) else None
+    return col0, row0, col1, row1
+
+
+class _Request:
+
+    def __init__(self, kind: str, run):
+        self._kind = kind
+        self._run = run
+
+    def execute(self, num_retries=0, **kwargs):
+        del num_retries, kwargs
+        SERVICES.spreadsheet.requests[self._kind] += 1
+        if SERVICES.simulate('sheets'):
+            errors = sys.modules['googleapiclient.errors']
+            resp = types.SimpleNamespace(status=429, reason='Too Many Requests')
+            raise errors.HttpError(resp, b'Injected quota error')
+        return self._run()
+
+
+class _Values:
+
+    def get(self, spreadsheetId, range, majorDimension='ROWS', **kwargs):
+        del spreadsheetId, kwargs
+        return _Request('get', lambda: SERVICES.spreadsheet.read(range, majorDimension))
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS', **kwargs):
+        del spreadsheetId, kwargs
+        if isinstance(ranges, str):
+            ranges = [ranges]
+        return _Request('batchGet', lambda: {'valueRanges': [
+            SERVICES.spreadsheet.read(r, majorDimension) for r in ranges]})
+
+    def update(self, spreadsheetId, range, body, valueInputOption='RAW', **kwargs):
+        del spreadsheetId, valueInputOption, kwargs
+
+        def run():
+            SERVICES.spreadsheet.write(range, body['values'],
+                                       body.get('majorDimension', 'ROWS'))
+            return {'updatedRange': range}
+
+        return _Request('update', run)
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        del spreadsheetId, kwargs
+
+        def run():
+            for value_range in body['data']:
+                SERVICES.spreadsheet.write(value_range['range'], value_range['values'],
+                                           value_range.get('majorDimension', 'ROWS'))
+            return {'totalUpdatedCells': len(body['data'])}
+
+        return _Request('batchUpdate', run)
+
+
+class _Spreadsheets:
+
+    def values(self):
+        return _Values()
+
+    def get(self, spreadsheetId, **kwargs):
+        del spreadsheetId, kwargs
+
+        def run():
+            with SERVICES.spreadsheet.lock:
+                row_count = len(SERVICES.spreadsheet.values)
+            return {'sheets': [{'properties': {'gridProperties': {'rowCount': row_count}}}]}
+
+        return _Request('get', run)
+
+
+class _SheetsService:
+
+    def spreadsheets(self):
+        return _Spreadsheets()
+
+
+def _build_sheets(service_name, version, *args, **kwargs):
+    del args, kwargs
+    if (service_name, version) != ('sheets', 'v4'):
+        raise ValueError(f'Unsupported service {service_name} {version}')
+    return _SheetsService()
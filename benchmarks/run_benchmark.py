@@ -0,0 +1,303 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmark of the TTS and video generation Cloud Functions.
+
+Runs the main of the functions against the fakes of fakes.py, over synthetic
+sheets of different sizes, and reports the throughput, the p50 and p95 duration
+of every stage and the peak memory. Each sheet size runs in its own process, so
+that it starts from a cold instance and its peak memory is measured alone.
+
+Example:
+  python benchmarks/run_benchmark.py --rows 10 100 1000 --tts-latency-ms 200
+"""
+
+from typing import Dict, List
+
+import argparse
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TTS_MAIN = os.path.join(ROOT, 'src', 'cfs', 'generate_tts_files', 'main.py')
+VIDEO_MAIN = os.path.join(ROOT, 'src', 'cfs', 'generate_video_file', 'main.py')
+BUCKET = 'benchmark-bucket'
+HEADERS = ['campaign', 'topic', 'gcs_bucket', 'video_file', 'base_audio_file',
+           'text', 'voice_id', 'millisecond_start_audio', 'audio_encoding',
+           'base_audio_vol_percent', 'tts_file_url', 'final_video_file_url',
+           'status', 'last_update']
+VOICES = ['en-US-Neural2-A', 'es-ES-Neural2-B', 'fr-FR-Neural2-C', 'de-DE-Neural2-D']
+WORDS = ('the quick brown fox jumps over a lazy dog while our new product '
+         'launches today with better prices and faster delivery').split()
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+# Environment of the functions. The quotas are disabled so that the benchmark
+# measures the code and not the rate limits, use --env to set them.
+DEFAULT_ENV = {
+    'GCP_PROJECT': 'benchmark',
+    'CONFIG_SPREADSHEET_ID': 'benchmark',
+    'STATE_BUCKET': BUCKET,
+    'TTS_REQUESTS_PER_MINUTE': '0',
+    'SHEETS_REQUESTS_PER_MINUTE': '0',
+}
+
+
+def _build_sheet(rows: int, masters: int, seed: int) -> List[List[str]]:
+    """Builds a config sheet with rows lines spread over masters videos."""
+    generator = random.Random(seed)
+    values = [list(HEADERS)]
+    for i in range(rows):
+        sentences = []
+        for unused_sentence in range(generator.randint(1, 4)):
+            words = generator.choices(WORDS, k=generator.randint(6, 20))
+            sentences.append(' '.join(words).capitalize() + '.')
+        values.append([
+            'benchmark', f'topic{i}', BUCKET,
+            f'input/master_{i % masters}.mp4',
+            'input/base_audio.wav' if i % 2 else '',
+            f'<speak>{" ".join(sentences)}</speak>',
+            VOICES[i % len(VOICES)], str(generator.randint(0, 3000)), 'MP3',
+            '0.3',
+        ])
+    return values
+
+
+def _generate_media(masters: int, seconds: int):
+    """Generates the master videos and the base audio with ffmpeg and stores
+    them in the fake GCS."""
+    directory = tempfile.mkdtemp(prefix='benchmark_media_')
+    base_audio = os.path.join(directory, 'base_audio.wav')
+    subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi', '-i',
+                    f'sine=frequency=220:duration={seconds}', base_audio],
+                   check=True)
+    _store_file(base_audio, 'input/base_audio.wav')
+    for i in range(masters):
+        video = os.path.join(directory, f'master_{i}.mp4')
+        subprocess.run(['ffmpeg', '-y', '-v', 'error',
+                        '-f', 'lavfi', '-i', f'testsrc=size=1280x720:rate=25:duration={seconds}',
+                        '-f', 'lavfi', '-i', f'sine=frequency={440 + i}:duration={seconds}',
+                        '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac',
+                        '-shortest', video], check=True)
+        _store_file(video, f'input/master_{i}.mp4')
+    shutil.rmtree(directory)
+
+
+def _store_file(path: str, name: str):
+    with open(path, 'rb') as f:
+        fakes.SERVICES.put_object(BUCKET, name, f.read())
+
+
+def _load_function(path: str, name: str):
+    """Imports the main.py of a function as a fresh module."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_captured(function, *args) -> (float, List[Dict]):
+    """Calls function, returning its duration and the stages it logged."""
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        function(*args)
+    seconds = time.perf_counter() - start
+    stages = []
+    for line in output.getvalue().splitlines():
+        if line.startswith('{'):
+            entry = json.loads(line)
+            if 'stage' in entry:
+                stages.append(entry)
+    return seconds, stages
+
+
+def _summarize_stages(stages: List[Dict]) -> Dict:
+    durations = {}
+    errors = {}
+    for entry in stages:
+        durations.setdefault(entry['stage'], []).append(entry['seconds'])
+        errors[entry['stage']] = errors.get(entry['stage'], 0) + (entry['outcome'] != 'ok')
+    summary = {}
+    for stage, values in durations.items():
+        values.sort()
+        summary[stage] = {
+            'count': len(values),
+            'errors': errors[stage],
+            'p50_seconds': values[min(len(values) - 1, len(values) * 50 // 100)],
+            'p95_seconds': values[min(len(values) - 1, len(values) * 95 // 100)],
+        }
+    return summary
+
+
+def _peak_rss_mb(who) -> float:
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def run_scenario(scenario: Dict) -> Dict:
+    """Runs one sheet size in the current process and returns its results."""
+    profiles = {name: fakes.ServiceProfile(**profile)
+                for name, profile in scenario['profiles'].items()}
+    fakes.install(fakes.FakeServices(profiles, seed=scenario['seed']))
+    os.environ.update(DEFAULT_ENV)
+    os.environ.update(scenario['env'])
+    fakes.SERVICES.spreadsheet.values = _build_sheet(
+        scenario['rows'], scenario['masters'], scenario['seed'])
+
+    tts = _load_function(TTS_MAIN, 'generate_tts_files_main')
+    seconds, stages = _run_captured(tts.main, {}, None)
+    status_column = HEADERS.index('status')
+    statuses = [row[status_column] if len(row) > status_column else ''
+                for row in fakes.SERVICES.spreadsheet.values[1:]]
+    result = {
+        'rows': scenario['rows'],
+        'tts': {
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(scenario['rows'] / seconds, 2),
+            'ok': statuses.count('TTS OK'),
+            'tts_requests': fakes.SERVICES.tts_requests,
+            'sheets_requests': dict(fakes.SERVICES.spreadsheet.requests),
+            'stages': _summarize_stages(stages),
+        },
+    }
+
+    messages = [data for unused_topic, data, unused_attrs in fakes.SERVICES.published]
+    messages = messages[:scenario['video_messages']]
+    if messages and not shutil.which('ffmpeg'):
+        result['video'] = {'skipped': 'ffmpeg is not installed'}
+    elif messages:
+        _generate_media(scenario['masters'], scenario['media_seconds'])
+        video = _load_function(VIDEO_MAIN, 'generate_video_file_main')
+        video_seconds = 0
+        video_stages = []
+        for message in messages:
+            event = {'data': base64.b64encode(message)}
+            seconds, stages = _run_captured(video.main, event, None)
+            video_seconds += seconds
+            video_stages.extend(stages)
+        rows = sum(len(json.loads(message).get('rows', [None])) for message in messages)
+        result['video'] = {
+            'messages': len(messages),
+            'rows': rows,
+            'seconds': round(video_seconds, 3),
+            'rows_per_second': round(rows / video_seconds, 2),
+            'stages': _summarize_stages(video_stages),
+        }
+
+    result['peak_rss_mb'] = _peak_rss_mb(resource.RUSAGE_SELF)
+    result['peak_child_rss_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def _print_report(results: List[Dict]):
+    for result in results:
+        tts = result['tts']
+        print(f"\n== {result['rows']} rows: TTS {tts['seconds']}s, "
+              f"{tts['rows_per_second']} rows/s, {tts['ok']} OK, "
+              f"peak RSS {result['peak_rss_mb']} MB "
+              f"(children {result['peak_child_rss_mb']} MB)")
+        _print_stages(tts['stages'])
+        video = result.get('video')
+        if video and 'skipped' in video:
+            print(f"   video skipped: {video['skipped']}")
+        elif video:
+            print(f"   video: {video['messages']} messages, {video['rows']} rows, "
+                  f"{video['seconds']}s, {video['rows_per_second']} rows/s")
+            _print_stages(video['stages'])
+
+
+def _print_stages(stages: Dict):
+    print(f"   {'stage':<22}{'count':>8}{'errors':>8}{'p50 s':>10}{'p95 s':>10}")
+    for stage, summary in sorted(stages.items()):
+        print(f"   {stage:<22}{summary['count']:>8}{summary['errors']:>8}"
+              f"{summary['p50_seconds']:>10.4f}{summary['p95_seconds']:>10.4f}")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000],
+                        help='sizes of the synthetic sheets, from 10 to 10000')
+    parser.add_argument('--masters', type=int, default=3,
+                        help='number of distinct master videos')
+    parser.add_argument('--video-messages', type=int, default=3,
+                        help='video generation messages to process, 0 to skip')
+    parser.add_argument('--media-seconds', type=int, default=10,
+                        help='length of the generated master videos')
+    for service, latency in (('tts', 150), ('storage', 30), ('pubsub', 10),
+                             ('sheets', 200)):
+        parser.add_argument(f'--{service}-latency-ms', type=float, default=latency)
+        parser.add_argument(f'--{service}-jitter-ms', type=float, default=latency / 2)
+        parser.add_argument(f'--{service}-error-rate', type=float, default=0)
+    parser.add_argument('--storage-bandwidth-mb-s', type=float, default=100)
+    parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE',
+                        help='environment variables of the functions')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file where the results are saved as JSON')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_args()
+    if args.scenario:
+        result = run_scenario(json.loads(args.scenario))
+        print(RESULT_PREFIX + json.dumps(result))
+        return
+
+    profiles = {}
+    for service in ('tts', 'storage', 'pubsub', 'sheets'):
+        profiles[service] = {
+            'latency_ms': getattr(args, f'{service}_latency_ms'),
+            'jitter_ms': getattr(args, f'{service}_jitter_ms'),
+            'error_rate': getattr(args, f'{service}_error_rate'),
+        }
+    profiles['storage']['bandwidth_mb_s'] = args.storage_bandwidth_mb_s
+    env = dict(item.split('=', 1) for item in args.env)
+
+    results = []
+    for rows in args.rows:
+        scenario = {
+            'rows': rows, 'masters': args.masters,
+            'video_messages': args.video_messages,
+            'media_seconds': args.media_seconds, 'profiles': profiles,
+            'env': env, 'seed': args.seed,
+        }
+        print(f'Running {rows} rows...', file=sys.stderr)
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--scenario', json.dumps(scenario)],
+            stdout=subprocess.PIPE, text=True, check=True)
+        for line in process.stdout.splitlines():
+            if line.startswith(RESULT_PREFIX):
+                results.append(json.loads(line[len(RESULT_PREFIX):]))
+
+    _print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
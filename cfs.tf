@@ -70,6 +70,33 @@ resource "google_storage_bucket_object" "generate_video_file_zip" {
     ]
 }
 
+# Shared by the scheduled tts generation and its workers
+locals {
+  tts_environment_variables = {
+    GCP_PROJECT = var.gcp_project,
+    CONFIG_SPREADSHEET_ID = var.config_spreadsheet_id,
+    CONFIG_SHEET_NAME = var.config_sheet_name,
+    CONFIG_RANGE_NAME = var.config_sheet_range,
+    CONFIG_SOURCE = var.config_source,
+    CONFIG_TABLE = var.config_table,
+    STATUS_COLUMN = var.status_column,
+    TTS_FILE_COLUMN = var.tts_file_column,
+    LAST_UPDATE_COLUMN = var.last_update_column,
+    GENERATE_VIDEO_TOPIC = var.generate_video_file_trigger_pubsub_topic,
+    TTS_MAX_WORKERS = var.tts_max_workers,
+    TTS_REQUESTS_PER_MINUTE = var.tts_requests_per_minute,
+    SHEETS_REQUESTS_PER_MINUTE = var.sheets_requests_per_minute,
+    TTS_CACHE_ENABLED = var.tts_cache_enabled,
+    TTS_CHUNK_MAX_BYTES = var.tts_chunk_max_bytes,
+    INCREMENTAL_MODE = var.incremental_mode,
+    STATE_BUCKET = google_storage_bucket.ai_dubbing_bucket.name,
+    VIDEO_GROUP_MODE = var.video_group_mode,
+    DISPATCH_MODE = var.dispatch_mode,
+    TTS_TASKS_TOPIC = var.generate_tts_tasks_pubsub_topic,
+    TTS_TASK_BATCH_SIZE = var.tts_task_batch_size
+  }
+}
+
 # Create the Cloud function triggered by a `Finalize` event on the bucket
 resource "google_cloudfunctions_function" "function_generate_tts_files" {
     depends_on            = [
@@ -82,16 +109,7 @@ resource "google_cloudfunctions_function" "function_generate_tts_files" {
     name                  = "generate_tts_files"
     runtime               = "python38"
 
-    environment_variables = {
-        GCP_PROJECT = var.gcp_project,
-        CONFIG_SPREADSHEET_ID = var.config_spreadsheet_id,
-        CONFIG_SHEET_NAME = var.config_sheet_name,
-        CONFIG_SHEET_RANGE = var.config_sheet_range,
-        STATUS_COLUMN = var.status_column,
-        TTS_FILE_COLUMN = var.tts_file_column,
-        LAST_UPDATE_COLUMN = var.last_update_column,
-        GENERATE_VIDEO_TOPIC = var.generate_video_file_trigger_pubsub_topic
-    }
+    environment_variables = local.tts_environment_variables
 
     # Get the source code of the cloud function as a Zip compression
     source_archive_bucket = google_storage_bucket.ai_dubbing_bucket.name
@@ -109,6 +127,37 @@ resource "google_cloudfunctions_function" "function_generate_tts_files" {
     }
 }
 
+# Create the Cloud function that processes the tasks sent in dispatch mode
+resource "google_cloudfunctions_function" "function_generate_tts_worker" {
+    depends_on            = [
+        google_storage_bucket_object.generate_tts_files_zip,
+        google_service_account.service_account,
+        google_project_service.enable_cloudfunctions,
+        google_project_service.enable_cloudbuild,
+        google_storage_bucket.ai_dubbing_bucket
+    ]
+    name                  = "generate_tts_worker"
+    runtime               = "python38"
+
+    environment_variables = local.tts_environment_variables
+
+    # Get the source code of the cloud function as a Zip compression
+    source_archive_bucket = google_storage_bucket.ai_dubbing_bucket.name
+    source_archive_object = google_storage_bucket_object.generate_tts_files_zip.name
+
+    # Must match the function name in the cloud function `main.py` source code
+    entry_point           = "worker"
+    service_account_email = google_service_account.service_account.email
+    available_memory_mb = 2048
+    timeout = 540
+    max_instances = var.tts_worker_max_instances
+
+    event_trigger {
+      event_type = "google.pubsub.topic.publish"
+      resource = google_pubsub_topic.generate_tts_tasks_topic.id
+    }
+}
+
 # Create the Cloud function triggered by a `Finalize` event on the bucket
 resource "google_cloudfunctions_function" "function_generate_video_file" {
     depends_on = [
@@ -125,9 +174,20 @@ resource "google_cloudfunctions_function" "function_generate_video_file" {
         GCP_PROJECT = var.gcp_project
         CONFIG_SPREADSHEET_ID = var.config_spreadsheet_id,
         CONFIG_SHEET_NAME = var.config_sheet_name,
+        CONFIG_SOURCE = var.config_source,
+        CONFIG_TABLE = var.config_table,
         STATUS_COLUMN = var.status_column,
         LAST_UPDATE_COLUMN = var.last_update_column,
-        FINAL_VIDEO_FILE_COLUMN = var.final_video_file_column
+        FINAL_VIDEO_FILE_COLUMN = var.final_video_file_column,
+        PREVIEW_FILE_COLUMN = var.preview_file_column,
+        STREAMING_MODE = var.streaming_mode,
+        MEDIA_CACHE_MAX_MB = var.media_cache_max_mb,
+        GCS_TRANSFER_CHUNK_MB = var.gcs_transfer_chunk_mb,
+        GCS_TRANSFER_MAX_WORKERS = var.gcs_transfer_max_workers,
+        AUDIO_OUTPUT_FORMAT = var.audio_output_format,
+        FFMPEG_MAX_JOBS = var.ffmpeg_max_jobs,
+        FFMPEG_TIMEOUT_SECONDS = var.ffmpeg_timeout_seconds,
+        AUTO_LOUDNESS = var.auto_loudness
     }
 
     # Get the source code of the cloud function as a Zip compression
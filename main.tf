@@ -125,11 +125,24 @@ resource "google_project_iam_member" "permissions_pubsub" {
   depends_on    = [google_service_account.service_account]
 }
 
+# Required to sign the GCS URLs read by ffmpeg in streaming mode
+resource "google_service_account_iam_member" "permissions_sign_blob" {
+  service_account_id = google_service_account.service_account.name
+  role   = "roles/iam.serviceAccountTokenCreator"
+  member = "serviceAccount:${google_service_account.service_account.email}"
+  depends_on    = [google_service_account.service_account]
+}
+
 resource "google_pubsub_topic" "generate_tts_files_trigger_topic" {
   depends_on    = [google_project_service.enable_pubsub]
   name = var.generate_tts_files_trigger_pubsub_topic
 }
 
+resource "google_pubsub_topic" "generate_tts_tasks_topic" {
+  depends_on    = [google_project_service.enable_pubsub]
+  name = var.generate_tts_tasks_pubsub_topic
+}
+
 resource "google_pubsub_topic" "generate_video_file_trigger_topic" {
   depends_on    = [google_project_service.enable_pubsub]
   name = var.generate_video_file_trigger_pubsub_topic
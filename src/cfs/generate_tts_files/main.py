@@ -28,30 +28,820 @@
 # final_video_file_url
 # status
 # last_update
+# preview_file_url (optional)
+# timeline (optional)
+# render_mode (optional)
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from google.cloud.functions_v1.context import Context
 from google.cloud import texttospeech
 from google.cloud import storage
 from google.cloud import pubsub_v1
 from datetime import datetime
 
+import abc
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import hashlib
+import io
 import json
 import os.path
 import base64
+import random
+import re
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+import uuid
 
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+try:
+  import pyarrow.parquet
+except ImportError:  # Only needed to read Parquet manifests
+  pyarrow = None
+try:
+  import psycopg2
+except ImportError:  # Only needed to use a PostgreSQL config source
+  psycopg2 = None
+
 # The ID and range of a sample spreadsheet.
 GCP_PROJECT = os.getenv('GCP_PROJECT', '')
 CONFIG_SPREADSHEET_ID = os.getenv('CONFIG_SPREADSHEET_ID', '')
 CONFIG_SHEET_NAME = os.getenv('CONFIG_SHEET_NAME', 'config')
-CONFIG_RANGE_NAME = os.getenv('CONFIG_RANGE_NAME', 'config!A1:N')
-TTS_FILE_COLUMN = os.getenv('TTS_FILE_COLUMN', 'K')
-STATUS_COLUMN = os.getenv('STATUS_COLUMN', 'M')
-LAST_UPDATE_COLUMN = os.getenv('LAST_UPDATE_COLUMN', 'N')
+CONFIG_RANGE_NAME = os.getenv('CONFIG_RANGE_NAME', 'config!A1:Z')
+# The columns written are found by the name of their field in the header row
+# of CONFIG_RANGE_NAME, unless their letter is set.
+TTS_FILE_COLUMN = os.getenv('TTS_FILE_COLUMN', '')
+STATUS_COLUMN = os.getenv('STATUS_COLUMN', '')
+LAST_UPDATE_COLUMN = os.getenv('LAST_UPDATE_COLUMN', '')
 GENERATE_VIDEO_TOPIC = os.getenv('GENERATE_VIDEO_TOPIC', 'generate_video_trigger')
+# Where the config lines are read from and their status written to: empty for
+# the Google Sheet, a CSV or Parquet manifest (local path or gs://bucket/path)
+# or a sqlite:///path or postgresql:// database URL. The CONFIG_TABLE of a
+# database has an `id` column with the index of each line.
+CONFIG_SOURCE = os.getenv('CONFIG_SOURCE', '')
+CONFIG_TABLE = os.getenv('CONFIG_TABLE', 'config')
+# Columns of the fields written to the Google Sheet, empty to find them in the
+# header row
+SHEET_COLUMNS = {
+  'status': STATUS_COLUMN,
+  'tts_file_url': TTS_FILE_COLUMN,
+  'last_update': LAST_UPDATE_COLUMN,
+}
+# Concurrency and quota settings. A value of 0 disables the rate limit.
+TTS_MAX_WORKERS = int(os.getenv('TTS_MAX_WORKERS', '8'))
+TTS_REQUESTS_PER_MINUTE = float(os.getenv('TTS_REQUESTS_PER_MINUTE', '900'))
+SHEETS_REQUESTS_PER_MINUTE = float(os.getenv('SHEETS_REQUESTS_PER_MINUTE', '55'))
+# The status updates are sent in batches of SHEETS_BATCH_SIZE lines, or every
+# SHEETS_FLUSH_SECONDS, whatever happens first.
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', '50'))
+SHEETS_FLUSH_SECONDS = float(os.getenv('SHEETS_FLUSH_SECONDS', '10'))
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+# The messages to the video generation are published in batches. The lines
+# whose message could not be published are marked as failed.
+PUBSUB_BATCH_MAX_MESSAGES = int(os.getenv('PUBSUB_BATCH_MAX_MESSAGES', '100'))
+PUBSUB_BATCH_MAX_BYTES = int(os.getenv('PUBSUB_BATCH_MAX_BYTES', '1000000'))
+PUBSUB_BATCH_MAX_LATENCY = float(os.getenv('PUBSUB_BATCH_MAX_LATENCY', '0.05'))
+PUBSUB_PUBLISH_TIMEOUT = float(os.getenv('PUBSUB_PUBLISH_TIMEOUT', '60'))
+# In group mode the lines sharing the same video and base audio are sent in a
+# single message, up to VIDEO_GROUP_MAX_SIZE lines per message, so that the
+# video generation downloads and decodes the video only once for all of them.
+VIDEO_GROUP_MODE = os.getenv('VIDEO_GROUP_MODE', 'false').lower() == 'true'
+VIDEO_GROUP_MAX_SIZE = int(os.getenv('VIDEO_GROUP_MAX_SIZE', '10'))
+# The texts longer than TTS_CHUNK_MAX_BYTES, the limit of a TTS request, are
+# split in chunks at sentence, paragraph or <break> boundaries, synthesized in
+# parallel as LINEAR16 at TTS_CHUNK_SAMPLE_RATE and concatenated.
+TTS_CHUNK_MAX_BYTES = int(os.getenv('TTS_CHUNK_MAX_BYTES', '5000'))
+TTS_CHUNK_MAX_WORKERS = int(os.getenv('TTS_CHUNK_MAX_WORKERS', '4'))
+TTS_CHUNK_SAMPLE_RATE = int(os.getenv('TTS_CHUNK_SAMPLE_RATE', '24000'))
+# Maximum duration of the ffmpeg process encoding the concatenated chunks.
+TTS_ENCODE_TIMEOUT_SECONDS = float(os.getenv('TTS_ENCODE_TIMEOUT_SECONDS', '120'))
+# ffmpeg arguments to encode the concatenated chunks in each audio encoding.
+CHUNK_ENCODER_ARGS = {
+  'MP3': ['-c:a', 'libmp3lame', '-b:a', '64k', '-f', 'mp3'],
+  'OGG_OPUS': ['-c:a', 'libopus', '-b:a', '48k', '-f', 'ogg'],
+  'MULAW': ['-c:a', 'pcm_mulaw', '-f', 'wav'],
+  'ALAW': ['-c:a', 'pcm_alaw', '-f', 'wav'],
+}
+# The segments of the lines with a timeline are synthesized concurrently, up to
+# TTS_SEGMENT_MAX_WORKERS segments of each line at the same time.
+TTS_SEGMENT_MAX_WORKERS = int(os.getenv('TTS_SEGMENT_MAX_WORKERS', '4'))
+# Content addressed cache of the generated audio files, stored in gcs_bucket.
+TTS_CACHE_ENABLED = os.getenv('TTS_CACHE_ENABLED', 'true').lower() == 'true'
+TTS_CACHE_PREFIX = os.getenv('TTS_CACHE_PREFIX', 'cache/tts')
+# Bump it to invalidate every cached audio file.
+TTS_CACHE_VERSION = 1
+# Incremental mode only processes new, modified or failed lines. The
+# fingerprint of each line processed successfully is kept in its own object
+# under STATE_PREFIX in STATE_BUCKET, so that parallel executions never write
+# the same object.
+INCREMENTAL_MODE = os.getenv('INCREMENTAL_MODE', 'false').lower() == 'true'
+STATE_BUCKET = os.getenv('STATE_BUCKET', '')
+STATE_PREFIX = os.getenv('STATE_PREFIX', f'state/{CONFIG_SPREADSHEET_ID}')
+# In dispatch mode the scheduled execution only reads the sheet and publishes
+# the pending lines to TTS_TASKS_TOPIC, in tasks of up to TTS_TASK_BATCH_SIZE
+# lines, that the `worker` entry point processes on as many instances as
+# needed. The lines are leased in STATE_BUCKET while they are processed, so that
+# overlapping executions never process the same line twice.
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'false').lower() == 'true'
+TTS_TASKS_TOPIC = os.getenv('TTS_TASKS_TOPIC', 'generate_tts_tasks')
+TTS_TASK_BATCH_SIZE = int(os.getenv('TTS_TASK_BATCH_SIZE', '5'))
+LEASE_PREFIX = os.getenv('LEASE_PREFIX', f'leases/{CONFIG_SPREADSHEET_ID}')
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '900'))
+# Fields written by the process, which are not part of the line fingerprint.
+OUTPUT_FIELDS = ('index', 'tts_file_url', 'final_video_file_url', 'status',
+                 'last_update', 'preview_file_url', 'speech_duration_seconds',
+                 'segments')
+SUCCESS_STATUSES = ('TTS OK', 'Video OK', 'Audio OK', 'Preview OK')
+# Fields only needed to synthesize the audio, which are not sent to the video
+# generation.
+TTS_ONLY_FIELDS = ('text', 'timeline')
+# The config sheet is read in pages of SHEETS_READ_PAGE_ROWS rows, fetching
+# only the columns of the fields read by the process.
+SHEETS_READ_PAGE_ROWS = int(os.getenv('SHEETS_READ_PAGE_ROWS', '1000'))
+
+
+class _RateLimiter:
+  """
+  Spaces out calls so that no more than `per_minute` of them start in a minute.
+
+  It is shared by all the worker threads of a stage, so the limit applies to
+  the whole run and not to each thread.
+  """
+
+  def __init__(self, per_minute: float):
+    self._interval = 60.0 / per_minute if per_minute > 0 else 0.0
+    self._next_slot = 0.0
+    self._lock = threading.Lock()
+
+  def wait(self):
+    """
+    Blocks the calling thread until it is allowed to make the next call.
+    """
+    if not self._interval:
+      return
+    with self._lock:
+      now = time.monotonic()
+      slot = max(now, self._next_slot)
+      self._next_slot = slot + self._interval
+    if slot > now:
+      time.sleep(slot - now)
+
+
+class _StatusWriteBuffer:
+  """
+  Gathers the status updates of several lines and writes them to the config
+  source at once.
+  """
+
+  def __init__(self, batch_size: int, flush_seconds: float):
+    self._batch_size = batch_size
+    self._flush_seconds = flush_seconds
+    self._updates = []
+    self._callbacks = []
+    self._last_flush = time.monotonic()
+    self._lock = threading.Lock()
+    self._timer = None
+
+  def add(self, update: Dict, on_written: Optional[Callable[[], None]] = None):
+    """
+    Adds the update of a line, flushing the buffer when it is full or when it
+    has not been flushed for too long. A timer flushes the buffer
+    `flush_seconds` after the first pending update, even if no other update is
+    added in the meantime.
+
+    Args:
+      update: Dict with the `index` of the line and the fields to write.
+      on_written: Function called once the batch of the update is written.
+    """
+    callbacks = []
+    with self._lock:
+      self._updates.append(update)
+      if on_written:
+        self._callbacks.append(on_written)
+      if (len(self._updates) >= self._batch_size or
+          time.monotonic() - self._last_flush >= self._flush_seconds):
+        callbacks = self._flush()
+      elif not self._timer:
+        self._timer = threading.Timer(self._flush_seconds, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+    self._run(callbacks)
+
+  def flush(self):
+    """
+    Writes all the pending updates to the config source.
+    """
+    with self._lock:
+      callbacks = self._flush()
+    self._run(callbacks)
+
+  def _flush(self) -> List[Callable[[], None]]:
+    if self._timer:
+      self._timer.cancel()
+      self._timer = None
+    updates, self._updates = self._updates, []
+    callbacks, self._callbacks = self._callbacks, []
+    self._last_flush = time.monotonic()
+    if updates:
+      try:
+        _CONFIG_SOURCE.write(updates)
+      except Exception as e:
+        print(f'Could not write the status of {len(updates)} lines: {e}')
+    return callbacks
+
+  @staticmethod
+  def _run(callbacks: List[Callable[[], None]]):
+    # Called without the lock, as the callbacks might add new updates
+    for callback in callbacks:
+      callback()
+
+
+class _ConfigSource(abc.ABC):
+  """
+  Where the config lines are read from and their status written to.
+  """
+
+  @abc.abstractmethod
+  def read(self) -> Iterator[Dict]:
+    """
+    Yields the config lines, with the number of each line in the source as
+    `index`. Only the input fields and the status are read.
+    """
+
+  @abc.abstractmethod
+  def write(self, updates: List[Dict]):
+    """
+    Writes the fields of several lines at once.
+
+    Args:
+      updates: List of dicts with the `index` of a line and the values of the
+        fields to write.
+    """
+
+
+class _SheetsConfigSource(_ConfigSource):
+  """
+  The config sheet of CONFIG_SPREADSHEET_ID. The column of each field written
+  is found by its name in the header row, unless it is set in SHEET_COLUMNS.
+  """
+
+  def __init__(self):
+    self._columns = None
+    self._lock = threading.Lock()
+
+  def read(self) -> Iterator[Dict]:
+    return _read_config_from_google_sheet(CONFIG_SPREADSHEET_ID, CONFIG_SHEET_NAME)
+
+  def write(self, updates: List[Dict]):
+    columns = self._get_columns()
+    data = []
+    for update in updates:
+      index = update['index']
+      for field, value in update.items():
+        if field not in columns:
+          continue
+        column = columns[field]
+        data.append({
+          'range' : f'{CONFIG_SHEET_NAME}!{column}{index}:{column}{index}',
+          'values' : [[value],],
+          'majorDimension' : 'COLUMNS'
+        })
+    if data:
+      _batch_update_sheet(data)
+
+  def _get_columns(self) -> Dict[str, str]:
+    with self._lock:
+      if self._columns is None:
+        self._columns = self._read_columns()
+      return self._columns
+
+  def _read_columns(self) -> Dict[str, str]:
+    """
+    Reads the header row to find the column of each field written. The fields
+    without a column are not written.
+    """
+    prefix, first_column, header_row, last_column = _parse_config_range(CONFIG_RANGE_NAME)
+    header_range = f'{prefix}{_column_letter(first_column)}{header_row}:{_column_letter(last_column)}{header_row}'
+    sheet = _sheets_service().spreadsheets()
+    _SHEETS_RATE_LIMITER.wait()
+    with _SHEETS_LOCK, _stage('sheet_read', client='sheets'):
+      result = sheet.values().get(spreadsheetId=CONFIG_SPREADSHEET_ID,
+                                  range=header_range).execute()
+    headers = (result.get('values') or [[]])[0]
+    positions = {field: first_column + i for i, field in enumerate(headers) if field}
+    columns = {}
+    for field, column in SHEET_COLUMNS.items():
+      if column:
+        columns[field] = column
+      elif field in positions:
+        columns[field] = _column_letter(positions[field])
+      else:
+        print(f'The config sheet has no {field} column, the field is not written')
+    return columns
+
+
+class _ManifestConfigSource(_ConfigSource):
+  """
+  A CSV or Parquet manifest with a config line per row, in a local file or in
+  GCS. The index of a line is its row number, counting the header as row 1.
+
+  The manifest itself is never modified: every batch of status updates is
+  written to a new CSV file under `<manifest>.status/`, and the latest status
+  of each line is merged into it when the manifest is read. The status files
+  read are then compacted into a single snapshot file, named so that it is
+  always applied first, so that their number does not grow with every batch.
+  """
+
+  _SNAPSHOT_NAME = '00000000000000000000-snapshot.csv'
+
+  def __init__(self, uri: str):
+    self._uri = uri
+    self._status_prefix = f'{uri}.status/'
+
+  def read(self) -> Iterator[Dict]:
+    statuses = self._read_statuses()
+    if self._uri.endswith('.parquet'):
+      rows = self._read_parquet()
+    else:
+      rows = self._read_csv(self._uri)
+    for i, row in enumerate(rows):
+      line = {field: '' if value is None else str(value)
+              for field, value in row.items()
+              if field and (field not in OUTPUT_FIELDS or field == 'status')}
+      if not any(line.values()):
+        continue
+      line['index'] = i + 2
+      if line['index'] in statuses:
+        line['status'] = statuses[line['index']]
+      yield line
+
+  def write(self, updates: List[Dict]):
+    fields = ['index'] + sorted({field for update in updates for field in update} - {'index'})
+    data = io.StringIO()
+    writer = csv.DictWriter(data, fields)
+    writer.writeheader()
+    writer.writerows(updates)
+    # Named after the time, so that the latest updates are applied last
+    name = (f"{self._status_prefix}{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+            f"-{uuid.uuid4().hex[:8]}.csv")
+    with _stage('status_write', client='storage' if _is_gcs(name) else None) as stage:
+      stage['bytes'] = len(data.getvalue())
+      if _is_gcs(name):
+        _gcs_blob(name).upload_from_string(data.getvalue(), content_type='text/csv')
+      else:
+        os.makedirs(self._status_prefix, exist_ok=True)
+        with open(name, 'w', newline='', encoding='utf-8') as f:
+          f.write(data.getvalue())
+
+  def _read_csv(self, uri: str) -> Iterator[Dict]:
+    with _stage('config_read', client='storage' if _is_gcs(uri) else None):
+      f = _open_file(uri)
+    with io.TextIOWrapper(f, encoding='utf-8', newline='') as text:
+      yield from csv.DictReader(text)
+
+  def _read_parquet(self) -> Iterator[Dict]:
+    if not pyarrow:
+      raise ImportError('Add pyarrow to requirements.txt to read Parquet manifests')
+    with _open_file(self._uri) as f:
+      parquet_file = pyarrow.parquet.ParquetFile(f)
+      columns = [name for name in parquet_file.schema_arrow.names
+                 if name not in OUTPUT_FIELDS or name == 'status']
+      for batch in parquet_file.iter_batches(batch_size=SHEETS_READ_PAGE_ROWS,
+                                             columns=columns):
+        yield from batch.to_pylist()
+
+  def _read_statuses(self) -> Dict[int, str]:
+    """
+    Reads the latest status of each line from the status files, and compacts
+    them into the snapshot file. The files are listed again if they were
+    compacted by another execution while they were read.
+    """
+    for attempt in range(3):
+      files = self._list_status_files()
+      try:
+        rows = self._merge_status_files(sorted(files))
+        break
+      except (NotFound, FileNotFoundError):
+        if attempt == 2:
+          raise
+        print('Status files compacted by another execution, reading them again')
+
+    if set(files) - {self._status_prefix + self._SNAPSHOT_NAME}:
+      self._compact_status_files(rows, files)
+    return {index: row['status'] for index, row in rows.items() if row.get('status')}
+
+  def _list_status_files(self) -> Dict[str, Optional[int]]:
+    """
+    Lists the status files, with the generation of each one in GCS.
+    """
+    if _is_gcs(self._status_prefix):
+      bucket_name, prefix = _split_gcs_uri(self._status_prefix)
+      with _stage('status_list', client='storage'):
+        return {f'gs://{bucket_name}/{blob.name}': blob.generation
+                for blob in _storage_client().bucket(bucket_name).list_blobs(prefix=prefix)
+                if blob.name.endswith('.csv')}
+    if os.path.isdir(self._status_prefix):
+      return {os.path.join(self._status_prefix, name): None
+              for name in os.listdir(self._status_prefix) if name.endswith('.csv')}
+    return {}
+
+  def _merge_status_files(self, names: List[str]) -> Dict[int, Dict]:
+    """
+    Merges the status files in order, keeping the latest value of every field
+    of each line.
+    """
+    rows = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(TTS_MAX_WORKERS, 1)) as executor:
+      for updates in executor.map(lambda name: list(self._read_csv(name)), names):
+        for update in updates:
+          row = rows.setdefault(int(update['index']), {})
+          row.update((field, value) for field, value in update.items() if value)
+    return rows
+
+  def _compact_status_files(self, rows: Dict[int, Dict],
+                            files: Dict[str, Optional[int]]):
+    """
+    Writes the merged statuses to the snapshot file and deletes the status
+    files merged into it, oldest first, so that the files left behind by a
+    failure are the latest ones and applying them again changes nothing. In
+    GCS the snapshot is only written if no other execution compacted the files
+    in the meantime.
+    """
+    snapshot = self._status_prefix + self._SNAPSHOT_NAME
+    fields = ['index'] + sorted({field for row in rows.values() for field in row} - {'index'})
+    data = io.StringIO()
+    writer = csv.DictWriter(data, fields)
+    writer.writeheader()
+    writer.writerows(rows[index] for index in sorted(rows))
+    merged = sorted(name for name in files if name != snapshot)
+    try:
+      with _stage('status_compact', client='storage' if _is_gcs(snapshot) else None) as stage:
+        stage['bytes'] = len(data.getvalue())
+        stage['files'] = len(merged)
+        if _is_gcs(snapshot):
+          _gcs_blob(snapshot).upload_from_string(
+              data.getvalue(), content_type='text/csv',
+              if_generation_match=files.get(snapshot) or 0)
+          for name in merged:
+            _gcs_blob(name).delete(if_generation_match=files[name])
+        else:
+          with open(f'{snapshot}.tmp', 'w', newline='', encoding='utf-8') as f:
+            f.write(data.getvalue())
+          os.replace(f'{snapshot}.tmp', snapshot)
+          for name in merged:
+            os.remove(name)
+    except Exception as e:
+      print(f'Could not compact the status files: {e}')
+
+
+class _DatabaseConfigSource(_ConfigSource):
+  """
+  A table with a config line per row, in a SQLite (sqlite:///path) or a
+  PostgreSQL (postgresql://...) database. The `id` column of the table is the
+  index of the lines, and the columns named after the fields written by the
+  process receive their values, with a statement per batch of updates.
+  """
+
+  def __init__(self, uri: str, table: str):
+    self._uri = uri
+    self._table = _quote_identifier(table)
+    self._sqlite = uri.startswith('sqlite:')
+    self._placeholder = '?' if self._sqlite else '%s'
+
+  def _connect(self):
+    if self._sqlite:
+      connection = sqlite3.connect(self._uri[len('sqlite:///'):], timeout=30)
+      # The status is written while the lines are still being read
+      connection.execute('PRAGMA journal_mode=WAL')
+      return connection
+    if not psycopg2:
+      raise ImportError('Add psycopg2-binary to requirements.txt to use a PostgreSQL config source')
+    return psycopg2.connect(self._uri)
+
+  def read(self) -> Iterator[Dict]:
+    connection = self._connect()
+    try:
+      cursor = connection.cursor()
+      cursor.execute(f'SELECT * FROM {self._table} WHERE 1 = 0')
+      columns = [column[0] for column in cursor.description
+                 if column[0] not in OUTPUT_FIELDS or column[0] == 'status']
+      if not self._sqlite:
+        # Server side cursor, the rows are fetched as they are consumed
+        cursor = connection.cursor(name='config_lines')
+      cursor.execute(f"SELECT {', '.join(map(_quote_identifier, columns))} "
+                     f'FROM {self._table} ORDER BY "id"')
+      while True:
+        with _stage('config_read') as stage:
+          rows = cursor.fetchmany(SHEETS_READ_PAGE_ROWS)
+          stage['rows'] = len(rows)
+        if not rows:
+          return
+        for row in rows:
+          line = {column: '' if value is None else str(value)
+                  for column, value in zip(columns, row)}
+          line['index'] = int(line.pop('id'))
+          yield line
+    finally:
+      connection.close()
+
+  def write(self, updates: List[Dict]):
+    # The lines updating the same fields share the same statement
+    statements = collections.defaultdict(list)
+    for update in updates:
+      fields = tuple(sorted(field for field in update if field != 'index'))
+      statements[fields].append([update[field] for field in fields] + [update['index']])
+
+    connection = self._connect()
+    try:
+      with _stage('status_write') as stage:
+        stage['rows'] = len(updates)
+        cursor = connection.cursor()
+        for fields, rows in statements.items():
+          assignments = ', '.join(
+              f'{_quote_identifier(field)} = {self._placeholder}' for field in fields)
+          cursor.executemany(
+              f'UPDATE {self._table} SET {assignments} WHERE "id" = {self._placeholder}',
+              rows)
+        connection.commit()
+    finally:
+      connection.close()
+
+
+def _build_config_source(uri: str) -> _ConfigSource:
+  """
+  Builds the config source of a CONFIG_SOURCE value.
+  """
+  if not uri:
+    return _SheetsConfigSource()
+  if uri.startswith(('sqlite:', 'postgres:', 'postgresql:')):
+    return _DatabaseConfigSource(uri, CONFIG_TABLE)
+  if uri.endswith(('.csv', '.parquet')):
+    return _ManifestConfigSource(uri)
+  raise ValueError(f'Unsupported config source {uri}')
+
+def _quote_identifier(name: str) -> str:
+  return '"' + name.replace('"', '""') + '"'
+
+def _is_gcs(uri: str) -> bool:
+  return uri.startswith('gs://')
+
+def _split_gcs_uri(uri: str) -> Tuple[str, str]:
+  bucket_name, unused_separator, name = uri[len('gs://'):].partition('/')
+  return bucket_name, name
+
+def _gcs_blob(uri: str):
+  bucket_name, name = _split_gcs_uri(uri)
+  return _storage_client().bucket(bucket_name).blob(name)
+
+def _open_file(uri: str):
+  """
+  Opens a local or a GCS file for binary reading.
+  """
+  if _is_gcs(uri):
+    return _gcs_blob(uri).open('rb')
+  return open(uri, 'rb')
+
+
+_TTS_RATE_LIMITER = _RateLimiter(TTS_REQUESTS_PER_MINUTE)
+_SHEETS_RATE_LIMITER = _RateLimiter(SHEETS_REQUESTS_PER_MINUTE)
+_CONFIG_SOURCE = _build_config_source(CONFIG_SOURCE)
+_STATUS_WRITER = _StatusWriteBuffer(SHEETS_BATCH_SIZE, SHEETS_FLUSH_SECONDS)
+atexit.register(_STATUS_WRITER.flush)
+# The chunks of the long texts have their own pool, since the lines are already
+# processed by the workers of the main pool.
+_CHUNK_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(TTS_CHUNK_MAX_WORKERS, 1))
+_SEGMENT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(TTS_SEGMENT_MAX_WORKERS, 1))
+
+# The API clients are created once per instance and reused by every line and
+# by the following invocations while the instance stays warm.
+_CLIENTS = {}
+_CLIENT_STATS = {}
+_CLIENTS_LOCK = threading.Lock()
+# httplib2, used by the Sheets service, is not thread safe, so the requests of
+# the shared service are executed one at a time.
+_SHEETS_LOCK = threading.Lock()
+
+def _get_client(name: str, factory):
+  """
+  Returns the client registered with name, creating it with factory the first
+  time it is requested.
+
+  Args:
+    name: name of the client in the registry
+    factory: callable without arguments that creates the client
+  """
+  with _CLIENTS_LOCK:
+    if name not in _CLIENTS:
+      start = time.perf_counter()
+      _CLIENTS[name] = factory()
+      _CLIENT_STATS[name] = {
+        'init_seconds': time.perf_counter() - start,
+        'created': start,
+        'calls': 0,
+        'call_seconds': 0.0,
+      }
+    return _CLIENTS[name]
+
+@contextlib.contextmanager
+def _client_call(name: str):
+  """
+  Measures the time spent in an API call made with the client registered with
+  name.
+
+  Args:
+    name: name of the client in the registry
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    with _CLIENTS_LOCK:
+      stats = _CLIENT_STATS.get(name)
+      if stats:
+        stats['calls'] += 1
+        stats['call_seconds'] += elapsed
+
+def _report_client_stats(invocation_start: float):
+  """
+  Prints the cost of creating each client, whether it was created in this
+  invocation (cold) or reused from a previous one (warm), and the average cost
+  of the calls made with it. The call counters are reset afterwards.
+
+  Args:
+    invocation_start: time.perf_counter() value at the start of the invocation
+  """
+  with _CLIENTS_LOCK:
+    report = {}
+    for name, stats in _CLIENT_STATS.items():
+      report[name] = {
+        'cold': stats['created'] >= invocation_start,
+        'init_seconds': round(stats['init_seconds'], 4),
+        'calls': stats['calls'],
+        'avg_call_seconds': round(
+            stats['call_seconds'] / stats['calls'], 4) if stats['calls'] else 0,
+      }
+      stats['calls'] = 0
+      stats['call_seconds'] = 0.0
+  print(json.dumps({'client_stats': report}))
+
+class _RunMetrics:
+  """
+  Collects the duration, bytes moved and outcome of every stage of a run, and
+  the number of lines of each kind it handled. Each stage is logged as a JSON
+  line, which Cloud Logging parses as a structured log, and a summary with the
+  percentiles of each stage and the counters is logged at the end.
+  """
+
+  def __init__(self):
+    self.run_id = None
+    self._stages = collections.defaultdict(list)
+    self._counters = collections.Counter()
+    self._local = threading.local()
+    self._lock = threading.Lock()
+
+  def start_run(self, run_id: str):
+    """
+    Starts a new run, discarding the stages recorded so far.
+
+    Args:
+      run_id: identifier of the run added to every log
+    """
+    with self._lock:
+      self.run_id = run_id
+      self._stages.clear()
+      self._counters.clear()
+
+  def set_row(self, row):
+    """
+    Sets the index of the row processed by the current thread, which is added
+    to the stages that do not specify their row.
+
+    Args:
+      row: index of the row in the sheet
+    """
+    self._local.row = row
+
+  def get_row(self):
+    return getattr(self._local, 'row', None)
+
+  def record(self, entry: Dict):
+    """
+    Logs a stage and keeps it for the summary.
+
+    Args:
+      entry: Dict with the stage, row, outcome, seconds and bytes moved
+    """
+    entry['run_id'] = self.run_id
+    with self._lock:
+      # Logged under the lock so that the lines of the threads do not mix
+      print(json.dumps(entry, default=str))
+      self._stages[entry['stage']].append(
+          (entry['seconds'], entry['outcome'], entry.get('bytes', 0)))
+
+  def count(self, name: str, number: int = 1):
+    """
+    Adds to a counter of the run.
+
+    Args:
+      name: name of the counter, e.g. lines_skipped
+      number: number to add
+    """
+    with self._lock:
+      self._counters[name] += number
+
+  def get_count(self, name: str) -> int:
+    with self._lock:
+      return self._counters[name]
+
+  def report_summary(self):
+    """
+    Logs the number of executions, errors, bytes moved and the p50 and p95
+    durations of each stage of the run.
+    """
+    summary = {}
+    with self._lock:
+      for stage, entries in self._stages.items():
+        durations = sorted(seconds for seconds, unused_outcome, unused_bytes in entries)
+        summary[stage] = {
+          'count': len(entries),
+          'errors': sum(outcome != 'ok' for unused_seconds, outcome, unused_bytes in entries),
+          'bytes': sum(size for unused_seconds, unused_outcome, size in entries),
+          'total_seconds': round(sum(durations), 4),
+          'p50_seconds': _percentile(durations, 50),
+          'p95_seconds': _percentile(durations, 95),
+        }
+    print(json.dumps({'run_id': self.run_id, 'run_summary': summary,
+                      'counters': dict(self._counters)}))
+
+
+_METRICS = _RunMetrics()
+
+def _percentile(values: List[float], percent: float) -> float:
+  """
+  Returns the nearest rank percentile of a sorted list of values.
+
+  Args:
+    values: sorted list of values
+    percent: percentile to compute, between 0 and 100
+  """
+  if not values:
+    return 0
+  return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+@contextlib.contextmanager
+def _stage(name: str, row=None, client: Optional[str] = None):
+  """
+  Measures a stage of the run and records its outcome. The body can add the
+  number of bytes moved to the `bytes` key of the yielded dict.
+
+  Args:
+    name: name of the stage
+    row: index of the row processed, by default the one of the current thread
+    client: name of the client used, whose call stats are also updated
+  """
+  entry = {'stage': name, 'row': row if row is not None else _METRICS.get_row()}
+  start = time.perf_counter()
+  try:
+    with _client_call(client) if client else contextlib.nullcontext():
+      yield entry
+    entry['outcome'] = 'ok'
+  except Exception as e:
+    entry['outcome'] = 'error'
+    entry['error'] = str(e)
+    raise
+  finally:
+    entry['seconds'] = round(time.perf_counter() - start, 4)
+    _METRICS.record(entry)
+
+def _tts_client():
+  return _get_client('texttospeech', texttospeech.TextToSpeechClient)
+
+def _storage_client():
+  return _get_client('storage', storage.Client)
+
+def _publisher_client():
+  return _get_client('pubsub', lambda: pubsub_v1.PublisherClient(
+      batch_settings=pubsub_v1.types.BatchSettings(
+          max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+          max_bytes=PUBSUB_BATCH_MAX_BYTES,
+          max_latency=PUBSUB_BATCH_MAX_LATENCY)))
+
+def _sheets_service():
+  return _get_client('sheets', lambda: build(
+      'sheets', 'v4', credentials=None, cache_discovery=False))
 
 def main(event: Dict[str, Any], context=Optional[Context]):
   """
@@ -65,139 +855,1072 @@ def main(event: Dict[str, Any], context=Optional[Context]):
       metadata. The `event_id` field contains the Pub/Sub message ID. The
       `timestamp` field contains the publish time.
   """
-  del context # unused
   del event # unused
-  lines = _read_config_from_google_sheet(CONFIG_SPREADSHEET_ID,CONFIG_SHEET_NAME)
-  lines = _generate_tts(lines)
+  invocation_start = time.perf_counter()
+  _METRICS.start_run(getattr(context, 'event_id', None) or uuid.uuid4().hex)
+  lines = _CONFIG_SOURCE.read()
+  fingerprints = None
+  if INCREMENTAL_MODE:
+    state = _load_state()
+    fingerprints = {}
+    lines = _select_pending(lines, state, fingerprints)
+  try:
+    if DISPATCH_MODE:
+      _dispatch_tasks(lines)
+    else:
+      _generate_tts(lines, fingerprints)
+  finally:
+    _STATUS_WRITER.flush()
+  if INCREMENTAL_MODE:
+    handled = 'dispatched' if DISPATCH_MODE else 'processed'
+    print(f"Incremental mode: {_METRICS.get_count(f'lines_{handled}')} lines "
+          f"{handled}, {_METRICS.get_count('lines_skipped')} unchanged lines skipped")
+  _METRICS.report_summary()
+  _report_client_stats(invocation_start)
 
-def _read_config_from_google_sheet(sheet_id, sheet_name) -> List[Dict]:
+def worker(event: Dict[str, Any], context=Optional[Context]):
   """
-  Reads all the lines in a Google Sheet having the first row the name of the fields and outputs an array of dicts.
+  Generates the TTS files of the lines of a task published by main in dispatch
+  mode, skipping the lines leased by another execution.
+
+  Args:
+    event (dict):  The dictionary with data specific to this type of event. The
+      `data` field contains the PubsubMessage message, whose `lines` field
+      contains the lines to process.
+    context (google.cloud.functions.Context): The Cloud Functions event
+      metadata. The `event_id` field contains the Pub/Sub message ID. The
+      `timestamp` field contains the publish time.
+  """
+  invocation_start = time.perf_counter()
+  _METRICS.start_run(getattr(context, 'event_id', None) or uuid.uuid4().hex)
+  task = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+  fingerprints = {line['index']: _build_fingerprint(line) for line in task['lines']}
+  leases = {}
+  for line in task['lines']:
+    generation = _acquire_lease(line, fingerprints[line['index']])
+    if generation:
+      leases[line['index']] = generation
+    else:
+      print(f"Line {line['index']} is leased by another execution, skipping it")
+  lines = [line for line in task['lines'] if line['index'] in leases]
+  try:
+    _generate_tts(lines, fingerprints if INCREMENTAL_MODE else None)
+  finally:
+    _STATUS_WRITER.flush()
+    for line in lines:
+      _release_lease(line, fingerprints[line['index']], leases[line['index']])
+  _METRICS.report_summary()
+  _report_client_stats(invocation_start)
+
+def _read_config_from_google_sheet(sheet_id, sheet_name) -> Iterator[Dict]:
+  """
+  Reads the lines of CONFIG_RANGE_NAME in a Google Sheet, whose first row has
+  the name of the fields, and yields them as dicts.
+
+  The lines are read in pages of SHEETS_READ_PAGE_ROWS rows, as they are
+  consumed, and only the columns of the fields read by the process are
+  fetched: the columns written by the process are skipped, except the status.
 
   Args:
     sheet_id: The ID of the Google Sheet.
     sheet_name: The name of the sheet in the Google Sheet.
 
-  Returns:
-    An array of dicts, where each dict represents a row in the Google Sheet.
+  Yields:
+    A dict for each non empty row, with every field read and the number of the
+    row in the sheet as `index`.
   """
-  creds = None
-  # The file token.json stores the user's access and refresh tokens, and is
-  # created automatically when the authorization flow completes for the first
-  # time.
-  rows = []
+  del sheet_name # The sheet is part of CONFIG_RANGE_NAME
+  prefix, first_column, header_row, last_column = _parse_config_range(CONFIG_RANGE_NAME)
   try:
-      service = build('sheets', 'v4', credentials=None)
+    sheet = _sheets_service().spreadsheets()
+    header_range = f'{prefix}{_column_letter(first_column)}{header_row}:{_column_letter(last_column)}{header_row}'
+    _SHEETS_RATE_LIMITER.wait()
+    with _SHEETS_LOCK, _stage('sheet_read', client='sheets'):
+      result = sheet.values().get(spreadsheetId=sheet_id,
+                                  range=header_range).execute()
+      # The pages must not go beyond the last row of the sheet
+      properties = sheet.get(spreadsheetId=sheet_id, ranges=header_range,
+                             fields='sheets.properties.gridProperties.rowCount').execute()
+    headers = (result.get('values') or [[]])[0]
+    row_count = properties['sheets'][0]['properties']['gridProperties']['rowCount']
+    if not headers:
+      print('No values')
+      return
 
-      # Call the Sheets API
-      sheet = service.spreadsheets()
-      result = sheet.values().get(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                  range=CONFIG_RANGE_NAME).execute()
-      values = result.get('values', [])
-
-      # Create an array of dicts, where each dict represents a row in the Google Sheet.
-      if not values:
-        print('No values')
-        return rows
-
-      headers = values[0]
-      i = 2
-      for row in values[1:]:
-          if row:
-              new_row = {field: value for field, value in zip(headers, row)}
-              new_row['index'] = i
-              rows.append(new_row)
-              i = i + 1
+    # Runs of consecutive columns to read, as (first, last) header positions
+    runs = []
+    for i, field in enumerate(headers):
+      if not field or (field in OUTPUT_FIELDS and field != 'status'):
+        continue
+      if runs and runs[-1][1] == i - 1:
+        runs[-1] = (runs[-1][0], i)
+      else:
+        runs.append((i, i))
+
+    page_start = header_row + 1
+    while page_start <= row_count:
+      page_end = min(page_start + SHEETS_READ_PAGE_ROWS - 1, row_count)
+      ranges = [
+        f'{prefix}{_column_letter(first_column + first)}{page_start}'
+        f':{_column_letter(first_column + last)}{page_end}'
+        for first, last in runs]
+      _SHEETS_RATE_LIMITER.wait()
+      with _SHEETS_LOCK, _stage('sheet_read', client='sheets') as stage:
+        result = sheet.values().batchGet(spreadsheetId=sheet_id,
+                                         ranges=ranges).execute()
+        pages = [value_range.get('values', [])
+                 for value_range in result.get('valueRanges', [])]
+        page_rows = max((len(page) for page in pages), default=0)
+        stage['rows'] = page_rows
+
+      for offset in range(page_rows):
+        line = {}
+        for (first, last), page in zip(runs, pages):
+          cells = page[offset] if offset < len(page) else []
+          for i in range(first, last + 1):
+            line[headers[i]] = cells[i - first] if i - first < len(cells) else ''
+        if any(line.values()):
+          line['index'] = page_start + offset
+          yield line
+      page_start = page_end + 1
 
   except HttpError as err:
       print(err)
 
-  return rows
+def _parse_config_range(a1_range: str) -> Tuple[str, int, int, int]:
+  """
+  Parses a range like config!A1:Z into its sheet prefix, the zero based
+  positions of its first and last columns and the number of its first row.
+  """
+  match = re.fullmatch(r'(.*!)?([A-Z]+)(\d*):([A-Z]+)\d*', a1_range)
+  if not match:
+    raise ValueError(f'Invalid config range {a1_range}, it must be like config!A1:Z')
+  prefix, first_column, first_row, last_column = match.groups()
+  return (prefix or '', _column_index(first_column), int(first_row or 1),
+          _column_index(last_column))
+
+def _column_index(letters: str) -> int:
+  index = 0
+  for letter in letters:
+    index = index * 26 + ord(letter) - ord('A') + 1
+  return index - 1
+
+def _column_letter(index: int) -> str:
+  letters = ''
+  index += 1
+  while index:
+    index, remainder = divmod(index - 1, 26)
+    letters = chr(ord('A') + remainder) + letters
+  return letters
 
-def _generate_tts(lines: List[Dict]) -> List[Dict]:
- """
-  For each line makes a call to Google TTS AI to generate the audio files and store them in GCS
+def _build_fingerprint(line: Dict) -> str:
+  """
+  It builds a hash of all the input fields of the line
 
   Args:
-    lines: Dict object containing all
-    sheet_name: The name of the sheet in the Google Sheet.
+    line: Dict object containing the fields of a row in the Google Sheet
 
   Returns:
-    An array of dicts, where each dict represents a row in the Google Sheet.
+    A string with the hex digest of the input fields
   """
- for line in lines:
-    if line:
-      try:
-        today =  datetime.today().strftime('%Y%m%d')
-        file_name = f"output/{today}/{_build_file_name(line)}"
-        _tts_api_call(line, file_name)
-        line['status'] = 'TTS OK'
-        line['tts_file_url'] = file_name
-        _call_video_generation(line)
+  fields = {k: v for k, v in line.items() if k not in OUTPUT_FIELDS}
+  return hashlib.sha256(
+      json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
 
-      except Exception as e:
+def _is_pending(line: Dict, state: Dict) -> bool:
+  """
+  Checks whether a line must be processed in incremental mode, which happens
+  when the line is new, has failed or has been modified since the last time it
+  was processed successfully.
+
+  Args:
+    line: Dict object containing the fields of a row in the Google Sheet
+    state: Dict with the fingerprints of the lines processed successfully
+
+  Returns:
+    True if the line has to be processed
+  """
+  if line.get('status') not in SUCCESS_STATUSES:
+    return True
+  processed = state['rows'].get(str(line['index']))
+  return not processed or processed['fingerprint'] != _build_fingerprint(line)
+
+def _select_pending(lines: Iterable[Dict], state: Dict,
+                    fingerprints: Dict[int, str]) -> Iterator[Dict]:
+  """
+  Yields the lines that must be processed in incremental mode, recording their
+  fingerprint before they are processed.
+
+  Args:
+    lines: the lines read from the sheet
+    state: Dict with the fingerprints of the lines processed successfully
+    fingerprints: Dict where the fingerprint of each pending line is stored,
+      by line index
+  """
+  for line in lines:
+    if _is_pending(line, state):
+      fingerprints[line['index']] = _build_fingerprint(line)
+      yield line
+    else:
+      _METRICS.count('lines_skipped')
+
+def _load_state() -> Dict:
+  """
+  Lists the incremental mode state objects under STATE_PREFIX. The fingerprint
+  of each line is read from the metadata of its object, so that the objects
+  do not have to be downloaded.
+
+  Returns:
+    A dict whose `rows` field has the fingerprint of every line processed
+    successfully, by line index.
+  """
+  storage_client = _storage_client()
+  rows = {}
+  with _stage('state_read', client='storage') as stage:
+    for blob in storage_client.bucket(STATE_BUCKET).list_blobs(
+        prefix=f'{STATE_PREFIX}/'):
+      fingerprint = (blob.metadata or {}).get('fingerprint')
+      if fingerprint:
+        key = blob.name[len(STATE_PREFIX) + 1:].rsplit('.', 1)[0]
+        rows[key] = {'fingerprint': fingerprint}
+    stage['rows'] = len(rows)
+  return {'rows': rows}
+
+def _save_state(line: Dict, fingerprints: Optional[Dict[int, str]]):
+  """
+  Records the state of a line as soon as its status is known, so that the
+  progress is kept even if the execution times out. Does nothing when not in
+  incremental mode.
+
+  Args:
+    line: Dict object containing the fields of a row in the Google Sheet
+    fingerprints: Dict with the fingerprint of each line, by line index,
+      computed before the line was processed, or None when not in incremental
+      mode
+  """
+  if fingerprints is not None:
+    _save_line_state(line, fingerprints[line['index']])
+
+def _save_line_state(line: Dict, fingerprint: str):
+  """
+  Writes the state object of a line processed successfully, or deletes it if
+  the line failed. Errors are only logged, the line is processed again by the
+  next execution if its state could not be saved.
+
+  Args:
+    line: Dict object containing the fields of a row in the Google Sheet
+    fingerprint: the fingerprint of the line, computed before it was processed
+  """
+  storage_client = _storage_client()
+  blob = storage_client.bucket(STATE_BUCKET).blob(
+      f"{STATE_PREFIX}/{line['index']}.json")
+  try:
+    with _stage('state_write', row=line['index'], client='storage') as stage:
+      if line.get('status') == 'TTS OK':
+        data = json.dumps({
+          'fingerprint': fingerprint,
+          'last_update': datetime.now().strftime("%Y/%m/%d, %H:%M:%S"),
+        })
+        stage['bytes'] = len(data)
+        blob.metadata = {'fingerprint': fingerprint}
+        blob.upload_from_string(data, content_type='application/json')
+      elif blob.exists():
+        blob.delete()
+  except NotFound:
+    pass
+  except Exception as e:
+    print(f"Could not save the state of line {line['index']}: {e}")
+
+def _dispatch_tasks(lines: Iterable[Dict]):
+  """
+  Publishes the lines to TTS_TASKS_TOPIC in tasks of up to TTS_TASK_BATCH_SIZE
+  lines, as soon as each task is complete. In group mode the lines sharing the
+  same video and base audio are sent in the same tasks, so that their videos
+  are still generated together. Lines whose task could not be published are
+  marked as failed in the sheet.
+
+  Args:
+    lines: the lines to process
+  """
+  groups = {}
+  published = []
+  batch_size = max(TTS_TASK_BATCH_SIZE, 1)
+  line_count = 0
+  for line in lines:
+    line_count += 1
+    key = _video_group_key(line) if VIDEO_GROUP_MODE else None
+    batch = groups.setdefault(key, [])
+    batch.append(line)
+    if len(batch) == batch_size:
+      published.append((batch, _send_pub_sub({'lines': batch}, TTS_TASKS_TOPIC)))
+      del groups[key]
+  for batch in groups.values():
+    published.append((batch, _send_pub_sub({'lines': batch}, TTS_TASKS_TOPIC)))
+
+  for batch, future in published:
+    try:
+      with _stage('publish_result'):
+        future.result(timeout=PUBSUB_PUBLISH_TIMEOUT)
+    except Exception as e:
+      print(e)
+      for line in batch:
         line['status'] = e
         line['tts_file_url'] = 'N/A'
-        print(e)
+        _update_config_line(line)
+    else:
+      _METRICS.count('lines_dispatched', len(batch))
+  print(f'Dispatched {line_count} lines in {len(published)} tasks')
+
+def _lease_blob(line: Dict):
+  storage_client = _storage_client()
+  return storage_client.bucket(STATE_BUCKET).blob(f"{LEASE_PREFIX}/{line['index']}.json")
+
+def _build_lease(fingerprint: str, state: str) -> str:
+  return json.dumps({
+    'run_id': _METRICS.run_id,
+    'fingerprint': fingerprint,
+    'state': state,
+    'expires': time.time() + LEASE_SECONDS,
+  })
+
+def _acquire_lease(line: Dict, fingerprint: str) -> Optional[int]:
+  """
+  Leases a line for LEASE_SECONDS. The lease object is only created if it does
+  not exist, and it is only taken over from another execution when it expired,
+  or when that execution finished with a different version of the line.
+
+  Args:
+    line: Dict object containing the fields of a row in the Google Sheet
+    fingerprint: the fingerprint of the line
+
+  Returns:
+    The generation of the lease object, or None if the line is leased by
+    another execution
+  """
+  blob = _lease_blob(line)
+  generation = 0
+  for unused_attempt in range(3):
+    try:
+      with _stage('lease_acquire', row=line['index'], client='storage'):
+        blob.upload_from_string(_build_lease(fingerprint, 'processing'),
+                                content_type='application/json',
+                                if_generation_match=generation)
+      return blob.generation
+    except PreconditionFailed:
+      current = blob.bucket.get_blob(blob.name)
+      if not current:
+        generation = 0
+        continue
+      lease = json.loads(current.download_as_bytes())
+      if lease['expires'] > time.time() and (
+          lease['state'] == 'processing' or lease['fingerprint'] == fingerprint):
+        return None
+      generation = current.generation
+  return None
+
+def _release_lease(line: Dict, fingerprint: str, generation: int):
+  """
+  Releases the lease of a line. The lease of a line processed successfully is
+  kept until it expires, so that overlapping executions that read the line
+  before its status was updated do not process it again. The lease of a failed
+  line is deleted, so that it can be retried right away.
+
+  Args:
+    line: Dict object containing the fields of a row in the Google Sheet
+    fingerprint: the fingerprint of the line
+    generation: the generation of the lease object
+  """
+  blob = _lease_blob(line)
+  try:
+    with _stage('lease_release', row=line['index'], client='storage'):
+      if line.get('status') == 'TTS OK':
+        blob.upload_from_string(_build_lease(fingerprint, 'done'),
+                                content_type='application/json',
+                                if_generation_match=generation)
+      else:
+        blob.delete(if_generation_match=generation)
+  except Exception as e:
+    print(f"Could not release the lease of line {line['index']}: {e}")
+
+def _generate_tts(lines: Iterable[Dict],
+                  fingerprints: Optional[Dict[int, str]] = None) -> List[Dict]:
+  """
+  Generates the audio file of every line using a bounded pool of workers.
+
+  Up to TTS_MAX_WORKERS lines are processed at the same time, while the calls
+  to the TTS and Sheets APIs are paced to respect their quotas. The lines are
+  taken from `lines` as the workers become free, so the first lines are
+  processed while the next pages of the sheet are not read yet. The video
+  generation message of each line is published once its status is written
+  with the next batch of statuses. In group mode the lines sharing the same
+  video and base audio are sent together as soon as VIDEO_GROUP_MAX_SIZE of
+  them are generated, and the incomplete groups once all the lines are done.
+  The lines whose message could not be published are marked as failed. In
+  incremental mode the state of each line is saved along with its status.
+
+  Args:
+    lines: the lines to process, where each dict represents a row in the
+      Google Sheet.
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+
+  Returns:
+    An array of dicts, where each dict represents a row in the Google Sheet.
+  """
+  max_workers = max(TTS_MAX_WORKERS, 1)
+  processed = []
+  published = []
+  groups = {}
+
+  def collect(result: Optional[Tuple[Dict, Any]]):
+    if not result:
+      return
+    if not VIDEO_GROUP_MODE:
+      published.append(result)
+      return
+    line, unused_future = result
+    key = _video_group_key(line)
+    group = groups.setdefault(key, [])
+    group.append(line)
+    # Sent as soon as it is complete, so that a timeout loses no finished group
+    if len(group) >= VIDEO_GROUP_MAX_SIZE:
+      published.extend(_call_grouped_video_generation(groups.pop(key), fingerprints))
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    running = collections.deque()
+    for line in lines:
+      if not line:
+        continue
+      processed.append(line)
+      running.append(executor.submit(_process_line, line, fingerprints))
+      # Keeps a few lines queued so that the workers never wait for the sheet
+      if len(running) >= 2 * max_workers:
+        collect(running.popleft().result())
+    for future in running:
+      collect(future.result())
+
+  for group in groups.values():
+    published.extend(_call_grouped_video_generation(group, fingerprints))
+  # The messages are published once the status of their lines is written
+  _STATUS_WRITER.flush()
+  _resolve_publications(published, fingerprints)
+
+  return processed
+
+
+def _process_line(line: Dict, fingerprints: Optional[Dict[int, str]] = None
+                  ) -> Optional[Tuple[Dict, Any]]:
+  """
+  Makes a call to Google TTS AI to generate the audio file of a line, stores it
+  in GCS and triggers the video generation. Lines that fail are updated in the
+  sheet right away.
+
+  Args:
+    line: Dict object containing the fields to generate the tts audio file
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+
+  Returns:
+    A tuple with the line and the future of the video generation message, or
+    None if the line failed. In group mode the message is not sent yet, nor the
+    status of the line queued, and the future is None.
+  """
+  _METRICS.set_row(line['index'])
+  _METRICS.count('lines_processed')
+  try:
+    today =  datetime.today().strftime('%Y%m%d')
+    file_name = f"output/{today}/{_build_file_name(line)}"
+    if line.get('timeline', '').strip():
+      line['segments'] = _synthesize_timeline(line, file_name)
+      file_name = '\n'.join(segment['tts_file_url'] for segment in line['segments'])
+    else:
+      # Sent to the video generation, so that it does not have to probe the file
+      line['speech_duration_seconds'] = _synthesize(line, file_name)
+    # Not needed anymore, the video generation only reads the audio files
+    for field in TTS_ONLY_FIELDS:
+      line.pop(field, None)
+    line['status'] = 'TTS OK'
+    line['tts_file_url'] = file_name
+    if VIDEO_GROUP_MODE:
+      return line, None
+    return line, _call_video_generation(line, fingerprints)
+
+  except Exception as e:
+    line['status'] = e
+    line['tts_file_url'] = 'N/A'
+    print(e)
+
+  _update_config_line(line)
+  _save_state(line, fingerprints)
+  return None
+
+
+def _check_publication(lines: List[Dict],
+                       fingerprints: Optional[Dict[int, str]], future):
+  """
+  Called once a video generation message is published, or failed to be. The
+  lines of a message that could not be published are marked as failed, as
+  their status was written before the message was sent.
+
+  Args:
+    lines: List of dicts with the lines sent in the message
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+    future: the future of the message
+  """
+  try:
+    future.result()
+  except Exception as e:
+    print(e)
+    for line in lines:
+      line['status'] = e
+      line['tts_file_url'] = 'N/A'
+      _update_config_line(line)
+      _save_state(line, fingerprints)
+
+def _resolve_publications(published: List[Tuple[Dict, Any]],
+                          fingerprints: Optional[Dict[int, str]] = None):
+  """
+  Waits for the video generation messages to be published, so that the
+  execution does not end before they are sent. The lines whose message is not
+  published after PUBSUB_PUBLISH_TIMEOUT seconds are marked as failed, the
+  other publication errors are handled by `_check_publication`.
+
+  Args:
+    published: List of tuples with a line and the future of its message
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+  """
+  for line, future in published:
+    try:
+      with _stage('publish_result', row=line['index']):
+        future.result(timeout=PUBSUB_PUBLISH_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+      line['status'] = (f'Video generation message not published after '
+                        f'{PUBSUB_PUBLISH_TIMEOUT:g}s')
+      line['tts_file_url'] = 'N/A'
+      print(line['status'])
+      _update_config_line(line)
+      _save_state(line, fingerprints)
+    except Exception:
+      pass
+
+
+def _synthesize_timeline(line: Dict, file_name: str) -> List[Dict]:
+  """
+  Synthesizes concurrently the segments of the timeline of a line. The
+  timeline is a JSON list of segments with their `millisecond_start_audio` and
+  `text`, and optionally their own `voice_id`, e.g.
+  [{"millisecond_start_audio": 0, "text": "<speak>Hi</speak>"},
+   {"millisecond_start_audio": 4500, "text": "<speak>Bye</speak>"}]
+
+  Args:
+    line: Dict object containing the fields to generate the tts audio files
+    file_name: the name of the file of the line, to which the index of each
+      segment is appended
+
+  Returns:
+    A list with the file, start and duration of each segment
+  """
+  segments = json.loads(line['timeline'])
+  if not isinstance(segments, list) or not segments:
+    raise ValueError('The timeline must be a non empty JSON list of segments')
+  base_name, extension = os.path.splitext(file_name)
+
+  def synthesize_segment(numbered_segment: Tuple[int, Dict]) -> Dict:
+    i, segment = numbered_segment
+    _METRICS.set_row(line['index'])
+    segment_line = dict(line, text=segment['text'],
+                        voice_id=segment.get('voice_id', line['voice_id']))
+    segment_file_name = f'{base_name}-{i}{extension}'
+    return {
+      'tts_file_url': segment_file_name,
+      'millisecond_start_audio': str(int(segment['millisecond_start_audio'])),
+      'speech_duration_seconds': _synthesize(segment_line, segment_file_name),
+    }
+
+  return list(_SEGMENT_EXECUTOR.map(synthesize_segment, enumerate(segments)))
+
+def _synthesize(line: Dict, file_name: str) -> Optional[float]:
+  """
+  Writes the audio file of the line into file_name, reusing a previously
+  generated audio file when the TTS request is exactly the same.
+
+  The audio files are cached in gcs_bucket under TTS_CACHE_PREFIX, named after
+  a hash of the TTS request parameters. Cache hits are served with a server
+  side copy, so the TTS API is only called for new or modified lines.
+
+  Args:
+    line: Dict object containing the fields to generate the tts audio file
+    file_name: the name of the file to write
+
+  Returns:
+    The duration of the audio in seconds, or None if it is unknown
+  """
+  if not TTS_CACHE_ENABLED:
+    return _tts_api_call(line, file_name)
+
+  storage_client = _storage_client()
+  bucket = storage_client.bucket(line['gcs_bucket'])
+  cache_file_name = _build_cache_file_name(line)
 
-      _update_sheet_line(line)
+  with _stage('cache_lookup', client='storage') as stage:
+    cache_blob = bucket.get_blob(cache_file_name)
+    stage['hit'] = cache_blob is not None
+  if cache_blob:
+    # The metadata, with the duration of the audio, is copied too
+    with _stage('cache_copy', client='storage'):
+      bucket.copy_blob(cache_blob, bucket, file_name)
+    duration = (cache_blob.metadata or {}).get('speech_duration_seconds')
+    return float(duration) if duration else None
 
- return lines
+  duration = _tts_api_call(line, file_name)
+  with _stage('cache_store', client='storage'):
+    bucket.copy_blob(bucket.blob(file_name), bucket, cache_file_name)
+  return duration
 
+def _build_cache_file_name(line: Dict) -> str:
+  """
+  It builds the name of the cached audio file from a hash of the TTS request
+
+  Args:
+    line: Dict object containing the fields to generate the tts audio file
 
-def _tts_api_call(line: Dict, file_name: str):
+  Returns:
+    A string with the name of the file in the TTS cache
+  """
+  params = _build_tts_params(line)
+  params['cache_version'] = TTS_CACHE_VERSION
+  if _needs_chunking(params):
+    params['chunk_max_bytes'] = TTS_CHUNK_MAX_BYTES
+  key = hashlib.sha256(
+      json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+  return f"{TTS_CACHE_PREFIX}/{key}.{line['audio_encoding'].lower()}"
+
+def _build_tts_params(line: Dict) -> Dict:
+  """
+  It extracts the parameters of the TTS request from the line. Every parameter
+  that changes the generated audio must be here, since they are also the key
+  of the TTS cache.
+
+  Args:
+    line: Dict object containing the fields to generate the tts audio file
+
+  Returns:
+    A dict with the parameters of the TTS request
+  """
+  return {
+    'ssml': line['text'],
+    'language_code': line['voice_id'][:5],
+    'voice_name': line['voice_id'].split('##')[0],
+    'audio_encoding': line['audio_encoding'],
+  }
+
+def _tts_api_call(line: Dict, file_name: str) -> Optional[float]:
   """
   It call the TTS API with the parameters received in the line parameter
 
   Args:
     line: Dict object containing the fields to generate the tts audio file
+    file_name: the name of the file to write
+
+  Returns:
+    The duration of the audio in seconds, or None if it is unknown
+  """
+  params = _build_tts_params(line)
+  if _needs_chunking(params):
+    audio_content = _synthesize_chunked(params)
+  else:
+    audio_content = _synthesize_request(params['ssml'], params,
+                                        params['audio_encoding'])
+
+  duration = _probe_audio_duration(
+      lambda start, length: audio_content[start:start + length],
+      len(audio_content))
+  _write_to_gcs(line['gcs_bucket'], file_name, audio_content, duration)
+  return duration
+
+def _synthesize_request(ssml: str, params: Dict, audio_encoding: str,
+                        sample_rate_hertz: int = 0, row=None) -> bytes:
   """
+  Performs a single TTS request
+
+  Args:
+    ssml: the SSML to synthesize
+    params: Dict with the parameters of the TTS request
+    audio_encoding: name of the audio encoding to request
+    sample_rate_hertz: sample rate of the audio, 0 for the one of the voice
+    row: index of the row, when called out of the thread of the line
 
-  # Instantiates a client
-  client = texttospeech.TextToSpeechClient()
+  Returns:
+    The binary audio content
+  """
+  # Reuses the client of the instance
+  client = _tts_client()
   # Set the text input to be synthesized
-  synthesis_input = texttospeech.SynthesisInput(ssml=line['text'])
+  synthesis_input = texttospeech.SynthesisInput(ssml=ssml)
 
   # Build the voice request, select the language code ("en-US") and the ssml
   # voice gender ("neutral")
-  voice_id = line['voice_id'].split('##')[0]
-  language_code = line['voice_id'][:5]
-  voice = texttospeech.VoiceSelectionParams(language_code=language_code, name=voice_id)
+  voice = texttospeech.VoiceSelectionParams(
+      language_code=params['language_code'], name=params['voice_name'])
 
   # Select the type of audio file you want returned
   audio_config = texttospeech.AudioConfig(
-      audio_encoding=eval('texttospeech.AudioEncoding.' + line['audio_encoding'])
+      audio_encoding=getattr(texttospeech.AudioEncoding, audio_encoding),
+      sample_rate_hertz=sample_rate_hertz
   )
 
   # Perform the text-to-speech request on the text input with the selected
   # voice parameters and audio file type
-  response = client.synthesize_speech(
-      input=synthesis_input, voice=voice, audio_config=audio_config
-  )
+  _TTS_RATE_LIMITER.wait()
+  with _stage('tts', row=row, client='texttospeech') as stage:
+    response = client.synthesize_speech(
+        input=synthesis_input, voice=voice, audio_config=audio_config
+    )
+    stage['bytes'] = len(response.audio_content)
 
   # The response's audio_content is binary.
-  # _write_to_local_file(file_name, response)
+  return response.audio_content
+
+def _needs_chunking(params: Dict) -> bool:
+  return len(params['ssml'].encode('utf-8')) > TTS_CHUNK_MAX_BYTES
+
+def _synthesize_chunked(params: Dict) -> bytes:
+  """
+  Synthesizes a text longer than a TTS request in chunks. The chunks are
+  requested in parallel as LINEAR16, their samples are concatenated and then
+  encoded in the audio encoding of the line.
+
+  Args:
+    params: Dict with the parameters of the TTS request
+
+  Returns:
+    The binary audio content
+  """
+  chunks = _split_ssml(params['ssml'], TTS_CHUNK_MAX_BYTES)
+  row = _METRICS.get_row()
+  print(f'Row {row}: synthesizing {len(chunks)} chunks')
+  wavs = list(_CHUNK_EXECUTOR.map(
+      lambda chunk: _synthesize_request(chunk, params, 'LINEAR16',
+                                        TTS_CHUNK_SAMPLE_RATE, row),
+      chunks))
+  pcm = b''.join(_read_wav_samples(wav) for wav in wavs)
+  wav = _build_wav(pcm, TTS_CHUNK_SAMPLE_RATE)
+  if params['audio_encoding'] == 'LINEAR16':
+    return wav
+
+  with _stage('tts_encode', row=row) as stage:
+    try:
+      result = subprocess.run(
+          ['ffmpeg', '-v', 'error', '-f', 'wav', '-i', 'pipe:0',
+           *CHUNK_ENCODER_ARGS[params['audio_encoding']], 'pipe:1'],
+          input=wav, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+          timeout=TTS_ENCODE_TIMEOUT_SECONDS, check=True)
+    except subprocess.TimeoutExpired as e:
+      raise RuntimeError(f'ffmpeg did not encode the chunks in '
+                         f'{TTS_ENCODE_TIMEOUT_SECONDS:g} seconds') from e
+    except subprocess.CalledProcessError as e:
+      error = e.stderr.decode('utf-8', 'replace').strip()[-2000:]
+      raise RuntimeError(f'ffmpeg exited with code {e.returncode} encoding the '
+                         f'chunks: {error}') from e
+    stage['bytes'] = len(result.stdout)
+  return result.stdout
+
+_SSML_TAG = re.compile(r'(<[^>]+>)')
+_SSML_TAG_NAME = re.compile(r'</?\s*([\w:-]+)')
+_SSML_CLOSING_TAG = re.compile(r'</[^>]+>')
+_SENTENCE_END = re.compile(r'[.!?]+\s+')
+_SENTENCE_TAIL = re.compile(r'[.!?]\s*$')
+# Elements that end a chunk when they are closed
+_SSML_BOUNDARY_TAGS = ('p', 's', 'break')
+# Elements whose content cannot be split
+_SSML_UNSPLITTABLE_TAGS = ('say-as', 'sub', 'phoneme', 'audio')
+
+def _split_ssml(ssml: str, max_bytes: int) -> List[str]:
+  """
+  Splits a SSML document in chunks of up to max_bytes at paragraph, sentence
+  or <break> boundaries. The elements open at a boundary are closed at the end
+  of its chunk and opened again at the start of the next one, so that every
+  chunk is a valid SSML document.
+
+  Args:
+    ssml: the SSML to split
+    max_bytes: maximum size of a chunk in bytes
+
+  Returns:
+    A list with the SSML of each chunk
+  """
+  # Split the document in segments ending at a boundary, together with the
+  # elements open after them
+  segments = []
+  stack = []
+  segment = ''
+  for token in _SSML_TAG.split(ssml):
+    if not token:
+      continue
+    if token.startswith('<'):
+      segment += token
+      match = _SSML_TAG_NAME.match(token)
+      name = match.group(1) if match else ''
+      closed = token.startswith('</') or token.endswith('/>')
+      if token.startswith('</'):
+        if stack and stack[-1][0] == name:
+          stack.pop()
+      elif not closed and not token.startswith(('<?', '<!')):
+        stack.append((name, token))
+      pieces, tail = ([''] if closed and name in _SSML_BOUNDARY_TAGS else []), ''
+    else:
+      pieces = _split_text(token, max_bytes // 2)
+      # The text after the last sentence continues in the following tokens
+      tail = '' if _SENTENCE_TAIL.search(pieces[-1]) else pieces.pop()
+    if any(name in _SSML_UNSPLITTABLE_TAGS for name, unused_tag in stack):
+      segment += ''.join(pieces) + tail
+      continue
+    for piece in pieces:
+      segment += piece
+      segments.append((segment, list(stack)))
+      segment = ''
+    segment += tail
+  if segment:
+    segments.append((segment, list(stack)))
+
+  # Pack the segments in chunks
+  chunks = []
+  body = ''
+  open_stack = []
+  stack_before = []
+  for segment, stack_after in segments:
+    candidate = body + segment
+    if body and len(_wrap_ssml(open_stack, candidate, stack_after).encode('utf-8')) > max_bytes:
+      # A body only closing the open elements would be a chunk without speech
+      if _SSML_CLOSING_TAG.sub('', body).strip():
+        chunks.append(_wrap_ssml(open_stack, body, stack_before))
+      open_stack = stack_before
+      candidate = segment
+    body = candidate
+    stack_before = stack_after
+  if _SSML_CLOSING_TAG.sub('', body).strip():
+    chunks.append(_wrap_ssml(open_stack, body, stack_before))
+  return chunks
+
+def _split_text(text: str, max_bytes: int) -> List[str]:
+  """
+  Splits a text at the end of its sentences, and the sentences longer than
+  max_bytes between words.
+  """
+  sentences = []
+  start = 0
+  for match in _SENTENCE_END.finditer(text):
+    sentences.append(text[start:match.end()])
+    start = match.end()
+  sentences.append(text[start:])
+
+  pieces = []
+  for sentence in sentences:
+    piece = ''
+    for word in re.findall(r'\S*\s*', sentence):
+      if piece and len((piece + word).encode('utf-8')) > max_bytes:
+        pieces.append(piece)
+        piece = ''
+      piece += word
+    pieces.append(piece)
+  return [piece for piece in pieces if piece] or ['']
 
-  _write_to_gcs(line['gcs_bucket'], file_name, response)
-   
-def _write_to_gcs(gcs_bucket: str, file_name: str, response):
+def _wrap_ssml(open_stack: List[Tuple[str, str]], body: str,
+               close_stack: List[Tuple[str, str]]) -> str:
+  return (''.join(tag for unused_name, tag in open_stack) + body +
+          ''.join(f'</{name}>' for name, unused_tag in reversed(close_stack)))
+
+def _read_wav_samples(wav: bytes) -> bytes:
+  """
+  Returns the samples of the data chunk of a RIFF/WAVE file
   """
-  Writes the contents of response into file_name as binary in the gcs_bucket
+  position = 12
+  while position + 8 <= len(wav):
+    chunk_id, size = struct.unpack('<4sI', wav[position:position + 8])
+    if chunk_id == b'data':
+      return wav[position + 8:position + 8 + size]
+    position += 8 + size + (size & 1)
+  raise ValueError('The LINEAR16 audio has no data chunk')
+
+def _build_wav(pcm: bytes, sample_rate: int) -> bytes:
+  """
+  Builds a mono 16 bits RIFF/WAVE file with the samples in pcm
+  """
+  fmt = struct.pack('<HHIIHH', 1, 1, sample_rate, sample_rate * 2, 2, 16)
+  return (b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(pcm)) + b'WAVE' +
+          b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+          b'data' + struct.pack('<I', len(pcm)) + pcm)
+
+PROBE_HEAD_BYTES = 65536
+_MP3_BITRATES = {
+  # (MPEG-1, layer): kbps by bitrate index
+  (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+  (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+  (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+  (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+  (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+  (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by MPEG version bits and sample rate index
+_MP3_SAMPLE_RATES = {
+  0: (11025, 12000, 8000),
+  2: (22050, 24000, 16000),
+  3: (44100, 48000, 32000),
+}
+
+def _probe_audio_duration(read, size: int) -> Optional[float]:
+  """
+  Computes the duration of an audio file from its headers, without decoding
+  it. It supports every encoding of the TTS API: MP3, OGG_OPUS and the
+  LINEAR16, MULAW and ALAW encodings, which come in a RIFF/WAVE file.
+
+  Args:
+    read: function that returns the given number of bytes of the file from
+      the given offset
+    size: size of the file in bytes
+
+  Returns:
+    The duration in seconds, or None if the format is not recognized or the
+    file is truncated
+  """
+  head = read(0, min(size, PROBE_HEAD_BYTES))
+  try:
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+      return _probe_wav_duration(read, size)
+    if head[:4] == b'OggS':
+      return _probe_ogg_opus_duration(read, size, head)
+    return _probe_mp3_duration(read, size, head)
+  except struct.error:
+    # The headers are cut short
+    return None
+
+def _probe_wav_duration(read, size: int) -> Optional[float]:
+  position = 12
+  byte_rate = None
+  while position + 8 <= size:
+    chunk_id, chunk_size = struct.unpack('<4sI', read(position, 8))
+    if chunk_id == b'fmt ':
+      byte_rate = struct.unpack('<I', read(position + 16, 4))[0]
+    elif chunk_id == b'data':
+      # Streamed files may have a placeholder size
+      data_size = min(chunk_size, size - position - 8)
+      return data_size / byte_rate if byte_rate else None
+    position += 8 + chunk_size + (chunk_size & 1)
+  return None
+
+def _probe_ogg_opus_duration(read, size: int, head: bytes) -> Optional[float]:
+  opus_head = head.find(b'OpusHead')
+  if opus_head < 0:
+    return None
+  pre_skip = struct.unpack('<H', head[opus_head + 10:opus_head + 12])[0]
+  # The granule position of the last page is the number of 48 kHz samples
+  tail_start = max(0, size - PROBE_HEAD_BYTES)
+  tail = read(tail_start, size - tail_start)
+  last_page = tail.rfind(b'OggS')
+  if last_page < 0 or last_page + 27 > len(tail):
+    return None
+  # The granule position of a truncated page is past the end of the file
+  segments = tail[last_page + 27:last_page + 27 + tail[last_page + 26]]
+  if last_page + 27 + tail[last_page + 26] + sum(segments) > len(tail):
+    return None
+  granule = struct.unpack('<q', tail[last_page + 6:last_page + 14])[0]
+  return max(granule - pre_skip, 0) / 48000
+
+def _probe_mp3_duration(read, size: int, head: bytes) -> Optional[float]:
+  start = 0
+  if head[:3] == b'ID3':
+    # The size of the ID3v2 tag is a 28 bits syncsafe integer
+    tag_size = 0
+    for byte in head[6:10]:
+      tag_size = (tag_size << 7) | (byte & 0x7F)
+    start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+    head = read(start, min(size - start, PROBE_HEAD_BYTES))
+
+  for offset in range(len(head) - 4):
+    frame = _parse_mp3_header(head[offset:offset + 4])
+    if frame:
+      break
+  else:
+    return None
+  mpeg1, mono, bitrate, sample_rate, samples_per_frame = frame
+
+  # VBR files have a Xing/Info or VBRI header with the number of frames
+  xing = offset + 4 + (17 if mono else 32) if mpeg1 else offset + 4 + (9 if mono else 17)
+  if head[xing:xing + 4] in (b'Xing', b'Info'):
+    flags = struct.unpack('>I', head[xing + 4:xing + 8])[0]
+    if flags & 1:
+      frames = struct.unpack('>I', head[xing + 8:xing + 12])[0]
+      # The size of the stream, when present, tells if the file is truncated
+      stream_bytes = struct.unpack('>I', head[xing + 12:xing + 16])[0] if flags & 2 else 0
+      if stream_bytes > size - start - offset:
+        return None
+      return frames * samples_per_frame / sample_rate
+  vbri = offset + 4 + 32
+  if head[vbri:vbri + 4] == b'VBRI':
+    stream_bytes, frames = struct.unpack('>II', head[vbri + 10:vbri + 18])
+    if stream_bytes > size - start - offset:
+      return None
+    return frames * samples_per_frame / sample_rate
+
+  # Otherwise the bitrate is constant
+  audio_bytes = size - start - offset
+  if size >= 128 and read(size - 128, 3) == b'TAG':
+    audio_bytes -= 128
+  return audio_bytes * 8 / (bitrate * 1000)
+
+def _parse_mp3_header(header: bytes) -> Optional[Tuple[bool, bool, int, int, int]]:
+  """
+  Parses the header of a MPEG audio frame
+
+  Returns:
+    A tuple with whether it is MPEG-1, whether it is mono, the bitrate in kbps,
+    the sample rate and the samples per frame, or None if it is not a header
+  """
+  if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+    return None
+  version = (header[1] >> 3) & 3
+  layer = 4 - ((header[1] >> 1) & 3)
+  bitrate_index = header[2] >> 4
+  sample_rate_index = (header[2] >> 2) & 3
+  if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+    return None
+  mpeg1 = version == 3
+  mono = header[3] >> 6 == 3
+  if layer == 1:
+    samples_per_frame = 384
+  elif layer == 2 or mpeg1:
+    samples_per_frame = 1152
+  else:
+    samples_per_frame = 576
+  return (mpeg1, mono, _MP3_BITRATES[(mpeg1, layer)][bitrate_index],
+          _MP3_SAMPLE_RATES[version][sample_rate_index], samples_per_frame)
+
+def _write_to_gcs(gcs_bucket: str, file_name: str, audio_content: bytes,
+                  duration: Optional[float] = None):
+  """
+  Writes audio_content into file_name as binary in the gcs_bucket
 
   Args:
     gcs_bucket: name of the gcs bucket
     file_name: the name of the file to write
-    response: the object containing the binary data to write
+    audio_content: the binary data to write
+    duration: duration of the audio in seconds, stored in the file metadata
   """
 
-  storage_client = storage.Client()
+  storage_client = _storage_client()
   bucket = storage_client.bucket(gcs_bucket)
   blob = bucket.blob(file_name)
+  if duration is not None:
+    blob.metadata = {'speech_duration_seconds': str(duration)}
 
   # Mode can be specified as wb/rb for bytes mode.
   # See: https://docs.python.org/3/library/io.html
-  with blob.open("wb") as f:
-      f.write(response.audio_content)
+  with _stage('gcs_write', client='storage') as stage, blob.open("wb") as f:
+      f.write(audio_content)
+      stage['bytes'] = len(audio_content)
 
 def _build_file_name(line: Dict) -> str:
   """
@@ -219,82 +1942,159 @@ def _build_file_name(line: Dict) -> str:
 
   return name.lower()
 
-def _call_video_generation(line: Dict):
+def _call_video_generation(line: Dict,
+                           fingerprints: Optional[Dict[int, str]] = None):
   """
   It triggers the video generation call function passing all the info required
 
   Args:
     line: Dict object containing the fields to generate the video file
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+
+  Returns:
+    The future of the published message
   """
-  _send_pub_sub(line, GENERATE_VIDEO_TOPIC)
+  return _publish_after_write([line], line, fingerprints)
 
-def _update_sheet_line(line: Dict):
+def _publish_after_write(lines: List[Dict], message: Dict,
+                         fingerprints: Optional[Dict[int, str]]):
   """
-  Updates the line in the Google Spreadsheet defined in the global variabl.
+  Queues the status of the lines and publishes the video generation message
+  once the batch with their status is written, so that it never overwrites the
+  status written by the video generation. In incremental mode the state of the
+  lines is saved right before the message is published. The lines are marked
+  as failed if the message could not be published.
 
   Args:
-    line: Dict containing all the relevant info.
+    lines: List of dicts with the lines sent in the message
+    message: Dict with the message to publish to GENERATE_VIDEO_TOPIC
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+
+  Returns:
+    A future that resolves to the message id once it is published
   """
+  future = concurrent.futures.Future()
 
-  try:
-      service = build('sheets', 'v4', credentials=None)
-      index = line['index']
-      status_range = f"{CONFIG_SHEET_NAME}!{STATUS_COLUMN}{index}:{STATUS_COLUMN}{index}"
-      tts_file_range = f"{CONFIG_SHEET_NAME}!{TTS_FILE_COLUMN}{index}:{TTS_FILE_COLUMN}{index}"
-      last_update_range = f"{CONFIG_SHEET_NAME}!{LAST_UPDATE_COLUMN}{index}:{LAST_UPDATE_COLUMN}{index}"
-
-      body1 = {
-        'values' : [[str(line['status'])],],
-        'majorDimension' : 'COLUMNS'
-        }
+  def forward(sent):
+    try:
+      future.set_result(sent.result())
+    except Exception as e:
+      future.set_exception(e)
 
-      body2 = {
-        'values' : [[str(line['tts_file_url'])],],
-        'majorDimension' : 'COLUMNS'
-        }
+  def publish():
+    for line in lines:
+      _save_state(line, fingerprints)
+    try:
+      sent = _send_pub_sub(message, GENERATE_VIDEO_TOPIC)
+    except Exception as e:
+      future.set_exception(e)
+      return
+    sent.add_done_callback(forward)
 
-      now = datetime.now()
-      body3 = {
-        'values' : [[str(now.strftime("%Y/%m/%d, %H:%M:%S"))],],
-        'majorDimension' : 'COLUMNS'
-        }
-      # Call the Sheets API
-
-      sheet = service.spreadsheets()
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=status_range,
-                                    valueInputOption='RAW',
-                                    body=body1).execute()
-
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=tts_file_range,
-                                    valueInputOption='RAW',
-                                    body=body2).execute()
-
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=last_update_range,
-                                    valueInputOption='RAW',
-                                    body=body3).execute()
-  except HttpError as err:
-      print(err)
+  future.add_done_callback(
+      functools.partial(_check_publication, lines, fingerprints))
+  for line in lines[:-1]:
+    _update_config_line(line)
+  _update_config_line(lines[-1], on_written=publish)
+  return future
+
+def _call_grouped_video_generation(
+    lines: List[Dict],
+    fingerprints: Optional[Dict[int, str]] = None) -> List[Tuple[Dict, Any]]:
+  """
+  It triggers the video generation of up to VIDEO_GROUP_MAX_SIZE lines sharing
+  the same video and base audio with a single message, whose `rows` field
+  contains the lines.
+
+  Args:
+    lines: List of dicts with the lines of the group whose audio file was
+      generated
+    fingerprints: Dict with the fingerprint of each line, by line index, or
+      None when not in incremental mode
+
+  Returns:
+    A list of tuples with each line and the future of the message of its group
+  """
+  future = _publish_after_write(lines, {'rows': lines}, fingerprints)
+  return [(line, future) for line in lines]
+
+def _video_group_key(line: Dict) -> Tuple[str, str, str]:
+  return (line['gcs_bucket'], line['video_file'], line.get('base_audio_file', ''))
+
+def _update_config_line(line: Dict,
+                        on_written: Optional[Callable[[], None]] = None):
+  """
+  Queues the update of the status of the line in the config source. The update
+  is written with the next batch.
+
+  Args:
+    line: Dict containing all the relevant info.
+    on_written: Function called once the update is written.
+  """
+  _STATUS_WRITER.add({
+    'index': line['index'],
+    'status': str(line['status']),
+    'tts_file_url': str(line['tts_file_url']),
+    'last_update': datetime.now().strftime("%Y/%m/%d, %H:%M:%S"),
+  }, on_written)
+
+def _batch_update_sheet(data: List[Dict]):
+  """
+  Writes several ranges to the Google Spreadsheet with one request, retrying
+  with exponential backoff when the quota is exceeded.
+
+  Args:
+    data: List of value ranges to write.
+  """
+  body = {
+    'valueInputOption' : 'RAW',
+    'data' : data
+  }
+  for attempt in range(SHEETS_MAX_RETRIES + 1):
+    try:
+      sheet = _sheets_service().spreadsheets()
+      _SHEETS_RATE_LIMITER.wait()
+      with _SHEETS_LOCK, _stage('sheet_update', client='sheets') as stage:
+        # The batch contains the updates of several rows
+        stage['row'] = None
+        stage['ranges'] = len(data)
+        sheet.values().batchUpdate(spreadsheetId=CONFIG_SPREADSHEET_ID,
+                                   body=body).execute()
+      return
+    except HttpError as err:
+      if err.resp.status not in (429, 500, 503) or attempt == SHEETS_MAX_RETRIES:
+        print(err)
+        return
+      delay = 2 ** attempt + random.random()
+      print(f'Sheets API error {err.resp.status}, retrying in {delay:.1f}s')
+      time.sleep(delay)
 
 
 def _send_pub_sub(message: Dict, topic: str):
   """
-  It sends a message to the pubsub topic
+  It sends a message to the pubsub topic without waiting for the publication,
+  so that the message can be batched with others.
 
   Args:
     message: Dict object containing the info to send to the topic
     topic: string containing the name of the topic
+
+  Returns:
+    The future that resolves to the message id once it is published
   """
-  publisher = pubsub_v1.PublisherClient()
+  publisher = _publisher_client()
   topic_path = publisher.topic_path(GCP_PROJECT, topic)
   msg_json = json.dumps(message)
 
-  unused_msg_id = publisher.publish(
-      topic_path,
-      data=bytes(msg_json, 'utf-8'),
-    ).result()
+  with _stage('publish', row=message.get('index'), client='pubsub') as stage:
+    data = bytes(msg_json, 'utf-8')
+    stage['bytes'] = len(data)
+    return publisher.publish(
+        topic_path,
+        data=data,
+      )
 
 if __name__ == '__main__':
 
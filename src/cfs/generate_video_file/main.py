@@ -15,40 +15,991 @@
 # [START main]
 
 from google.cloud import storage
-from mutagen.mp3 import MP3
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from google.cloud.functions_v1.context import Context
 from google.cloud import pubsub_v1
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from datetime import datetime
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from datetime import datetime, timedelta
+import google.auth
+import google.auth.transport.requests
+import numpy as np
+import soundfile
 
+try:
+    import psycopg2
+except ImportError:  # Only needed to use a PostgreSQL config source
+    psycopg2 = None
+
+import abc
+import atexit
+import contextlib
+import csv
+import io
+import mimetypes
 import os
+import shutil
+import sqlite3
 import string
+import struct
+import subprocess
 import random
+import re
 import json
 import base64
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import threading
+import time
+import uuid
 
 GCP_PROJECT = os.getenv('GCP_PROJECT', '')
 CONFIG_SPREADSHEET_ID = os.getenv('CONFIG_SPREADSHEET_ID', '')
 CONFIG_SHEET_NAME = os.getenv('CONFIG_SHEET_NAME', 'config')
-CONFIG_RANGE_NAME = os.getenv('CONFIG_RANGE_NAME', 'config!A1:N')
-FINAL_VIDEO_FILE_COLUMN = os.getenv('FINAL_VIDEO_FILE_COLUMN', 'L')
-STATUS_COLUMN = os.getenv('STATUS_COLUMN', 'M')
-LAST_UPDATE_COLUMN = os.getenv('LAST_UPDATE_COLUMN', 'N')
+CONFIG_RANGE_NAME = os.getenv('CONFIG_RANGE_NAME', 'config!A1:Z')
+# The columns written are found by the name of their field in the header row
+# of CONFIG_RANGE_NAME, unless their letter is set.
+FINAL_VIDEO_FILE_COLUMN = os.getenv('FINAL_VIDEO_FILE_COLUMN', '')
+STATUS_COLUMN = os.getenv('STATUS_COLUMN', '')
+LAST_UPDATE_COLUMN = os.getenv('LAST_UPDATE_COLUMN', '')
+PREVIEW_FILE_COLUMN = os.getenv('PREVIEW_FILE_COLUMN', '')
+# Where the status of the lines is written to, as read by generate_tts_files:
+# empty for the Google Sheet, a CSV or Parquet manifest (local path or
+# gs://bucket/path) or a sqlite:///path or postgresql:// database URL.
+CONFIG_SOURCE = os.getenv('CONFIG_SOURCE', '')
+CONFIG_TABLE = os.getenv('CONFIG_TABLE', 'config')
+# Columns of the fields written to the Google Sheet, empty to find them in the
+# header row
+SHEET_COLUMNS = {
+    'status': STATUS_COLUMN,
+    'final_video_file_url': FINAL_VIDEO_FILE_COLUMN,
+    'preview_file_url': PREVIEW_FILE_COLUMN,
+    'last_update': LAST_UPDATE_COLUMN,
+}
+# The status updates are sent in batches of SHEETS_BATCH_SIZE lines, or every
+# SHEETS_FLUSH_SECONDS, whatever happens first.
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', '50'))
+SHEETS_FLUSH_SECONDS = float(os.getenv('SHEETS_FLUSH_SECONDS', '10'))
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+# In streaming mode ffmpeg reads the inputs from signed URLs and its output is
+# uploaded to GCS while it is generated, so nothing is written to /tmp.
+STREAMING_MODE = os.getenv('STREAMING_MODE', 'false').lower() == 'true'
+SIGNED_URL_EXPIRATION_MINUTES = int(os.getenv('SIGNED_URL_EXPIRATION_MINUTES', '60'))
+# Must be a multiple of 256 KB.
+GCS_STREAM_CHUNK_MB = int(os.getenv('GCS_STREAM_CHUNK_MB', '8'))
+# Files larger than GCS_TRANSFER_CHUNK_MB are downloaded with parallel ranged
+# reads, and uploaded in parallel parts that are composed into the final file.
+GCS_TRANSFER_CHUNK_MB = int(os.getenv('GCS_TRANSFER_CHUNK_MB', '32'))
+GCS_TRANSFER_MAX_WORKERS = int(os.getenv('GCS_TRANSFER_MAX_WORKERS', '8'))
+# Maximum number of files composed in a single request
+GCS_MAX_COMPOSE_PARTS = 32
+# The videos and base audio files are kept in /tmp, which uses the memory of
+# the instance, so that warm instances can reuse them. 0 disables the cache.
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', '/tmp/media_cache')
+MEDIA_CACHE_MAX_MB = int(os.getenv('MEDIA_CACHE_MAX_MB', '2048'))
+# The video stream is copied to the output as it is and only the mixed audio is
+# encoded, unless the codec of the video cannot be stored in a MP4 file.
+VIDEO_STREAM_COPY = os.getenv('VIDEO_STREAM_COPY', 'true').lower() == 'true'
+MP4_VIDEO_CODECS = ('h264', 'hevc', 'mpeg4', 'av1', 'vp9')
+FALLBACK_VIDEO_CODEC = os.getenv('FALLBACK_VIDEO_CODEC', 'libx264')
+AUDIO_CODEC = os.getenv('AUDIO_CODEC', 'aac')
+AUDIO_BITRATE = os.getenv('AUDIO_BITRATE', '192k')
+# At most FFMPEG_MAX_JOBS ffmpeg processes run at the same time, sharing the
+# CPUs of the instance. 0 runs one process per FFMPEG_THREADS_PER_JOB CPUs.
+FFMPEG_MAX_JOBS = int(os.getenv('FFMPEG_MAX_JOBS', '0'))
+FFMPEG_THREADS_PER_JOB = int(os.getenv('FFMPEG_THREADS_PER_JOB', '4'))
+FFMPEG_TIMEOUT_SECONDS = float(os.getenv('FFMPEG_TIMEOUT_SECONDS', '480'))
+FFPROBE_TIMEOUT_SECONDS = 60
+# The outputs store the fingerprint of the job that rendered them, so the jobs
+# whose inputs and parameters did not change are not rendered again. A pointer
+# object named after the fingerprint under JOB_POINTER_PREFIX records the last
+# output of every job, which is copied when the job runs again on another day.
+JOB_FINGERPRINT_KEY = 'job_fingerprint'
+JOB_POINTER_PREFIX = os.getenv('JOB_POINTER_PREFIX', 'cache/jobs')
+# The lines without video_file generate only the mixed audio, which is decoded,
+# mixed and encoded in memory instead of running ffmpeg.
+AUDIO_OUTPUT_FORMAT = os.getenv('AUDIO_OUTPUT_FORMAT', 'wav').lower()
+# soundfile format, subtype and content type of each output format
+AUDIO_OUTPUT_FORMATS = {
+    'wav': ('WAV', 'PCM_16', 'audio/wav'),
+    'flac': ('FLAC', 'PCM_16', 'audio/flac'),
+    'ogg': ('OGG', 'VORBIS', 'audio/ogg'),
+    'mp3': ('MP3', 'MPEG_LAYER_III', 'audio/mpeg'),
+}
+# Sample rate of the audio outputs without base audio file
+AUDIO_OUTPUT_SAMPLE_RATE = 48000
+# Seconds taken by the amix filter of ffmpeg to raise the volume of the
+# remaining inputs when one of them ends (its dropout_transition)
+AMIX_DROPOUT_SECONDS = 2.0
+# With AUTO_LOUDNESS, the lines whose base_audio_vol_percent is empty get their
+# gains from the loudness of their speech and base audio: each speech segment
+# is normalized to SPEECH_TARGET_LUFS, and the base audio is lowered to
+# DUCKING_OFFSET_LU below it while the speech is played. The loudness of each
+# file is measured once and cached under LOUDNESS_CACHE_PREFIX.
+AUTO_LOUDNESS = os.getenv('AUTO_LOUDNESS', 'false').lower() == 'true'
+SPEECH_TARGET_LUFS = float(os.getenv('SPEECH_TARGET_LUFS', '-16'))
+DUCKING_OFFSET_LU = float(os.getenv('DUCKING_OFFSET_LU', '12'))
+LOUDNESS_CACHE_PREFIX = os.getenv('LOUDNESS_CACHE_PREFIX', 'cache/loudness')
+# Increase when the analysis changes, to ignore the previous results
+LOUDNESS_CACHE_VERSION = 1
+# The speech gain never raises its true peak above SPEECH_MAX_PEAK_DBTP, nor
+# amplifies it more than LOUDNESS_MAX_GAIN_DB
+SPEECH_MAX_PEAK_DBTP = -1.0
+LOUDNESS_MAX_GAIN_DB = 20.0
+# Integrated loudness reported by ebur128 for silence
+SILENCE_LUFS = -70.0
+# The lines whose render_mode is preview only render the speech and a margin
+# around it, at a lower resolution and bitrate, under preview/ instead of
+# output/. They are rendered in full once their render_mode is approved, or
+# full. The lines of sheets without render_mode are always rendered in full,
+# and any other value is rejected.
+RENDER_MODES = {'preview': 'preview', 'approved': 'full', 'full': 'full'}
+PREVIEW_MARGIN_SECONDS = float(os.getenv('PREVIEW_MARGIN_SECONDS', '2'))
+PREVIEW_HEIGHT = int(os.getenv('PREVIEW_HEIGHT', '360'))
+PREVIEW_VIDEO_BITRATE = os.getenv('PREVIEW_VIDEO_BITRATE', '600k')
+PREVIEW_AUDIO_BITRATE = os.getenv('PREVIEW_AUDIO_BITRATE', '96k')
+
+
+class _StatusWriteBuffer:
+    """Gathers the status updates of several lines and writes them to the
+    config source at once.
+    """
+
+    def __init__(self, batch_size: int, flush_seconds: float):
+        self._batch_size = batch_size
+        self._flush_seconds = flush_seconds
+        self._updates = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, update: Dict):
+        """Adds the update of a line, flushing the buffer when it is full or
+        when it has not been flushed for too long. A timer flushes the buffer
+        `flush_seconds` after the first pending update, even if no other
+        update is added in the meantime.
+
+        Args:
+          update: Dict with the `index` of the line and the fields to write.
+        """
+        with self._lock:
+            self._updates.append(update)
+            if (len(self._updates) >= self._batch_size or
+                    time.monotonic() - self._last_flush >= self._flush_seconds):
+                self._flush()
+            elif not self._timer:
+                self._timer = threading.Timer(self._flush_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Writes all the pending updates to the config source."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        updates, self._updates = self._updates, []
+        self._last_flush = time.monotonic()
+        if updates:
+            try:
+                _CONFIG_SOURCE.write(updates)
+            except Exception as e:
+                print(f'Could not write the status of {len(updates)} lines: {e}')
+
+
+class _ConfigSource(abc.ABC):
+    """Where the status of the lines is written to. The lines are read by
+    generate_tts_files.
+    """
+
+    @abc.abstractmethod
+    def write(self, updates: List[Dict]):
+        """Writes the fields of several lines at once.
+
+        Args:
+          updates: List of dicts with the `index` of a line and the values of
+            the fields to write.
+        """
+
+
+class _SheetsConfigSource(_ConfigSource):
+    """The config sheet of CONFIG_SPREADSHEET_ID. The column of each field
+    written is found by its name in the header row, unless it is set in
+    SHEET_COLUMNS.
+    """
+
+    def __init__(self):
+        self._columns = None
+        self._lock = threading.Lock()
+
+    def write(self, updates: List[Dict]):
+        columns = self._get_columns()
+        data = []
+        for update in updates:
+            index = update['index']
+            for field, value in update.items():
+                if field not in columns:
+                    continue
+                column = columns[field]
+                data.append({
+                    'range': f'{CONFIG_SHEET_NAME}!{column}{index}:{column}{index}',
+                    'values': [[value]],
+                    'majorDimension': 'COLUMNS'
+                })
+        if data:
+            _batch_update_sheet(data)
+
+    def _get_columns(self) -> Dict[str, str]:
+        with self._lock:
+            if self._columns is None:
+                self._columns = self._read_columns()
+            return self._columns
+
+    def _read_columns(self) -> Dict[str, str]:
+        """Reads the header row to find the column of each field written. The
+        fields without a column, like preview_file_url in a sheet without
+        previews, are not written.
+        """
+        prefix, first_column, header_row, last_column = _parse_config_range(CONFIG_RANGE_NAME)
+        header_range = (f'{prefix}{_column_letter(first_column)}{header_row}:'
+                        f'{_column_letter(last_column)}{header_row}')
+        sheet = _sheets_service().spreadsheets()
+        with _SHEETS_LOCK, _stage('sheet_read', client='sheets'):
+            result = sheet.values().get(spreadsheetId=CONFIG_SPREADSHEET_ID,
+                                        range=header_range).execute()
+        headers = (result.get('values') or [[]])[0]
+        positions = {field: first_column + i for i, field in enumerate(headers) if field}
+        columns = {}
+        for field, column in SHEET_COLUMNS.items():
+            if column:
+                columns[field] = column
+            elif field in positions:
+                columns[field] = _column_letter(positions[field])
+            else:
+                print(f'The config sheet has no {field} column, the field is not written')
+        return columns
+
+
+def _parse_config_range(a1_range: str) -> Tuple[str, int, int, int]:
+    """Parses a range like config!A1:Z into its sheet prefix, the zero based
+    positions of its first and last columns and the number of its first row.
+    """
+    match = re.fullmatch(r'(.*!)?([A-Z]+)(\d*):([A-Z]+)\d*', a1_range)
+    if not match:
+        raise ValueError(f'Invalid config range {a1_range}, it must be like config!A1:Z')
+    prefix, first_column, first_row, last_column = match.groups()
+    return (prefix or '', _column_index(first_column), int(first_row or 1),
+            _column_index(last_column))
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _column_letter(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+class _ManifestConfigSource(_ConfigSource):
+    """A CSV or Parquet manifest in a local file or in GCS. Every batch of
+    status updates is written to a new CSV file under `<manifest>.status/`,
+    which generate_tts_files merges into the manifest when it reads it.
+    """
+
+    def __init__(self, uri: str):
+        self._status_prefix = f'{uri}.status/'
+
+    def write(self, updates: List[Dict]):
+        fields = ['index'] + sorted({field for update in updates for field in update} - {'index'})
+        data = io.StringIO()
+        writer = csv.DictWriter(data, fields)
+        writer.writeheader()
+        writer.writerows(updates)
+        # Named after the time, so that the latest updates are applied last
+        name = (f"{self._status_prefix}{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+                f"-{uuid.uuid4().hex[:8]}.csv")
+        with _stage('status_write', client='storage' if name.startswith('gs://') else None) as stage:
+            stage['bytes'] = len(data.getvalue())
+            if name.startswith('gs://'):
+                bucket_name, unused_separator, blob_name = name[len('gs://'):].partition('/')
+                blob = _storage_client().bucket(bucket_name).blob(blob_name)
+                blob.upload_from_string(data.getvalue(), content_type='text/csv')
+            else:
+                os.makedirs(self._status_prefix, exist_ok=True)
+                with open(name, 'w', newline='', encoding='utf-8') as f:
+                    f.write(data.getvalue())
+
+
+class _DatabaseConfigSource(_ConfigSource):
+    """A table in a SQLite (sqlite:///path) or a PostgreSQL
+    (postgresql://...) database, whose `id` column is the index of the lines.
+    The columns named after the fields written by the process receive their
+    values, with a statement per batch of updates.
+    """
+
+    def __init__(self, uri: str, table: str):
+        self._uri = uri
+        self._table = _quote_identifier(table)
+        self._sqlite = uri.startswith('sqlite:')
+        self._placeholder = '?' if self._sqlite else '%s'
+
+    def _connect(self):
+        if self._sqlite:
+            return sqlite3.connect(self._uri[len('sqlite:///'):], timeout=30)
+        if not psycopg2:
+            raise ImportError('Add psycopg2-binary to requirements.txt to use a PostgreSQL config source')
+        return psycopg2.connect(self._uri)
+
+    def write(self, updates: List[Dict]):
+        # The lines updating the same fields share the same statement
+        statements = collections.defaultdict(list)
+        for update in updates:
+            fields = tuple(sorted(field for field in update if field != 'index'))
+            statements[fields].append([update[field] for field in fields] + [update['index']])
+
+        connection = self._connect()
+        try:
+            with _stage('status_write') as stage:
+                stage['rows'] = len(updates)
+                cursor = connection.cursor()
+                for fields, rows in statements.items():
+                    assignments = ', '.join(
+                        f'{_quote_identifier(field)} = {self._placeholder}' for field in fields)
+                    cursor.executemany(
+                        f'UPDATE {self._table} SET {assignments} WHERE "id" = {self._placeholder}',
+                        rows)
+                connection.commit()
+        finally:
+            connection.close()
+
+
+def _build_config_source(uri: str) -> _ConfigSource:
+    """Builds the config source of a CONFIG_SOURCE value."""
+    if not uri:
+        return _SheetsConfigSource()
+    if uri.startswith(('sqlite:', 'postgres:', 'postgresql:')):
+        return _DatabaseConfigSource(uri, CONFIG_TABLE)
+    if uri.endswith(('.csv', '.parquet')):
+        return _ManifestConfigSource(uri)
+    raise ValueError(f'Unsupported config source {uri}')
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class _MediaCache:
+    """Least recently used cache of source media files in the local disk.
+
+    Files are identified by bucket, name and generation, so a file that has
+    been replaced in GCS is downloaded again. Files in use are never evicted,
+    and files that do not fit in the cache are deleted once released.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._in_use = collections.Counter()
+        self._lock = threading.Lock()
+        # Files left by a previous instance are unknown to the cache
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self, gcs_bucket: str, blob_name: str) -> str:
+        """Returns the path of a local copy of the current generation of a
+        file in GCS, downloading it if it is not in the cache. The file must
+        be released once it is no longer needed.
+
+        Args:
+          gcs_bucket: string containing the bucket name.
+          blob_name: Name of the blob containing the file.
+        """
+        with _stage('media_cache_lookup', client='storage') as stage:
+            blob = _storage_client().bucket(gcs_bucket).get_blob(blob_name)
+            if blob is None:
+                raise FileNotFoundError(f'gs://{gcs_bucket}/{blob_name}')
+            key = (gcs_bucket, blob_name, blob.generation)
+            with self._lock:
+                stage['hit'] = key in self._entries
+                if stage['hit']:
+                    self._entries.move_to_end(key)
+                    path = self._entries[key][0]
+                    self._in_use[path] += 1
+                    return path
+
+        name_hash = hashlib.sha256(f'{gcs_bucket}/{blob_name}'.encode('utf-8')).hexdigest()
+        extension = os.path.splitext(blob_name)[1]
+        path = os.path.join(self._directory, f'{name_hash}-{blob.generation}{extension}')
+        partial_path = f'{path}.{random.getrandbits(32)}'
+        # The blob has its generation set, so this exact generation is downloaded
+        with _stage('gcs_download', client='storage') as stage:
+            _download_blob_to_file(blob, partial_path)
+            stage['bytes'] = blob.size
+        os.replace(partial_path, path)
 
-def _get_mp3_length(path: str):
-    """Returns the length of a MP3 file in seconds.
+        with self._lock:
+            self._in_use[path] += 1
+            if blob.size <= self._max_bytes and key not in self._entries:
+                # Older generations of the same file are stale
+                for stale_key in [k for k in self._entries if k[:2] == key[:2]]:
+                    self._remove(stale_key)
+                self._entries[key] = (path, blob.size)
+                self._size += blob.size
+                self._evict()
+        return path
+
+    def release(self, path: str):
+        """Releases a file returned by acquire, deleting it if it is not in
+        the cache.
+
+        Args:
+          path: path returned by acquire.
+        """
+        with self._lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+                if not any(path == entry[0] for entry in self._entries.values()):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._size <= self._max_bytes:
+                return
+            if self._entries[key][0] not in self._in_use:
+                self._remove(key)
+
+    def _remove(self, key):
+        path, size = self._entries.pop(key)
+        self._size -= size
+        if path not in self._in_use:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+class _FFmpegRunner:
+    """Runs ffmpeg processes, at most max_jobs of them at the same time.
+
+    Every process has a timeout, its exit code is checked and its error output
+    is captured to be reported. Each process gets an equal share of the CPUs
+    available to the instance, in its `threads` attribute.
+    """
+
+    def __init__(self, max_jobs: int, threads_per_job: int, timeout_seconds: float):
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = len(os.sched_getaffinity(0))
+        else:
+            cpus = os.cpu_count() or 1
+        self.max_jobs = max_jobs or max(1, cpus // threads_per_job)
+        self.threads = max(1, cpus // self.max_jobs)
+        self._timeout_seconds = timeout_seconds
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+
+    def run(self, command: List[str], pass_fds: List[int] = ()) -> str:
+        """Runs an ffmpeg command, waiting for a free slot first, and waits for
+        it to finish.
+
+        Args:
+          command: the ffmpeg command.
+          pass_fds: File descriptors inherited by ffmpeg, like the write end of
+            the pipes of its outputs. They are closed in this process once
+            ffmpeg has started, or failed to start.
+
+        Returns:
+          The error output of ffmpeg, where it logs its messages.
+
+        Raises:
+          RuntimeError: if ffmpeg fails or does not finish in time.
+        """
+        with self._slots:
+            try:
+                process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                                           stderr=subprocess.PIPE, pass_fds=pass_fds)
+            finally:
+                for fd in pass_fds:
+                    os.close(fd)
+            try:
+                unused_stdout, stderr = process.communicate(timeout=self._timeout_seconds)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise RuntimeError(f'ffmpeg did not finish in {self._timeout_seconds} seconds')
+        if process.returncode != 0:
+            error = stderr.decode('utf-8', 'replace').strip()[-2000:]
+            # The signatures of the signed URLs read in streaming mode are not reported
+            error = re.sub(r'(https?://[^?\s]*)\?[^\s:]*', r'\1', error)
+            raise RuntimeError(f'ffmpeg exited with code {process.returncode}: {error}')
+        return stderr.decode('utf-8', 'replace')
+
+
+_CONFIG_SOURCE = _build_config_source(CONFIG_SOURCE)
+_STATUS_WRITER = _StatusWriteBuffer(SHEETS_BATCH_SIZE, SHEETS_FLUSH_SECONDS)
+atexit.register(_STATUS_WRITER.flush)
+_MEDIA_CACHE = _MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB * 1024 * 1024)
+_FFMPEG = _FFmpegRunner(FFMPEG_MAX_JOBS, FFMPEG_THREADS_PER_JOB, FFMPEG_TIMEOUT_SECONDS)
+# Loudness of the files analyzed by this instance, by cache key. The results
+# are a few bytes each, so they are kept for the life of the instance.
+_LOUDNESS_CACHE = {}
+_LOUDNESS_CACHE_LOCK = threading.Lock()
+
+# The API clients are created once per instance and reused by the following
+# invocations while the instance stays warm.
+_CLIENTS = {}
+_CLIENT_STATS = {}
+_CLIENTS_LOCK = threading.Lock()
+# httplib2, used by the Sheets service, is not thread safe, so the requests of
+# the shared service are executed one at a time.
+_SHEETS_LOCK = threading.Lock()
+
+
+def _get_client(name: str, factory):
+    """Returns the client registered with name, creating it with factory the
+    first time it is requested.
+
+    Args:
+      name: name of the client in the registry.
+      factory: callable without arguments that creates the client.
+    """
+    with _CLIENTS_LOCK:
+        if name not in _CLIENTS:
+            start = time.perf_counter()
+            _CLIENTS[name] = factory()
+            _CLIENT_STATS[name] = {
+                'init_seconds': time.perf_counter() - start,
+                'created': start,
+                'calls': 0,
+                'call_seconds': 0.0,
+            }
+        return _CLIENTS[name]
+
+
+@contextlib.contextmanager
+def _client_call(name: str):
+    """Measures the time spent in an API call made with the client
+    registered with name.
+
+    Args:
+      name: name of the client in the registry.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _CLIENTS_LOCK:
+            stats = _CLIENT_STATS.get(name)
+            if stats:
+                stats['calls'] += 1
+                stats['call_seconds'] += elapsed
+
+
+def _report_client_stats(invocation_start: float):
+    """Prints the cost of creating each client, whether it was created in
+    this invocation (cold) or reused from a previous one (warm), and the
+    average cost of the calls made with it. The call counters are reset
+    afterwards.
+
+    Args:
+      invocation_start: time.perf_counter() value at the start of the
+        invocation.
+    """
+    with _CLIENTS_LOCK:
+        report = {}
+        for name, stats in _CLIENT_STATS.items():
+            report[name] = {
+                'cold': stats['created'] >= invocation_start,
+                'init_seconds': round(stats['init_seconds'], 4),
+                'calls': stats['calls'],
+                'avg_call_seconds': round(
+                    stats['call_seconds'] / stats['calls'], 4) if stats['calls'] else 0,
+            }
+            stats['calls'] = 0
+            stats['call_seconds'] = 0.0
+    print(json.dumps({'client_stats': report}))
+
+
+class _RunMetrics:
+    """Collects the duration, bytes moved and outcome of every stage of a run.
+
+    Each stage is logged as a JSON line, which Cloud Logging parses as a
+    structured log, and a summary with the percentiles of each stage is logged
+    at the end.
+    """
+
+    def __init__(self):
+        self.run_id = None
+        self.rows = None
+        self._stages = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def start_run(self, run_id: str, rows):
+        """Starts a new run, discarding the stages recorded so far.
+
+        Args:
+          run_id: identifier of the run added to every log.
+          rows: index, or list of indexes, of the rows processed in the run.
+        """
+        with self._lock:
+            self.run_id = run_id
+            self.rows = rows
+            self._stages.clear()
+
+    def record(self, entry: Dict):
+        """Logs a stage and keeps it for the summary.
+
+        Args:
+          entry: Dict with the stage, row, outcome, seconds and bytes moved.
+        """
+        entry['run_id'] = self.run_id
+        with self._lock:
+            # Logged under the lock so that the lines of the threads do not mix
+            print(json.dumps(entry, default=str))
+            self._stages[entry['stage']].append(
+                (entry['seconds'], entry['outcome'], entry.get('bytes', 0)))
+
+    def report_summary(self):
+        """Logs the number of executions, errors, bytes moved and the p50 and
+        p95 durations of each stage of the run.
+        """
+        summary = {}
+        with self._lock:
+            for stage, entries in self._stages.items():
+                durations = sorted(seconds for seconds, unused_outcome, unused_bytes in entries)
+                summary[stage] = {
+                    'count': len(entries),
+                    'errors': sum(outcome != 'ok' for unused_seconds, outcome, unused_bytes in entries),
+                    'bytes': sum(size for unused_seconds, unused_outcome, size in entries),
+                    'total_seconds': round(sum(durations), 4),
+                    'p50_seconds': _percentile(durations, 50),
+                    'p95_seconds': _percentile(durations, 95),
+                }
+        print(json.dumps({'run_id': self.run_id, 'rows': self.rows,
+                          'run_summary': summary}, default=str))
+
+
+_METRICS = _RunMetrics()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """Returns the nearest rank percentile of a sorted list of values.
 
     Args:
-      path: Path to the MP3 file.
+      values: sorted list of values.
+      percent: percentile to compute, between 0 and 100.
     """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+@contextlib.contextmanager
+def _stage(name: str, client: Optional[str] = None):
+    """Measures a stage of the run and records its outcome. The body can add
+    the number of bytes moved to the `bytes` key of the yielded dict.
+
+    Args:
+      name: name of the stage.
+      client: name of the client used, whose call stats are also updated.
+    """
+    entry = {'stage': name, 'row': _METRICS.rows}
+    start = time.perf_counter()
     try:
-        audio = MP3(path)
-        length = audio.info.length
-        return length
-    except:
+        with _client_call(client) if client else contextlib.nullcontext():
+            yield entry
+        entry['outcome'] = 'ok'
+    except Exception as e:
+        entry['outcome'] = 'error'
+        entry['error'] = str(e)
+        raise
+    finally:
+        entry['seconds'] = round(time.perf_counter() - start, 4)
+        _METRICS.record(entry)
+
+
+def _storage_client():
+    return _get_client('storage', storage.Client)
+
+
+def _sheets_service():
+    return _get_client('sheets', lambda: build(
+        'sheets', 'v4', credentials=None, cache_discovery=False))
+
+
+def _credentials():
+    credentials = _get_client('credentials', lambda: google.auth.default()[0])
+    with _CLIENTS_LOCK:
+        if not credentials.valid:
+            credentials.refresh(google.auth.transport.requests.Request())
+    return credentials
+
+def _get_speech_duration(config: Dict) -> float:
+    """Returns the duration of the speech of a line or segment in seconds.
+
+    The duration is sent by the TTS generation. Otherwise it is read from the
+    headers of the speech file with ranged reads from GCS, or by decoding the
+    whole file when its headers are truncated or not recognized.
+
+    Args:
+      config: Dictionary with the gcs_bucket, tts_file_url and, if known, the
+        speech_duration_seconds of the speech.
+    """
+    duration = config.get('speech_duration_seconds')
+    if duration:
+        return float(duration)
+
+    bucket = _storage_client().bucket(config['gcs_bucket'])
+    with _stage('speech_probe', client='storage') as stage:
+        blob = bucket.get_blob(config['tts_file_url'])
+        if not blob:
+            raise FileNotFoundError(f"gs://{config['gcs_bucket']}/{config['tts_file_url']}")
+        def read(start, length):
+            if length <= 0:
+                return b''
+            data = blob.download_as_bytes(start=start, end=start + length - 1)
+            stage['bytes'] = stage.get('bytes', 0) + len(data)
+            return data
+        duration = _probe_audio_duration(read, blob.size)
+    if duration is not None:
+        return duration
+
+    print(f"Decoding {config['tts_file_url']} to read its duration")
+    with _stage('speech_download', client='storage') as stage:
+        data = blob.download_as_bytes()
+        stage['bytes'] = len(data)
+    try:
+        samples, sample_rate = _decode_audio(io.BytesIO(data))
+    except RuntimeError as e:
+        raise ValueError(f"Could not read the duration of {config['tts_file_url']}") from e
+    return len(samples) / sample_rate
+
+PROBE_HEAD_BYTES = 65536
+_MP3_BITRATES = {
+    # (MPEG-1, layer): kbps by bitrate index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by MPEG version bits and sample rate index
+_MP3_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+def _probe_audio_duration(read, size: int) -> Optional[float]:
+    """Computes the duration of an audio file from its headers, without
+    decoding it. It supports every encoding of the TTS API: MP3, OGG_OPUS and
+    the LINEAR16, MULAW and ALAW encodings, which come in a RIFF/WAVE file.
+
+    Args:
+        read: function that returns the given number of bytes of the file from
+            the given offset
+        size: size of the file in bytes
+
+    Returns:
+        The duration in seconds, or None if the format is not recognized or
+        the file is truncated
+    """
+    head = read(0, min(size, PROBE_HEAD_BYTES))
+    try:
+        if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+            return _probe_wav_duration(read, size)
+        if head[:4] == b'OggS':
+            return _probe_ogg_opus_duration(read, size, head)
+        return _probe_mp3_duration(read, size, head)
+    except struct.error:
+        # The headers are cut short
+        return None
+
+def _probe_wav_duration(read, size: int) -> Optional[float]:
+    position = 12
+    byte_rate = None
+    while position + 8 <= size:
+        chunk_id, chunk_size = struct.unpack('<4sI', read(position, 8))
+        if chunk_id == b'fmt ':
+            byte_rate = struct.unpack('<I', read(position + 16, 4))[0]
+        elif chunk_id == b'data':
+            # Streamed files may have a placeholder size
+            data_size = min(chunk_size, size - position - 8)
+            return data_size / byte_rate if byte_rate else None
+        position += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def _probe_ogg_opus_duration(read, size: int, head: bytes) -> Optional[float]:
+    opus_head = head.find(b'OpusHead')
+    if opus_head < 0:
+        return None
+    pre_skip = struct.unpack('<H', head[opus_head + 10:opus_head + 12])[0]
+    # The granule position of the last page is the number of 48 kHz samples
+    tail_start = max(0, size - PROBE_HEAD_BYTES)
+    tail = read(tail_start, size - tail_start)
+    last_page = tail.rfind(b'OggS')
+    if last_page < 0 or last_page + 27 > len(tail):
         return None
+    # The granule position of a truncated page is past the end of the file
+    segments = tail[last_page + 27:last_page + 27 + tail[last_page + 26]]
+    if last_page + 27 + tail[last_page + 26] + sum(segments) > len(tail):
+        return None
+    granule = struct.unpack('<q', tail[last_page + 6:last_page + 14])[0]
+    return max(granule - pre_skip, 0) / 48000
+
+def _probe_mp3_duration(read, size: int, head: bytes) -> Optional[float]:
+    start = 0
+    if head[:3] == b'ID3':
+        # The size of the ID3v2 tag is a 28 bits syncsafe integer
+        tag_size = 0
+        for byte in head[6:10]:
+            tag_size = (tag_size << 7) | (byte & 0x7F)
+        start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+        head = read(start, min(size - start, PROBE_HEAD_BYTES))
+
+    for offset in range(len(head) - 4):
+        frame = _parse_mp3_header(head[offset:offset + 4])
+        if frame:
+            break
+    else:
+        return None
+    mpeg1, mono, bitrate, sample_rate, samples_per_frame = frame
+
+    # VBR files have a Xing/Info or VBRI header with the number of frames
+    xing = offset + 4 + (17 if mono else 32) if mpeg1 else offset + 4 + (9 if mono else 17)
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', head[xing + 4:xing + 8])[0]
+        if flags & 1:
+            frames = struct.unpack('>I', head[xing + 8:xing + 12])[0]
+            # The size of the stream, when present, tells if the file is truncated
+            stream_bytes = struct.unpack('>I', head[xing + 12:xing + 16])[0] if flags & 2 else 0
+            if stream_bytes > size - start - offset:
+                return None
+            return frames * samples_per_frame / sample_rate
+    vbri = offset + 4 + 32
+    if head[vbri:vbri + 4] == b'VBRI':
+        stream_bytes, frames = struct.unpack('>II', head[vbri + 10:vbri + 18])
+        if stream_bytes > size - start - offset:
+            return None
+        return frames * samples_per_frame / sample_rate
+
+    # Otherwise the bitrate is constant
+    audio_bytes = size - start - offset
+    if size >= 128 and read(size - 128, 3) == b'TAG':
+        audio_bytes -= 128
+    return audio_bytes * 8 / (bitrate * 1000)
+
+def _parse_mp3_header(header: bytes) -> Optional[Tuple[bool, bool, int, int, int]]:
+    """Parses the header of a MPEG audio frame.
+
+    Returns:
+        A tuple with whether it is MPEG-1, whether it is mono, the bitrate in kbps,
+        the sample rate and the samples per frame, or None if it is not a header
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = 4 - ((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    mono = header[3] >> 6 == 3
+    if layer == 1:
+        samples_per_frame = 384
+    elif layer == 2 or mpeg1:
+        samples_per_frame = 1152
+    else:
+        samples_per_frame = 576
+    return (mpeg1, mono, _MP3_BITRATES[(mpeg1, layer)][bitrate_index],
+                    _MP3_SAMPLE_RATES[version][sample_rate_index], samples_per_frame)
+
+
+def _download_blob_to_file(blob: storage.Blob, filename: str):
+    """Downloads a blob to a local file. Blobs larger than GCS_TRANSFER_CHUNK_MB
+    are split in ranges that are read in parallel and written in place.
+
+    Args:
+      blob: the blob to download. Its size must be loaded, otherwise it is
+        downloaded with a single request.
+      filename: Name of the local file that will be written.
+    """
+    chunk_size = GCS_TRANSFER_CHUNK_MB * 1024 * 1024
+    if blob.size is None or blob.size <= chunk_size:
+        blob.download_to_filename(filename)
+        return
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        os.ftruncate(fd, blob.size)
+        def download_range(start: int):
+            # The blob has its generation set, so every range is read from it
+            data = blob.download_as_bytes(start=start, end=min(start + chunk_size, blob.size) - 1)
+            os.pwrite(fd, data, start)
+        with concurrent.futures.ThreadPoolExecutor(GCS_TRANSFER_MAX_WORKERS) as executor:
+            list(executor.map(download_range, range(0, blob.size, chunk_size)))
+    finally:
+        os.close(fd)
+
+
+def _upload_file_to_blob(filename: str, blob: storage.Blob, if_generation_match: int):
+    """Uploads a local file to a blob. Files larger than GCS_TRANSFER_CHUNK_MB
+    are uploaded in parallel as temporary parts, which are then composed into
+    the blob and deleted.
+
+    Args:
+      filename: Name of the local file that will be uploaded.
+      blob: the blob to write, with the metadata to store.
+      if_generation_match: Generation of the blob, or 0 if it did not exist.
+        The blob is only written if it is still at that generation.
+    """
+    size = os.path.getsize(filename)
+    chunk_size = GCS_TRANSFER_CHUNK_MB * 1024 * 1024
+    if size <= chunk_size:
+        blob.upload_from_filename(filename, if_generation_match=if_generation_match)
+        return
+
+    # A single compose request accepts a limited number of parts
+    chunk_size = max(chunk_size, -(-size // GCS_MAX_COMPOSE_PARTS))
+    upload_id = uuid.uuid4().hex
+    parts = [blob.bucket.blob(f'{blob.name}.{upload_id}.part{i}')
+             for i in range(-(-size // chunk_size))]
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        def upload_part(i: int):
+            parts[i].upload_from_string(os.pread(fd, chunk_size, i * chunk_size),
+                                        if_generation_match=0)
+        with concurrent.futures.ThreadPoolExecutor(GCS_TRANSFER_MAX_WORKERS) as executor:
+            list(executor.map(upload_part, range(len(parts))))
+        # Like upload_from_filename, which guesses it from the extension
+        blob.content_type = blob.content_type or mimetypes.guess_type(filename)[0]
+        blob.compose(parts, if_generation_match=if_generation_match)
+    finally:
+        os.close(fd)
+        def delete_part(part: storage.Blob):
+            # The parts that failed to upload do not exist
+            with contextlib.suppress(Exception):
+                part.delete()
+        with concurrent.futures.ThreadPoolExecutor(GCS_TRANSFER_MAX_WORKERS) as executor:
+            list(executor.map(delete_part, parts))
 
 
 def _copy_file_from_gcs(gcs_bucket: str, source_blob_name: str, destination_local_filename: str):
@@ -59,126 +1010,1151 @@ def _copy_file_from_gcs(gcs_bucket: str, source_blob_name: str, destination_loca
       source_blob_name: Name of the source blob containing the file.
       destination_local_filename: Name of the local file that will be written.
     """
-    storage_client = storage.Client()
+    storage_client = _storage_client()
     bucket = storage_client.bucket(gcs_bucket)
     blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_local_filename)
+    with _stage('gcs_download', client='storage') as stage:
+        blob.download_to_filename(destination_local_filename)
+        stage['bytes'] = os.path.getsize(destination_local_filename)
 
 
-def _copy_file_to_gcs(gcs_bucket: str, source_local_filename: str, destination_blob_name: str):
-    """Copies a file to Google Cloud Storage from a temporary local filename.
+def _copy_file_to_gcs(gcs_bucket: str, source_local_filename: str, destination_blob_name: str,
+                      fingerprint: str, if_generation_match: int):
+    """Copies a file to Google Cloud Storage from a temporary local filename,
+    with the fingerprint of the job that generated it in its metadata.
+
+    The file is only written if the destination is still at the generation
+    seen before rendering it, replacing it in a single request.
 
     Args:
       gcs_bucket: string containing the bucket name.
       source_local_filename: Name of the local file that will be copied.
       destination_blob_name: Name of the blob to be created in GCS.
+      fingerprint: Fingerprint of the job that generated the file.
+      if_generation_match: Generation of the destination blob, or 0 if it
+        did not exist.
     """
-    storage_client = storage.Client()
+    storage_client = _storage_client()
     bucket = storage_client.bucket(gcs_bucket)
     blob = bucket.blob(destination_blob_name)
+    blob.metadata = {JOB_FINGERPRINT_KEY: fingerprint}
     print(gcs_bucket)
     print(source_local_filename)
     print(destination_blob_name)
-    print('Checking if blob exists')
-    if blob.exists():
-        print('Deleting existing target file')
-        blob.delete()
-    blob.upload_from_filename(source_local_filename)
+    with _stage('gcs_upload', client='storage') as stage, _conditional_write(
+            bucket, destination_blob_name, fingerprint):
+        _upload_file_to_blob(source_local_filename, blob, if_generation_match)
+        stage['bytes'] = os.path.getsize(source_local_filename)
 
 
-def _mix_video_and_speech(config: Dict): #, video_file, speech_file,destination_video_name, voice_delay):
-    """Mixes a generated speech file with the audio of the specified video.
+@contextlib.contextmanager
+def _conditional_write(bucket: storage.Bucket, blob_name: str, fingerprint: str):
+    """Ignores the failed precondition of a conditional write when the blob
+    was written meanwhile by another execution of the same job, for example
+    for a redelivered message.
+
+    Args:
+      bucket: the bucket of the blob.
+      blob_name: Name of the blob written.
+      fingerprint: Fingerprint of the job that generated the blob.
+    """
+    try:
+        yield
+    except PreconditionFailed:
+        if not _is_rendered(bucket.get_blob(blob_name), fingerprint):
+            raise
+        print(f'{blob_name} was written by another execution of the same job')
+
+
+def _get_signed_url(gcs_bucket: str, blob_name: str) -> str:
+    """Generates a signed URL to read a file in Google Cloud Storage.
+
+    The URL is signed with the IAM signBlob API using the credentials of the
+    function, so the service account must be able to sign for itself.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_name: Name of the blob containing the file.
+    """
+    credentials = _credentials()
+    blob = _storage_client().bucket(gcs_bucket).blob(blob_name)
+    return blob.generate_signed_url(
+        version='v4',
+        expiration=timedelta(minutes=SIGNED_URL_EXPIRATION_MINUTES),
+        method='GET',
+        service_account_email=credentials.service_account_email,
+        access_token=credentials.token)
+
+
+def _upload_stream_to_gcs(stream, blob):
+    """Uploads a binary stream to Google Cloud Storage in chunks until it is
+    exhausted. The stream is closed afterwards, even if the upload fails.
+
+    Args:
+      stream: binary file object to read from.
+      blob: the blob to write.
+    """
+    with stream, _stage('gcs_upload', client='storage') as stage, blob.open(
+            'wb', chunk_size=GCS_STREAM_CHUNK_MB * 1024 * 1024,
+            content_type='video/mp4') as f:
+        stage['bytes'] = 0
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            f.write(chunk)
+            stage['bytes'] += len(chunk)
+
+
+def _stream_ffmpeg_outputs_to_gcs(build_command: Callable[[List[str]], List[str]],
+                                  gcs_bucket: str,
+                                  destination_blob_names: List[str],
+                                  fingerprints: List[str],
+                                  if_generation_matches: List[int]):
+    """Runs ffmpeg and uploads each of its outputs to Google Cloud Storage in
+    chunks while they are being generated.
+
+    Every output is written by ffmpeg to its own pipe and uploaded to a
+    partial file, which is renamed to its destination name only when ffmpeg
+    succeeds, and only if the destination is still at the generation seen
+    before rendering it.
+
+    Args:
+      build_command: function that receives the list of output names and
+        returns the ffmpeg command.
+      gcs_bucket: string containing the bucket name.
+      destination_blob_names: Names of the blobs to be created in GCS, one per
+        output.
+      fingerprints: Fingerprint of the job that generates each output, stored
+        in its metadata.
+      if_generation_matches: Generation of each destination blob, or 0 if it
+        did not exist.
+    """
+    bucket = _storage_client().bucket(gcs_bucket)
+    partial_blobs = [bucket.blob(f'{name}.partial') for name in destination_blob_names]
+    for blob, fingerprint in zip(partial_blobs, fingerprints):
+        blob.metadata = {JOB_FINGERPRINT_KEY: fingerprint}
+    pipes = [os.pipe() for unused_name in destination_blob_names]
+    write_fds = [write_fd for unused_read_fd, write_fd in pipes]
+    command = build_command([f'pipe:{write_fd}' for write_fd in write_fds])
+    with _stage('ffmpeg_stream'):
+        # The uploads read the pipes while ffmpeg writes them
+        with concurrent.futures.ThreadPoolExecutor(len(pipes)) as executor:
+            uploads = [
+                executor.submit(_upload_stream_to_gcs, os.fdopen(read_fd, 'rb'), blob)
+                for (read_fd, unused_write_fd), blob in zip(pipes, partial_blobs)]
+            try:
+                _FFMPEG.run(command, pass_fds=write_fds)
+                errors = []
+            except RuntimeError as e:
+                errors = [e]
+        errors += [upload.exception() for upload in uploads if upload.exception()]
+        if errors:
+            for blob in partial_blobs:
+                with contextlib.suppress(Exception):
+                    blob.delete()
+            raise errors[0]
+    with _stage('gcs_rename', client='storage'):
+        for blob, name, fingerprint, if_generation_match in zip(
+                partial_blobs, destination_blob_names, fingerprints, if_generation_matches):
+            with _conditional_write(bucket, name, fingerprint):
+                bucket.rename_blob(blob, name, if_generation_match=if_generation_match)
+                continue
+            # The output was written by another execution, so it is discarded
+            blob.delete()
+
+
+def _get_video_codec(video_input: str) -> Optional[str]:
+    """Returns the name of the codec of the first video stream of a file, as
+    reported by ffprobe, or None if it cannot be read.
+
+    Args:
+      video_input: Path or URL of the video file.
+    """
+    with _stage('probe'):
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'stream=codec_name', '-of', 'default=nw=1:nk=1',
+             video_input],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+            timeout=FFPROBE_TIMEOUT_SECONDS)
+    codec = result.stdout.strip()
+    return codec if result.returncode == 0 and codec else None
+
+
+def _can_copy_video(video_input: str) -> bool:
+    """Checks whether the video stream can be copied to the MP4 output as it
+    is, without encoding it again.
+
+    Args:
+      video_input: Path or URL of the video file.
+    """
+    if not VIDEO_STREAM_COPY:
+        return False
+    codec = _get_video_codec(video_input)
+    if codec not in MP4_VIDEO_CODECS:
+        print(f'Video codec {codec} cannot be copied, encoding it with {FALLBACK_VIDEO_CODEC}')
+        return False
+    return True
+
+
+def _build_codec_args(copy_video: bool, preview: bool = False) -> List[str]:
+    """Builds the ffmpeg arguments selecting the codecs of an output.
+
+    Args:
+      copy_video: Whether the video stream is copied instead of encoded.
+      preview: Whether the output is a preview, which is scaled down and
+        encoded at a lower bitrate.
+    """
+    if preview:
+        return ['-vf', f'scale=-2:min(ih\\,{PREVIEW_HEIGHT})',
+                '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                '-b:v', PREVIEW_VIDEO_BITRATE,
+                '-c:a', AUDIO_CODEC, '-b:a', PREVIEW_AUDIO_BITRATE]
+    video_codec = 'copy' if copy_video else FALLBACK_VIDEO_CODEC
+    return ['-c:v', video_codec, '-c:a', AUDIO_CODEC, '-b:a', AUDIO_BITRATE]
+
+
+def _get_render_mode(config: Dict) -> str:
+    """Returns how a line must be rendered, 'preview' or 'full'.
 
     Args:
       config: Dictionary containing the configuration information.
+
+    Raises:
+      ValueError: if its render_mode is not one of RENDER_MODES.
     """
-    # Generate a 10 characters long random string (rnd)
-    random_string = ''.join(random.choices(
-        string.ascii_lowercase + string.digits, k=12))
+    if 'render_mode' not in config:
+        return 'full'
+    render_mode = str(config['render_mode']).strip().lower()
+    if render_mode not in RENDER_MODES:
+        raise ValueError(f"Invalid render_mode '{config['render_mode']}', it must be "
+                         f"{', '.join(RENDER_MODES)}")
+    return RENDER_MODES[render_mode]
 
-    # Copy video_file from blob to /tmp/video[rnd].mp4
-    source_video_input = '/tmp/video_{random_string}.mp4'.format(
-        random_string=random_string)
-    input_video_file = f"{config['video_file']}"
-    print(input_video_file)
-    _copy_file_from_gcs(config['gcs_bucket'], input_video_file, source_video_input)
 
-    # Copy speech_file from blob to /tmp/speech[rnd].mp3
-    source_speech_input = '/tmp/speech_{random_string}.mp4'.format(
-        random_string=random_string)
-    _copy_file_from_gcs(config['gcs_bucket'], config['tts_file_url'], source_speech_input)
+def _is_preview(config: Dict) -> bool:
+    """Checks whether only a preview of a line must be rendered.
+
+    Args:
+      config: Dictionary containing the configuration information.
+
+    Raises:
+      ValueError: if its render_mode is not one of RENDER_MODES.
+    """
+    return _get_render_mode(config) == 'preview'
+
+
+def _get_preview_window(config: Dict, voice_dub_lengths: List[float]) -> Tuple[float, float]:
+    """Returns the part of the output rendered in the preview of a line, from
+    PREVIEW_MARGIN_SECONDS before its first speech segment until
+    PREVIEW_MARGIN_SECONDS after its last one.
+
+    Args:
+      config: Dictionary containing the configuration information.
+      voice_dub_lengths: Length of each speech segment in seconds.
+
+    Returns:
+      A tuple with the start and the duration of the window in seconds.
+    """
+    segments = _get_segments(config)
+    start = min(int(segment['millisecond_start_audio']) for segment in segments) / 1000
+    end = max(int(segment['millisecond_start_audio']) / 1000 + length
+              for segment, length in zip(segments, voice_dub_lengths))
+    start = max(0.0, start - PREVIEW_MARGIN_SECONDS)
+    return start, end + PREVIEW_MARGIN_SECONDS - start
+
 
-    # Generate and run mix command to generate the output video file
-    generated_video_file = '/tmp/output_{random_string}.mp4'.format(
-        random_string=random_string)
+def _get_segments(config: Dict) -> List[Dict]:
+    """Returns the speech segments of a line, with their `tts_file_url`,
+    `millisecond_start_audio` and `speech_duration_seconds`. The lines without
+    a timeline have a single segment.
 
+    Args:
+      config: Dictionary containing the configuration information.
+    """
+    if config.get('segments'):
+        return config['segments']
+    return [{
+        'tts_file_url': config['tts_file_url'],
+        'millisecond_start_audio': config['millisecond_start_audio'],
+        'speech_duration_seconds': config.get('speech_duration_seconds'),
+    }]
+
+
+def _build_dub_filter(speech_streams: List[str], original_stream: str,
+                      voice_delays: List[int], config: Dict,
+                      voice_dub_lengths: List[float], suffix: str = '',
+                      gains: Optional[Dict] = None) -> str:
+    """Builds the part of the ffmpeg filter graph that mixes the speech
+    segments of an output with the base audio, lowering the base audio while
+    each segment is played.
+
+    Args:
+      speech_streams: Label of the audio stream of each speech segment.
+      original_stream: Label of the base audio stream.
+      voice_delays: Milliseconds to delay each speech segment.
+      config: Dictionary containing the configuration information.
+      voice_dub_lengths: Length of each speech segment in seconds.
+      suffix: Suffix of the labels of the streams created by the filter.
+      gains: Gains computed from the loudness of the inputs, as returned by
+        _get_auto_gains, which replace base_audio_vol_percent.
+
+    Returns:
+      The filter, whose output is labelled audio_out{suffix}.
+    """
     audio_reduction = 0.9
-    if config['base_audio_vol_percent']:
-      audio_reduction = config['base_audio_vol_percent']
+    speech_volumes = [''] * len(speech_streams)
+    if gains:
+        audio_reduction = gains['base']
+        speech_volumes = [f'volume={gain},' for gain in gains['speech']]
+    elif config['base_audio_vol_percent']:
+        audio_reduction = config['base_audio_vol_percent']
 
     # Calculate when the original audio should be adjusted during and
-    # after the voice dub section
-    audio_down_start = int(config['millisecond_start_audio'])/1000
-    voice_dub_length = _get_mp3_length(source_speech_input)
-    print('Voice Dub length is {voice_dub_length}'.format(
-        voice_dub_length=voice_dub_length))
-    audio_down_end = audio_down_start + voice_dub_length
-    if config['base_audio_file']:
-      # Copy base_audio_file from blob to /tmp/base_audio_[rnd].{sound_extension}
-      sound_extension = config['base_audio_file'].split(".")[1]
-      source_audio_input = f"/tmp/base_audio_{random_string}.{sound_extension}"
-      _copy_file_from_gcs(config['gcs_bucket'], config['base_audio_file'], source_audio_input)
-      ffmpeg_mix_command = (
-                      "ffmpeg "
-                      "-loglevel error "
-                      f"-i {source_video_input} -i {source_audio_input} -i {source_speech_input} "
-                      "-filter_complex "
-                      f"\"[2:a] adelay={config['millisecond_start_audio']}|{config['millisecond_start_audio']} [voice_dub];"
-                      f"[1:a] volume={audio_reduction}:enable='between(t,{audio_down_start},{audio_down_end})' [original_audio];"
-                      f"[original_audio] volume=0.9:enable='gt(t,{audio_down_end})' [original_audio];"
-                      f"[voice_dub][original_audio] amix=duration=longest [audio_out]"
-                      "\" "
-                      f"-map 0:v -map \"[audio_out]\" -y {generated_video_file}"
-                      )
+    # after the voice dub sections
+    windows = [(int(delay)/1000, int(delay)/1000 + length)
+               for delay, length in zip(voice_delays, voice_dub_lengths)]
+    audio_down_end = max(end for unused_start, end in windows)
+    ducking = '+'.join(f'between(t,{start},{end})' for start, end in windows)
+
+    filters = []
+    if len(speech_streams) == 1:
+        filters.append(
+            f"[{speech_streams[0]}] {speech_volumes[0]}adelay={voice_delays[0]}|{voice_delays[0]} [voice_dub{suffix}]")
+    else:
+        # The segments are placed in the timeline and summed. amerge does not
+        # scale the inputs like amix, but it stops with the shortest input, so
+        # all of them are padded with silence up to the end of the last one.
+        voice_streams = [f'voice{suffix}_{j}' for j in range(len(speech_streams))]
+        for speech_stream, voice_stream, voice_delay, speech_volume in zip(
+                speech_streams, voice_streams, voice_delays, speech_volumes):
+            filters.append(
+                f"[{speech_stream}] {speech_volume}aresample=48000,aformat=channel_layouts=mono,"
+                f"adelay={voice_delay},apad,atrim=end={audio_down_end + 1} [{voice_stream}]")
+        channels = '+'.join(f'c{j}' for j in range(len(voice_streams)))
+        filters.append(
+            ''.join(f'[{stream}]' for stream in voice_streams) +
+            f" amerge=inputs={len(voice_streams)},pan=mono|c0={channels} [voice_dub{suffix}]")
+
+    filters += [
+        f"[{original_stream}] volume={audio_reduction}:enable='{ducking}' [original_audio{suffix}]",
+        f"[original_audio{suffix}] volume=0.9:enable='gt(t,{audio_down_end})' [original_audio{suffix}]",
+        f"[voice_dub{suffix}][original_audio{suffix}] amix=duration=longest [audio_out{suffix}]",
+    ]
+    return ';'.join(filters)
+
+
+def _build_ffmpeg_mix_command(configs: List[Dict], video_input: str,
+                              speech_inputs: List[List[str]],
+                              base_audio_input: Optional[str],
+                              voice_dub_lengths: List[List[float]],
+                              outputs: List[str],
+                              copy_video: bool,
+                              window: Optional[Tuple[float, float]] = None,
+                              threads: int = 0,
+                              gains: Optional[List[Optional[Dict]]] = None) -> List[str]:
+    """Builds the ffmpeg command that mixes the speech segments of each output
+    with the base audio, generating one output video per line in a single
+    pass.
+
+    The inputs are read once, and only the mixed audio is encoded when the
+    video stream can be copied.
+
+    Args:
+      configs: List of dictionaries containing the configuration information,
+        one per output.
+      video_input: Path or URL of the video file.
+      speech_inputs: Path or URL of the speech file of each segment of each
+        output.
+      base_audio_input: Path or URL of the base audio file, if any. Otherwise
+        the audio of the video is used.
+      voice_dub_lengths: Length of each segment of each output in seconds.
+      outputs: Path of each output file, or pipe:N to write it to the file
+        descriptor N.
+      copy_video: Whether the video stream is copied instead of encoded.
+      window: Start and duration in seconds of the part of the video to
+        render, for previews, which are also encoded at a lower resolution
+        and bitrate. The whole video is rendered otherwise.
+      threads: Number of threads used to decode and encode the video, or 0 to
+        let ffmpeg use every CPU.
+      gains: Gains of each output computed from the loudness of the inputs, or
+        None for the outputs using base_audio_vol_percent.
+
+    Returns:
+      The list with the arguments of the command.
+    """
+    # The video and base audio are read from the start of the window, so
+    # the speech is moved back accordingly
+    seek = ['-ss', str(window[0])] if window else []
+    offset = round(window[0] * 1000) if window else 0
+    thread_args = ['-threads', str(threads)] if threads else []
+    inputs = [*seek, *thread_args, '-i', video_input]
+    input_count = 1
+    if base_audio_input:
+        inputs += [*seek, '-i', base_audio_input]
+        input_count += 1
+        original_stream = '1:a'
     else:
-      ffmpeg_mix_command = (
-                      "ffmpeg "
-                      "-loglevel error "
-                      f"-i {source_video_input} -i {source_speech_input} "
-                      "-filter_complex "
-                      f"\"[1:a] adelay={0}|{0} [voice_dub];"
-                      f"[0:a] volume={audio_reduction}:enable='between(t,{audio_down_start},{audio_down_end})' [original_audio];"
-                      f"[original_audio] volume=0.9:enable='gt(t,{audio_down_end})' [original_audio];"
-                      f"[voice_dub][original_audio] amix=duration=longest [audio_out]"
-                      "\" "
-                      f"-map 0:v -map \"[audio_out]\" -y {generated_video_file}"
-                      )
-    print(f'Running command: {ffmpeg_mix_command}')
+        original_stream = '0:a'
+
+    filters = []
+    original_streams = [original_stream]
+    if len(configs) > 1:
+        # Every output needs its own copy of the base audio
+        original_streams = [f'original_{i}' for i in range(len(configs))]
+        filters.append(f"[{original_stream}] asplit={len(configs)} " +
+                       ''.join(f'[{stream}]' for stream in original_streams))
+    for i, config in enumerate(configs):
+        speech_streams = []
+        for speech_input in speech_inputs[i]:
+            speech_streams.append(f'{input_count}:a')
+            inputs += ['-i', speech_input]
+            input_count += 1
+        voice_delays = [int(segment['millisecond_start_audio']) - offset
+                        for segment in _get_segments(config)]
+        filters.append(_build_dub_filter(
+            speech_streams, original_streams[i], voice_delays, config,
+            voice_dub_lengths[i], f'_{i}' if len(configs) > 1 else '',
+            gains[i] if gains else None))
+
+    command = ['ffmpeg', '-loglevel', 'error', '-y', *inputs,
+               '-filter_complex', ';'.join(filters)]
+    for i, output in enumerate(outputs):
+        audio_out = f'[audio_out_{i}]' if len(configs) > 1 else '[audio_out]'
+        command += ['-map', '0:v', '-map', audio_out, *thread_args,
+                    *_build_codec_args(copy_video, preview=window is not None)]
+        if window:
+            command += ['-t', str(window[1])]
+        if output.startswith('pipe:'):
+            # A fragmented MP4 can be written without seeking back in the output
+            command += ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov']
+        command.append(output)
+    return command
+
+
+def _get_input_files(config: Dict) -> List[str]:
+    """Returns the names of the files in GCS used to generate the output of a
+    line.
+
+    Args:
+      config: Dictionary containing the configuration information.
+    """
+    names = [name for name in (config['video_file'], config['base_audio_file']) if name]
+    return names + [segment['tts_file_url'] for segment in _get_segments(config)]
+
+
+def _get_input_checksums(gcs_bucket: str, blob_names: List[str]) -> Dict[str, str]:
+    """Returns the CRC32C checksum and size of each file, which identify its
+    content. Generations are not used, since the TTS generation copies the
+    speech files from its cache in every execution.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_names: Names of the blobs.
+    """
+    bucket = _storage_client().bucket(gcs_bucket)
+    blob_names = sorted(set(blob_names))
+    with _stage('input_lookup', client='storage'), concurrent.futures.ThreadPoolExecutor(
+            min(len(blob_names), 16)) as executor:
+        blobs = list(executor.map(bucket.get_blob, blob_names))
+    checksums = {}
+    for blob_name, blob in zip(blob_names, blobs):
+        if blob is None:
+            raise FileNotFoundError(f'gs://{gcs_bucket}/{blob_name}')
+        checksums[blob_name] = f'{blob.crc32c}/{blob.size}'
+    return checksums
+
+
+def _build_job_fingerprint(config: Dict, checksums: Dict[str, str], recipe: Any) -> str:
+    """Builds the fingerprint of the job generating the output of a line from
+    the content of its input files and the recipe that mixes them.
+
+    Args:
+      config: Dictionary containing the configuration information.
+      checksums: Checksum of each input file, by name.
+      recipe: JSON serializable description of every parameter of the mix and
+        the encoding, like the ffmpeg command.
+    """
+    job = {
+        'inputs': [checksums[name] for name in _get_input_files(config)],
+        'recipe': recipe,
+    }
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _is_rendered(blob: Optional[storage.Blob], fingerprint: str) -> bool:
+    """Checks whether an output exists and was generated by the job with the
+    given fingerprint.
+
+    Args:
+      blob: the output blob, or None if it does not exist.
+      fingerprint: Fingerprint of the job.
+    """
+    return blob is not None and (blob.metadata or {}).get(JOB_FINGERPRINT_KEY) == fingerprint
+
+
+def _get_output_blobs(gcs_bucket: str, blob_names: List[str]) -> List[Optional[storage.Blob]]:
+    """Returns the current version of each output, or None for the outputs
+    that do not exist.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_names: Names of the output blobs.
+    """
+    bucket = _storage_client().bucket(gcs_bucket)
+    with _stage('output_lookup', client='storage'), concurrent.futures.ThreadPoolExecutor(
+            min(len(blob_names), 16)) as executor:
+        return list(executor.map(bucket.get_blob, blob_names))
+
+
+def _reuse_rendered_outputs(gcs_bucket: str, blob_names: List[str], fingerprints: List[str],
+                            output_blobs: List[Optional[storage.Blob]]
+                            ) -> List[Optional[storage.Blob]]:
+    """Copies to their target the outputs that are not rendered there yet but
+    were rendered by the same job in a previous execution, found through the
+    pointer object of the job.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_names: Names of the output blobs.
+      fingerprints: Fingerprint of the job generating each output.
+      output_blobs: Current version of each output, or None for the outputs
+        that do not exist.
+
+    Returns:
+      The current version of each output after the copies.
+    """
+    bucket = _storage_client().bucket(gcs_bucket)
+    outputs = list(output_blobs)
+    for i, (blob_name, fingerprint, output_blob) in enumerate(
+            zip(blob_names, fingerprints, output_blobs)):
+        if _is_rendered(output_blob, fingerprint):
+            continue
+        try:
+            with _stage('job_pointer_lookup', client='storage'):
+                pointer = bucket.get_blob(f'{JOB_POINTER_PREFIX}/{fingerprint}')
+                source = None
+                if pointer and (pointer.metadata or {}).get('output'):
+                    source = bucket.get_blob(pointer.metadata['output'])
+            if not _is_rendered(source, fingerprint):
+                continue
+            with _stage('gcs_copy', client='storage'), _conditional_write(
+                    bucket, blob_name, fingerprint):
+                bucket.copy_blob(source, bucket, blob_name,
+                                 if_generation_match=output_blob.generation if output_blob else 0)
+            print(f'{blob_name} copied from {source.name}, rendered by the same job')
+            outputs[i] = bucket.get_blob(blob_name)
+        except Exception as e:
+            print(f'Could not reuse the previous output of {blob_name}: {e}')
+    return outputs
+
+
+def _save_job_pointers(gcs_bucket: str, blob_names: List[str], fingerprints: List[str]):
+    """Records the output rendered by each job in the pointer object named
+    after its fingerprint.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_names: Names of the output blobs.
+      fingerprints: Fingerprint of the job that generated each output.
+    """
+    bucket = _storage_client().bucket(gcs_bucket)
+    for blob_name, fingerprint in zip(blob_names, fingerprints):
+        blob = bucket.blob(f'{JOB_POINTER_PREFIX}/{fingerprint}')
+        blob.metadata = {'output': blob_name}
+        try:
+            with _stage('job_pointer_write', client='storage'):
+                blob.upload_from_string(blob_name, content_type='text/plain')
+        except Exception as e:
+            print(f'Could not save the job pointer of {blob_name}: {e}')
+
+
+def _get_auto_gains(configs: List[Dict], checksums: Dict[str, str]) -> List[Optional[Dict]]:
+    """Computes the gains of the lines from the loudness of their speech and
+    base audio, when AUTO_LOUDNESS is enabled and their
+    base_audio_vol_percent is empty.
+
+    Each speech segment is normalized to SPEECH_TARGET_LUFS, without raising
+    its true peak above SPEECH_MAX_PEAK_DBTP. The base audio, or the audio of
+    the video if there is no base audio file, is lowered while the speech is
+    played so that it stays DUCKING_OFFSET_LU below the speech, but it is never
+    raised.
+
+    Args:
+      configs: List of dictionaries containing the configuration information,
+        sharing the same video and base audio files.
+      checksums: Checksum of each input file, by name.
+
+    Returns:
+      For each line, a dict with the `base` gain applied while the speech is
+      played and the `speech` gain of each segment, or None if the line uses
+      base_audio_vol_percent.
+    """
+    auto = [AUTO_LOUDNESS and not config['base_audio_vol_percent'] for config in configs]
+    if not any(auto):
+        return [None] * len(configs)
+    gcs_bucket = configs[0]['gcs_bucket']
+    base_file = configs[0]['base_audio_file'] or configs[0]['video_file']
+    names = {segment['tts_file_url']
+             for config, line_auto in zip(configs, auto) if line_auto
+             for segment in _get_segments(config)}
+    if base_file:
+        names.add(base_file)
+    names = sorted(names)
+    with concurrent.futures.ThreadPoolExecutor(min(len(names), GCS_TRANSFER_MAX_WORKERS)) as executor:
+        loudness = dict(zip(names, executor.map(
+            lambda name: _get_loudness(gcs_bucket, name, checksums[name]), names)))
+
+    base_gain = 1.0
+    if base_file and loudness[base_file]['integrated_lufs'] > SILENCE_LUFS:
+        base_gain_db = SPEECH_TARGET_LUFS - DUCKING_OFFSET_LU - loudness[base_file]['integrated_lufs']
+        base_gain = round(10 ** (min(base_gain_db, 0) / 20), 4)
+    gains = []
+    for config, line_auto in zip(configs, auto):
+        if not line_auto:
+            gains.append(None)
+            continue
+        speech_gains = []
+        for segment in _get_segments(config):
+            speech = loudness[segment['tts_file_url']]
+            speech_gain_db = 0.0
+            if speech['integrated_lufs'] > SILENCE_LUFS:
+                speech_gain_db = min(SPEECH_TARGET_LUFS - speech['integrated_lufs'],
+                                     SPEECH_MAX_PEAK_DBTP - speech['true_peak_dbtp'],
+                                     LOUDNESS_MAX_GAIN_DB)
+            speech_gains.append(round(10 ** (speech_gain_db / 20), 4))
+        gains.append({'base': base_gain, 'speech': speech_gains})
+    return gains
+
+
+def _get_loudness(gcs_bucket: str, blob_name: str, checksum: str) -> Dict[str, float]:
+    """Returns the loudness of a file, which is only measured the first time.
+    The results are cached in memory and in gcs_bucket under
+    LOUDNESS_CACHE_PREFIX, named after the checksum of the file: unlike its
+    generation, the checksum does not change when the TTS generation copies
+    the same speech file again.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_name: Name of the blob containing the file.
+      checksum: Checksum of the content of the file.
+
+    Returns:
+      A dict with the `integrated_lufs` loudness and the `true_peak_dbtp` of
+      the file.
+    """
+    key = hashlib.sha256(f'{LOUDNESS_CACHE_VERSION}/{checksum}'.encode('utf-8')).hexdigest()
+    with _LOUDNESS_CACHE_LOCK:
+        if key in _LOUDNESS_CACHE:
+            return _LOUDNESS_CACHE[key]
+
+    cache_blob = _storage_client().bucket(gcs_bucket).blob(f'{LOUDNESS_CACHE_PREFIX}/{key}.json')
+    with _stage('loudness_cache_lookup', client='storage') as stage:
+        try:
+            loudness = json.loads(cache_blob.download_as_bytes())
+        except NotFound:
+            loudness = None
+        stage['hit'] = loudness is not None
+    if loudness is None:
+        loudness = _measure_loudness(gcs_bucket, blob_name)
+        with _stage('loudness_cache_store', client='storage'):
+            cache_blob.upload_from_string(json.dumps(loudness), content_type='application/json')
+
+    with _LOUDNESS_CACHE_LOCK:
+        _LOUDNESS_CACHE[key] = loudness
+    return loudness
+
+
+def _measure_loudness(gcs_bucket: str, blob_name: str) -> Dict[str, float]:
+    """Measures the integrated loudness (EBU R128) and the true peak of the
+    audio of a file with ffmpeg.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_name: Name of the blob containing the file.
+    """
+    cached_file = None
+    if STREAMING_MODE:
+        source = _get_signed_url(gcs_bucket, blob_name)
+    else:
+        source = cached_file = _MEDIA_CACHE.acquire(gcs_bucket, blob_name)
+    try:
+        with _stage('loudness_analysis'):
+            # The summary is logged at the info level, the frames at verbose
+            output = _FFMPEG.run(['ffmpeg', '-nostats', '-hide_banner', '-i', source, '-vn',
+                                  '-af', 'ebur128=peak=true:framelog=verbose',
+                                  '-f', 'null', '-'])
+    finally:
+        if cached_file:
+            _MEDIA_CACHE.release(cached_file)
+    integrated = re.findall(r'I:\s+(\S+) LUFS', output)
+    peak = re.findall(r'Peak:\s+(\S+) dBFS', output)
+    if not integrated or not peak:
+        raise RuntimeError(f'Could not measure the loudness of {blob_name}')
+    return {'integrated_lufs': float(integrated[-1]), 'true_peak_dbtp': float(peak[-1])}
+
+
+def _decode_audio(source) -> Tuple[np.ndarray, int]:
+    """Decodes an audio file into float PCM samples.
+
+    Args:
+      source: Path of the file, or binary file object with its content.
+
+    Returns:
+      A tuple with the samples, as an array of frames by channels, and the
+      sample rate.
+    """
+    with _stage('audio_decode'):
+        samples, sample_rate = soundfile.read(source, dtype='float32', always_2d=True)
+    return samples, sample_rate
+
+
+def _resample(samples: np.ndarray, sample_rate: int, target_rate: int) -> np.ndarray:
+    """Resamples audio by truncating or zero padding its spectrum, which does
+    not add aliasing. The speech files are short, so the whole signal is
+    transformed at once.
+
+    Args:
+      samples: Array of samples, with the frames in the first axis.
+      sample_rate: Sample rate of the samples.
+      target_rate: Sample rate of the result.
+    """
+    if sample_rate == target_rate or not len(samples):
+        return samples
+    frames = round(len(samples) * target_rate / sample_rate)
+    spectrum = np.fft.rfft(samples, axis=0)
+    resampled = np.fft.irfft(spectrum, n=frames, axis=0) * (frames / len(samples))
+    return resampled.astype(np.float32)
+
+
+def _mix_audio(config: Dict, speech_tracks: List[np.ndarray],
+               base_audio: Optional[np.ndarray], sample_rate: int,
+               gains: Optional[Dict] = None) -> np.ndarray:
+    """Mixes the speech segments of a line with the base audio, applying the
+    same delays, volume changes and mix as the filter graph of
+    _build_dub_filter.
+
+    Args:
+      config: Dictionary containing the configuration information.
+      speech_tracks: Mono samples of each speech segment.
+      base_audio: Samples of the base audio, as an array of frames by
+        channels, or None if there is no base audio.
+      sample_rate: Sample rate of the speech and base audio samples.
+      gains: Gains computed from the loudness of the inputs, which replace
+        base_audio_vol_percent.
+
+    Returns:
+      The mixed samples, as an array of frames by channels.
+    """
+    if gains:
+        speech_tracks = [track * gain for track, gain in zip(speech_tracks, gains['speech'])]
+    delays = [round(int(segment['millisecond_start_audio']) * sample_rate / 1000)
+              for segment in _get_segments(config)]
+    voice_end = max(delay + len(track) for delay, track in zip(delays, speech_tracks))
+    if len(speech_tracks) > 1:
+        # The filter graph pads the segments with 1 second of silence
+        voice_end += sample_rate
+    voice = np.zeros(voice_end, dtype=np.float32)
+    for delay, track in zip(delays, speech_tracks):
+        voice[delay:delay + len(track)] += track
+    if base_audio is None:
+        return voice[:, np.newaxis]
+
+    audio_reduction = 0.9
+    if gains:
+        audio_reduction = gains['base']
+    elif config['base_audio_vol_percent']:
+        audio_reduction = float(config['base_audio_vol_percent'])
+    # Volume of the base audio during and after the voice dub sections
+    gain = np.ones(len(base_audio), dtype=np.float32)
+    for delay, track in zip(delays, speech_tracks):
+        gain[delay:delay + len(track) + 1] = audio_reduction
+    gain[max(delay + len(track) for delay, track in zip(delays, speech_tracks)) + 1:] *= 0.9
+
+    # amix divides the inputs by the number of inputs being played, and raises
+    # the volume of the remaining one progressively when the other ends
+    frames = max(len(voice), len(base_audio))
+    shortest = min(len(voice), len(base_audio))
+    transition = np.arange(frames - shortest) / (AMIX_DROPOUT_SECONDS * sample_rate)
+    scale = np.concatenate([np.full(shortest, 0.5), 0.5 + 0.5 * np.minimum(transition, 1)])
+    mix = np.zeros((frames, base_audio.shape[1]), dtype=np.float32)
+    mix[:len(base_audio)] += base_audio * gain[:, np.newaxis]
+    if base_audio.shape[1] == 2:
+        # ffmpeg converts the mono voice to stereo at -3 dB in each channel
+        voice *= np.sqrt(0.5)
+    mix[:len(voice)] += voice[:, np.newaxis]
+    return mix * scale[:, np.newaxis].astype(np.float32)
+
+
+def _encode_audio(samples: np.ndarray, sample_rate: int) -> bytes:
+    """Encodes PCM samples in memory in the AUDIO_OUTPUT_FORMAT.
+
+    Args:
+      samples: Array of frames by channels.
+      sample_rate: Sample rate of the samples.
+    """
+    file_format, subtype, unused_content_type = AUDIO_OUTPUT_FORMATS[AUDIO_OUTPUT_FORMAT]
+    output = io.BytesIO()
+    with _stage('audio_encode') as stage:
+        soundfile.write(output, np.clip(samples, -1, 1), sample_rate,
+                        format=file_format, subtype=subtype)
+        stage['bytes'] = output.tell()
+    return output.getvalue()
+
+
+def _mix_audio_line(config: Dict, base_audio: Optional[np.ndarray], sample_rate: int,
+                    target_file_name: str, fingerprint: str, if_generation_match: int,
+                    preview: bool = False, gains: Optional[Dict] = None):
+    """Generates the audio file of a line without video and stores it in GCS.
+
+    Args:
+      config: Dictionary containing the configuration information.
+      base_audio: Decoded base audio, or None if there is no base audio.
+      sample_rate: Sample rate of the base audio and of the output.
+      target_file_name: Name of the blob to be created in GCS.
+      fingerprint: Fingerprint of the job, stored in the metadata of the file.
+      if_generation_match: Generation of the target blob, or 0 if it did not
+        exist.
+      preview: Whether only the preview window of the audio is generated.
+      gains: Gains computed from the loudness of the inputs, if any.
+    """
+    bucket = _storage_client().bucket(config['gcs_bucket'])
+    speech_tracks = []
+    for segment in _get_segments(config):
+        with _stage('gcs_download', client='storage') as stage:
+            data = bucket.blob(segment['tts_file_url']).download_as_bytes()
+            stage['bytes'] = len(data)
+        samples, speech_rate = _decode_audio(io.BytesIO(data))
+        speech_tracks.append(_resample(samples.mean(axis=1), speech_rate, sample_rate))
+
+    with _stage('audio_mix'):
+        mix = _mix_audio(config, speech_tracks, base_audio, sample_rate, gains)
+    if preview:
+        start, duration = _get_preview_window(
+            config, [len(track) / sample_rate for track in speech_tracks])
+        mix = mix[round(start * sample_rate):round((start + duration) * sample_rate)]
+    data = _encode_audio(mix, sample_rate)
+
+    blob = bucket.blob(target_file_name)
+    blob.metadata = {JOB_FINGERPRINT_KEY: fingerprint}
+    with _stage('gcs_upload', client='storage') as stage, _conditional_write(
+            bucket, target_file_name, fingerprint):
+        blob.upload_from_string(data, content_type=AUDIO_OUTPUT_FORMATS[AUDIO_OUTPUT_FORMAT][2],
+                                if_generation_match=if_generation_match)
+        stage['bytes'] = len(data)
+
+
+def _mix_audio_group(configs: List[Dict], preview: bool = False):
+    """Mixes the speech of several lines with the same base audio file,
+    generating one audio file per line and no video.
+
+    The base audio is decoded once, and the mixes are computed and encoded in
+    memory, without running ffmpeg nor writing temporary files. The lines
+    whose audio file was already generated from the same inputs and
+    parameters, on any day, are skipped.
+
+    Args:
+      configs: List of dictionaries containing the configuration information.
+      preview: Whether only the previews of the lines are generated.
+    """
+    url_field = 'preview_file_url' if preview else 'final_video_file_url'
+    success_status = 'Preview OK' if preview else 'Audio OK'
+    first_config = configs[0]
+    gcs_bucket = first_config['gcs_bucket']
+    cached_files = []
     try:
-        os.system(ffmpeg_mix_command)
-        print('Copying output file to GCS')
         today =  datetime.today().strftime('%Y%m%d')
-        target_video_file_name = f"output/{today}/{_build_file_name(config)}"
-        print(target_video_file_name)
-        # Copy the generated video file to the target GCS bucket
-        _copy_file_to_gcs(config['gcs_bucket'], generated_video_file, target_video_file_name)
-        config['status'] = 'Video OK'
-        config['final_video_file_url'] = f"gs://{config['gcs_bucket']}/{target_video_file_name}"
+        folder = 'preview' if preview else 'output'
+        target_file_names = [
+            f"{folder}/{today}/{_build_file_name(config, AUDIO_OUTPUT_FORMAT)}"
+            for config in configs]
+        checksums = _get_input_checksums(
+            gcs_bucket, [name for config in configs for name in _get_input_files(config)])
+        gains = _get_auto_gains(configs, checksums)
+        fingerprints = [_build_job_fingerprint(config, checksums, {
+            'engine': 'numpy',
+            'millisecond_start_audio': [int(segment['millisecond_start_audio'])
+                                        for segment in _get_segments(config)],
+            'base_audio_vol_percent': config['base_audio_vol_percent'],
+            'gains': line_gains,
+            'preview_margin_seconds': PREVIEW_MARGIN_SECONDS if preview else None,
+            'format': AUDIO_OUTPUT_FORMATS[AUDIO_OUTPUT_FORMAT],
+            'sample_rate': AUDIO_OUTPUT_SAMPLE_RATE,
+        }) for config, line_gains in zip(configs, gains)]
+        output_blobs = _reuse_rendered_outputs(
+            gcs_bucket, target_file_names, fingerprints,
+            _get_output_blobs(gcs_bucket, target_file_names))
 
+        base_audio, sample_rate = None, AUDIO_OUTPUT_SAMPLE_RATE
+        for config, target_file_name, fingerprint, output_blob, line_gains in zip(
+                configs, target_file_names, fingerprints, output_blobs, gains):
+            try:
+                if _is_rendered(output_blob, fingerprint):
+                    print(f'{target_file_name} is up to date')
+                else:
+                    if first_config['base_audio_file'] and base_audio is None:
+                        base_audio, sample_rate = _load_base_audio(
+                            gcs_bucket, first_config['base_audio_file'], cached_files)
+                    _mix_audio_line(config, base_audio, sample_rate, target_file_name,
+                                    fingerprint, output_blob.generation if output_blob else 0,
+                                    preview, line_gains)
+                    _save_job_pointers(gcs_bucket, [target_file_name], [fingerprint])
+                config[url_field] = f"gs://{gcs_bucket}/{target_file_name}"
+                config['status'] = success_status
+            except Exception as e:
+                config['status'] = e
+                config[url_field] = "N/A"
     except Exception as e:
-        config['status'] = e
-        config['final_video_file_url'] = "N/A"
+        for config in configs:
+            config['status'] = e
+            config[url_field] = "N/A"
 
-    _update_sheet_line(config)
+    for config in configs:
+        _update_config_line(config)
+    for cached_file in cached_files:
+        _MEDIA_CACHE.release(cached_file)
+
+
+def _load_base_audio(gcs_bucket: str, blob_name: str,
+                     cached_files: List[str]) -> Tuple[np.ndarray, int]:
+    """Downloads and decodes a base audio file, from the media cache unless in
+    streaming mode.
+
+    Args:
+      gcs_bucket: string containing the bucket name.
+      blob_name: Name of the blob containing the file.
+      cached_files: List where the files acquired from the media cache are
+        added, to be released afterwards.
+
+    Returns:
+      A tuple with the samples, as an array of frames by channels, and the
+      sample rate.
+    """
+    if STREAMING_MODE:
+        with _stage('gcs_download', client='storage') as stage:
+            data = _storage_client().bucket(gcs_bucket).blob(blob_name).download_as_bytes()
+            stage['bytes'] = len(data)
+        return _decode_audio(io.BytesIO(data))
+    cached_files.append(_MEDIA_CACHE.acquire(gcs_bucket, blob_name))
+    return _decode_audio(cached_files[-1])
+
+
+def _mix_video_and_speech(config: Dict): #, video_file, speech_file,destination_video_name, voice_delay):
+    """Mixes a generated speech file with the audio of the specified video.
+
+    Args:
+      config: Dictionary containing the configuration information.
+    """
+    _mix_video_and_speech_group([config])
+
+
+def _mix_video_and_speech_group(configs: List[Dict], preview: bool = False):
+    """Mixes several generated speech files with the audio of the same video,
+    generating one video per speech with a single ffmpeg run.
+
+    All the configs must share gcs_bucket, video_file and base_audio_file.
+    When there is no video_file only the audio files are generated. The
+    outputs already generated from the same inputs and parameters, whose
+    metadata has the same job fingerprint, are not generated again, and are
+    copied from the output of a previous day if needed.
+
+    Args:
+      configs: List of dictionaries containing the configuration information.
+      preview: Whether only the preview of the line is rendered, in which
+        case configs must have a single line.
+    """
+    first_config = configs[0]
+    if not first_config['video_file']:
+        _mix_audio_group(configs, preview)
+        return
+    url_field = 'preview_file_url' if preview else 'final_video_file_url'
+    gcs_bucket = first_config['gcs_bucket']
+    local_files = []
+    cached_files = []
+
+    input_video_file = f"{first_config['video_file']}"
+    print(input_video_file)
+    try:
+        # The durations are sent by the TTS generation, so the speech files are
+        # only downloaded if they have to be mixed
+        voice_dub_lengths = [
+            [_get_speech_duration(dict(segment, gcs_bucket=gcs_bucket))
+             for segment in _get_segments(config)]
+            for config in configs]
+        print('Voice Dub lengths are {voice_dub_lengths}'.format(
+            voice_dub_lengths=voice_dub_lengths))
+        window = None
+        if preview:
+            window = _get_preview_window(first_config, voice_dub_lengths[0])
+
+        today =  datetime.today().strftime('%Y%m%d')
+        folder = 'preview' if preview else 'output'
+        target_video_file_names = [
+            f"{folder}/{today}/{_build_file_name(config)}" for config in configs]
+        print(target_video_file_names)
+
+        # The fingerprint covers the content of the inputs and the command that
+        # mixes them, built with placeholders instead of the local paths
+        checksums = _get_input_checksums(
+            gcs_bucket, [name for config in configs for name in _get_input_files(config)])
+        gains = _get_auto_gains(configs, checksums)
+        fingerprints = []
+        for config, lengths, line_gains in zip(configs, voice_dub_lengths, gains):
+            command = _build_ffmpeg_mix_command(
+                [config], 'video', [[f'speech_{j}' for j in range(len(lengths))]],
+                'base_audio' if config['base_audio_file'] else None, [lengths],
+                ['output'], VIDEO_STREAM_COPY, window, gains=[line_gains])
+            fingerprints.append(_build_job_fingerprint(config, checksums, {
+                'command': command,
+                'fallback_video_codec': FALLBACK_VIDEO_CODEC,
+            }))
+        output_blobs = _reuse_rendered_outputs(
+            gcs_bucket, target_video_file_names, fingerprints,
+            _get_output_blobs(gcs_bucket, target_video_file_names))
+        pending = [i for i, (output_blob, fingerprint) in enumerate(zip(output_blobs, fingerprints))
+                   if not _is_rendered(output_blob, fingerprint)]
+        for i in set(range(len(configs))) - set(pending):
+            print(f'{target_video_file_names[i]} is up to date')
+
+        if pending:
+            _render_videos(
+                [configs[i] for i in pending],
+                [voice_dub_lengths[i] for i in pending],
+                [target_video_file_names[i] for i in pending],
+                [fingerprints[i] for i in pending],
+                [output_blobs[i].generation if output_blobs[i] else 0 for i in pending],
+                window, [gains[i] for i in pending], local_files, cached_files)
+            _save_job_pointers(gcs_bucket, [target_video_file_names[i] for i in pending],
+                               [fingerprints[i] for i in pending])
+        for config, target_video_file_name in zip(configs, target_video_file_names):
+            config['status'] = 'Preview OK' if preview else 'Video OK'
+            config[url_field] = f"gs://{gcs_bucket}/{target_video_file_name}"
+
+    except Exception as e:
+        for config in configs:
+            config['status'] = e
+            config[url_field] = "N/A"
+
+    for config in configs:
+        _update_config_line(config)
 
     # Cleanup temp files
     print('Cleaning up')
-    os.remove(source_video_input)
-    os.remove(source_speech_input)
-    os.remove(generated_video_file)
+    for local_file in local_files:
+        if os.path.exists(local_file):
+            os.remove(local_file)
+    for cached_file in cached_files:
+        _MEDIA_CACHE.release(cached_file)
+
+def _render_videos(configs: List[Dict], voice_dub_lengths: List[List[float]],
+                   target_video_file_names: List[str], fingerprints: List[str],
+                   if_generation_matches: List[int],
+                   window: Optional[Tuple[float, float]],
+                   gains: List[Optional[Dict]],
+                   local_files: List[str], cached_files: List[str]):
+    """Renders the videos of several lines sharing the same video and base
+    audio files with a single ffmpeg run, and stores them in GCS.
+
+    Args:
+      configs: List of dictionaries containing the configuration information.
+      voice_dub_lengths: Length of each segment of each line in seconds.
+      target_video_file_names: Name of the blob of each video in GCS.
+      fingerprints: Fingerprint of the job rendering each video.
+      if_generation_matches: Generation of each target blob, or 0 if it did
+        not exist.
+      window: Start and duration of the part of the video rendered, for
+        previews.
+      gains: Gains of each line computed from the loudness of the inputs, or
+        None for the lines using base_audio_vol_percent.
+      local_files: List where the temporary files are added, to be deleted
+        afterwards.
+      cached_files: List where the files acquired from the media cache are
+        added, to be released afterwards.
+    """
+    first_config = configs[0]
+    gcs_bucket = first_config['gcs_bucket']
+    input_video_file = first_config['video_file']
+    # Generate a 10 characters long random string (rnd)
+    random_string = ''.join(random.choices(
+        string.ascii_lowercase + string.digits, k=12))
+    if STREAMING_MODE:
+        # ffmpeg reads the inputs straight from GCS
+        source_video_input = _get_signed_url(gcs_bucket, input_video_file)
+        source_speech_inputs = [
+            [_get_signed_url(gcs_bucket, segment['tts_file_url'])
+             for segment in _get_segments(config)]
+            for config in configs]
+        source_audio_input = None
+        if first_config['base_audio_file']:
+            source_audio_input = _get_signed_url(gcs_bucket, first_config['base_audio_file'])
+    else:
+        # All the inputs are fetched concurrently
+        with concurrent.futures.ThreadPoolExecutor(GCS_TRANSFER_MAX_WORKERS) as executor:
+            # Get video_file and base_audio_file from the media cache, copying
+            # them from blob if needed
+            cache_futures = [executor.submit(_MEDIA_CACHE.acquire, gcs_bucket, input_video_file)]
+            if first_config['base_audio_file']:
+                cache_futures.append(executor.submit(
+                    _MEDIA_CACHE.acquire, gcs_bucket, first_config['base_audio_file']))
+
+            # Copy the speech files from blob to /tmp/speech[rnd]_[i]_[j].mp4
+            source_speech_inputs = []
+            speech_futures = []
+            for i, config in enumerate(configs):
+                source_speech_inputs.append([])
+                for j, segment in enumerate(_get_segments(config)):
+                    source_speech_input = f'/tmp/speech_{random_string}_{i}_{j}.mp4'
+                    local_files.append(source_speech_input)
+                    speech_futures.append(executor.submit(
+                        _copy_file_from_gcs, gcs_bucket, segment['tts_file_url'],
+                        source_speech_input))
+                    source_speech_inputs[i].append(source_speech_input)
+
+        # The files acquired are released even if another input failed
+        cached_files.extend(future.result() for future in cache_futures
+                            if not future.exception())
+        for future in cache_futures + speech_futures:
+            future.result()
+        source_video_input = cache_futures[0].result()
+        source_audio_input = cache_futures[1].result() if len(cache_futures) > 1 else None
+
+    copy_video = window is None and _can_copy_video(source_video_input)
+
+    def build_command(outputs: List[str]) -> List[str]:
+        command = _build_ffmpeg_mix_command(
+            configs, source_video_input, source_speech_inputs, source_audio_input,
+            voice_dub_lengths, outputs, copy_video, window, _FFMPEG.threads, gains)
+        # Signed URLs are not logged
+        print('Running command: ' + ' '.join(arg.split('?')[0] for arg in command))
+        return command
+
+    if STREAMING_MODE:
+        print('Streaming output files to GCS')
+        _stream_ffmpeg_outputs_to_gcs(
+            build_command, gcs_bucket, target_video_file_names, fingerprints,
+            if_generation_matches)
+    else:
+        # Generate and run mix command to generate the output video files
+        generated_video_files = [
+            f'/tmp/output_{random_string}_{i}.mp4' for i in range(len(configs))]
+        local_files.extend(generated_video_files)
+        with _stage('ffmpeg'):
+            _FFMPEG.run(build_command(generated_video_files))
+        print('Copying output files to GCS')
+        # Copy the generated video files to the target GCS bucket
+        for generated_video_file, target_video_file_name, fingerprint, if_generation_match in zip(
+                generated_video_files, target_video_file_names, fingerprints,
+                if_generation_matches):
+            _copy_file_to_gcs(gcs_bucket, generated_video_file, target_video_file_name,
+                              fingerprint, if_generation_match)
+
 
 def main(event: Dict[str, Any], context=Optional[Context]):
     """Mixes a generated speech audio file into an input video.
+
+    The message can also contain a group of lines sharing the same video in
+    its `rows` field, and then all of them are generated in a single pass.
+    The lines in preview mode are rendered one by one, as previews. Up to
+    FFMPEG_MAX_JOBS of these renders run at the same time.
+
     Args:
       event (dict):  The dictionary with data specific to this type of event. The
         `data` field contains the PubsubMessage message. The `attributes` field
@@ -188,21 +2164,46 @@ def main(event: Dict[str, Any], context=Optional[Context]):
         `timestamp` field contains the publish time.
     """
 
-    del context  # Unused
+    invocation_start = time.perf_counter()
     data = base64.b64decode(event['data']).decode('utf-8')
     config = json.loads(data)
-    _mix_video_and_speech(config)
-    _update_sheet_line(config)
+    rows = [row.get('index') for row in config['rows']] if 'rows' in config else config.get('index')
+    _METRICS.start_run(getattr(context, 'event_id', None) or uuid.uuid4().hex, rows)
+    try:
+        lines = []
+        for line in config['rows'] if 'rows' in config else [config]:
+            try:
+                _get_render_mode(line)
+                lines.append(line)
+            except ValueError as e:
+                print(e)
+                line['status'] = e
+                _update_config_line(line)
+        full_lines = [line for line in lines if not _is_preview(line)]
+        jobs = []
+        if len(full_lines) > 1:
+            jobs.append(functools.partial(_mix_video_and_speech_group, full_lines))
+        elif full_lines:
+            jobs.append(functools.partial(_mix_video_and_speech, full_lines[0]))
+        jobs += [functools.partial(_mix_video_and_speech_group, [line], preview=True)
+                 for line in lines if _is_preview(line)]
+        with concurrent.futures.ThreadPoolExecutor(max(min(len(jobs), _FFMPEG.max_jobs), 1)) as executor:
+            list(executor.map(lambda job: job(), jobs))
+    finally:
+        _STATUS_WRITER.flush()
+    _METRICS.report_summary()
+    _report_client_stats(invocation_start)
     print('Process completed')
     return 'done'
 
 
-def _build_file_name(config: Dict) -> str:
+def _build_file_name(config: Dict, extension: str = 'mp4') -> str:
     """
     It builds the file name based on the configuration fields
 
     Args:
       config: Dict object containing the fields to generate the video file
+      extension: Extension of the file
 
     Returns:
       A string with the name in low case
@@ -211,61 +2212,61 @@ def _build_file_name(config: Dict) -> str:
     name = (
      f"{config['campaign']}"
      f"-{config['topic']}"
-     f"-{config['voice_id']}.mp4"
+     f"-{config['voice_id']}.{extension}"
      )
 
     return name.lower()
 
-def _update_sheet_line(line: Dict):
+def _update_config_line(line: Dict):
   """
-  Updates the line in the Google Spreadsheet defined in the global variabl.
+  Queues the update of the status of the line in the config source. The update
+  is written with the next batch.
 
   Args:
     line: Dict containing all the relevant info.
   """
-
+  update = {
+    'index': line['index'],
+    'status': str(line['status']),
+    'last_update': datetime.now().strftime("%Y/%m/%d, %H:%M:%S"),
+  }
   try:
-      service = build('sheets', 'v4', credentials=None)
-      index = line['index']
-      status_range = f'{CONFIG_SHEET_NAME}!{STATUS_COLUMN}{index}:{STATUS_COLUMN}{index}'
-      final_video_file_range = f'{CONFIG_SHEET_NAME}!{FINAL_VIDEO_FILE_COLUMN}{index}:{FINAL_VIDEO_FILE_COLUMN}{index}'
-      last_update_range = f"{CONFIG_SHEET_NAME}!{LAST_UPDATE_COLUMN}{index}:{LAST_UPDATE_COLUMN}{index}"
-
-      body1 = {
-        'values' : [[str(line['status'])],],
-        'majorDimension' : 'COLUMNS'
-        }
-
-      body2 = {
-        'values' : [[str(line['final_video_file_url'])],],
-        'majorDimension' : 'COLUMNS'
-        }
-
-      now = datetime.now()
-      body3 = {
-        'values' : [[now.strftime("%Y/%m/%d, %H:%M:%S")],],
-        'majorDimension' : 'COLUMNS'
-        }
-      # Call the Sheets API
-
-      sheet = service.spreadsheets()
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=status_range,
-                                    valueInputOption='RAW',
-                                    body=body1).execute()
-
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=final_video_file_range,
-                                    valueInputOption='RAW',
-                                    body=body2).execute()
-
-      sheet.values().update(spreadsheetId=CONFIG_SPREADSHEET_ID,
-                                    range=last_update_range,
-                                    valueInputOption='RAW',
-                                    body=body3).execute()
-
-  except HttpError as err:
-      print(err)
+    # Previews are written to their own field, keeping the last full render
+    url_field = 'preview_file_url' if _is_preview(line) else 'final_video_file_url'
+    update[url_field] = str(line[url_field])
+  except ValueError:
+    # Lines with an invalid render mode are not rendered, only their status is
+    # written
+    pass
+  _STATUS_WRITER.add(update)
+
+def _batch_update_sheet(data: List[Dict]):
+  """
+  Writes several ranges to the Google Spreadsheet with one request, retrying
+  with exponential backoff when the quota is exceeded.
+
+  Args:
+    data: List of value ranges to write.
+  """
+  body = {
+    'valueInputOption' : 'RAW',
+    'data' : data
+  }
+  for attempt in range(SHEETS_MAX_RETRIES + 1):
+    try:
+      sheet = _sheets_service().spreadsheets()
+      with _SHEETS_LOCK, _stage('sheet_update', client='sheets') as stage:
+        stage['ranges'] = len(data)
+        sheet.values().batchUpdate(spreadsheetId=CONFIG_SPREADSHEET_ID,
+                                   body=body).execute()
+      return
+    except HttpError as err:
+      if err.resp.status not in (429, 500, 503) or attempt == SHEETS_MAX_RETRIES:
+        print(err)
+        return
+      delay = 2 ** attempt + random.random()
+      print(f'Sheets API error {err.resp.status}, retrying in {delay:.1f}s')
+      time.sleep(delay)
 
 if __name__ == '__main__':
     config = {
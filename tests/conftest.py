@@ -0,0 +1,50 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fixtures that load the functions against the fakes of the benchmark."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import fakes  # pylint: disable=wrong-import-position
+import run_benchmark  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def services(monkeypatch):
+    """Installs fresh fakes and the default environment of the benchmark."""
+    fake_services = fakes.FakeServices()
+    fakes.install(fake_services)
+    for name, value in run_benchmark.DEFAULT_ENV.items():
+        monkeypatch.setenv(name, value)
+    return fake_services
+
+
+@pytest.fixture
+def load_function(services, monkeypatch):
+    """Returns a function that imports the main.py of a function, 'tts' or
+    'video', with the given environment variables."""
+    del services
+
+    def load(name, **env):
+        for variable, value in env.items():
+            monkeypatch.setenv(variable, value)
+        path = run_benchmark.TTS_MAIN if name == 'tts' else run_benchmark.VIDEO_MAIN
+        return run_benchmark._load_function(path, f'{name}_main')
+
+    return load
@@ -0,0 +1,164 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the speech durations read from the headers of the audio files."""
+
+import contextlib
+import io
+import struct
+
+import numpy as np
+import pytest
+import soundfile
+
+import run_benchmark
+
+# MPEG-1 layer III, 128 kbps, 44.1 kHz, stereo: 417 bytes and 1152 samples per frame
+MP3_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])
+MP3_FRAME_BYTES = 417
+# Offset of the Xing and VBRI headers in the first frame of a stereo MPEG-1 file
+MP3_VBR_HEADER = 4 + 32
+
+
+def _mp3(frames: int, vbr_header: bytes = b'', id3: bool = False) -> bytes:
+    first = MP3_HEADER + bytes(MP3_VBR_HEADER - 4) + vbr_header
+    first += bytes(MP3_FRAME_BYTES - len(first))
+    data = first + (MP3_HEADER + bytes(MP3_FRAME_BYTES - 4)) * (frames - 1)
+    if id3:
+        # ID3v2 tag of 300 bytes, its size is a syncsafe integer
+        data = b'ID3\x04\x00\x00' + bytes([0, 0, 300 >> 7, 300 & 0x7F]) + bytes(300) + data
+    return data
+
+
+def _xing(frames: int, stream_bytes: int) -> bytes:
+    return b'Xing' + struct.pack('>III', 3, frames, stream_bytes)
+
+
+def _vbri(frames: int, stream_bytes: int) -> bytes:
+    return b'VBRI' + struct.pack('>HHHII', 1, 0, 75, stream_bytes, frames)
+
+
+def _ogg_page(payload: bytes, granule: int, sequence: int) -> bytes:
+    segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+    return (b'OggS' + struct.pack('<BBqIII', 0, 0, granule, 1, sequence, 0) +
+            bytes([len(segments)]) + bytes(segments) + payload)
+
+
+def _ogg_opus(seconds: float, pre_skip: int = 312) -> bytes:
+    opus_head = b'OpusHead' + struct.pack('<BBHIhB', 1, 1, pre_skip, 48000, 0, 0)
+    samples = round(seconds * 48000) + pre_skip
+    return (_ogg_page(opus_head, 0, 0) + _ogg_page(b'OpusTags' + bytes(8), 0, 1) +
+            _ogg_page(bytes(600), samples // 2, 2) + _ogg_page(bytes(600), samples, 3))
+
+
+def _wav(seconds: float, sample_rate: int = 24000, data_size: int = None) -> bytes:
+    pcm = bytes(2 * round(seconds * sample_rate))
+    fmt = struct.pack('<HHIIHH', 1, 1, sample_rate, 2 * sample_rate, 2, 16)
+    return (b'RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(pcm)) + b'WAVE' +
+            b'LIST' + struct.pack('<I', 5) + b'INFO\x00\x00' +
+            b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+            b'data' + struct.pack('<I', len(pcm) if data_size is None else data_size) + pcm)
+
+
+def _encode(file_format: str, subtype: str, sample_rate: int, seconds: float) -> bytes:
+    """Encodes a tone with libsndfile, as a file of a real encoder."""
+    tone = 0.3 * np.sin(np.arange(round(seconds * sample_rate)) * 0.05).astype('float32')
+    output = io.BytesIO()
+    soundfile.write(output, tone, sample_rate, format=file_format, subtype=subtype)
+    return output.getvalue()
+
+
+def _decoded_duration(data: bytes) -> float:
+    samples, sample_rate = soundfile.read(io.BytesIO(data))
+    return len(samples) / sample_rate
+
+
+@pytest.fixture(params=['tts', 'video'])
+def probe(request, load_function):
+    """The header probe of each function, which keep their own copy."""
+    function = load_function(request.param)
+    return lambda data: function._probe_audio_duration(
+        lambda start, length: data[start:start + length], len(data))
+
+
+@pytest.mark.parametrize('data, duration', [
+    (_mp3(100), 100 * MP3_FRAME_BYTES * 8 / 128000),
+    (_mp3(100, id3=True), 100 * MP3_FRAME_BYTES * 8 / 128000),
+    (_mp3(100) + b'TAG' + bytes(125), 100 * MP3_FRAME_BYTES * 8 / 128000),
+    (_mp3(100, _xing(250, 100 * MP3_FRAME_BYTES)), 250 * 1152 / 44100),
+    (_mp3(100, _xing(250, 100 * MP3_FRAME_BYTES), id3=True), 250 * 1152 / 44100),
+    (_mp3(100, _vbri(250, 100 * MP3_FRAME_BYTES)), 250 * 1152 / 44100),
+    (_ogg_opus(2.5), 2.5),
+    (_wav(1.5), 1.5),
+    (_wav(1.5, data_size=0xFFFFFFFF), 1.5),
+], ids=['mp3-cbr', 'mp3-id3', 'mp3-id3v1', 'mp3-xing', 'mp3-xing-id3', 'mp3-vbri',
+        'ogg-opus', 'wav', 'wav-streamed'])
+def test_duration_is_read_from_the_headers(probe, data, duration):
+    assert probe(data) == pytest.approx(duration)
+
+
+@pytest.mark.parametrize('data', [
+    _mp3(100, _xing(250, 100 * MP3_FRAME_BYTES))[:20 * MP3_FRAME_BYTES],
+    _mp3(100, _vbri(250, 100 * MP3_FRAME_BYTES))[:20 * MP3_FRAME_BYTES],
+    _ogg_opus(2.5)[:-100],
+    _wav(1.5)[:40],
+    b'not an audio file',
+], ids=['mp3-xing', 'mp3-vbri', 'ogg-opus', 'wav-header', 'unknown'])
+def test_truncated_headers_are_not_trusted(probe, data):
+    assert probe(data) is None
+
+
+def test_truncated_wav_duration_is_the_length_of_its_samples(probe):
+    assert probe(_wav(1.5)[:-24000]) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize('file_format, subtype, sample_rate', [
+    ('MP3', 'MPEG_LAYER_III', 44100),
+    ('OGG', 'OPUS', 48000),
+    ('WAV', 'PCM_16', 24000),
+])
+def test_encoded_files_match_their_decoded_duration(probe, file_format, subtype, sample_rate):
+    data = _encode(file_format, subtype, sample_rate, 2)
+
+    # The MP3 frames include the delay and padding of the encoder
+    assert probe(data) == pytest.approx(_decoded_duration(data), abs=0.05)
+
+
+@pytest.mark.parametrize('file_format, subtype, sample_rate', [
+    ('MP3', 'MPEG_LAYER_III', 44100),
+    ('OGG', 'OPUS', 48000),
+])
+def test_truncated_speech_is_decoded(services, load_function, file_format, subtype,
+                                     sample_rate):
+    video = load_function('video')
+    data = _encode(file_format, subtype, sample_rate, 2)
+    data = data[:len(data) * 6 // 10]
+    services.put_object(run_benchmark.BUCKET, 'speech/line', data)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        duration = video._get_speech_duration(
+            {'gcs_bucket': run_benchmark.BUCKET, 'tts_file_url': 'speech/line'})
+
+    assert duration == pytest.approx(_decoded_duration(data))
+    assert duration < 1.5
+
+
+def test_undecodable_speech_is_reported(services, load_function):
+    video = load_function('video')
+    services.put_object(run_benchmark.BUCKET, 'speech/line', b'not an audio file')
+
+    with contextlib.redirect_stdout(io.StringIO()), pytest.raises(
+            ValueError, match='Could not read the duration of speech/line'):
+        video._get_speech_duration(
+            {'gcs_bucket': run_benchmark.BUCKET, 'tts_file_url': 'speech/line'})
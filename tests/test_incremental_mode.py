@@ -0,0 +1,51 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the incremental mode of generate_tts_files."""
+
+import contextlib
+import io
+import json
+
+import pytest
+
+import run_benchmark
+
+ROWS = 5
+
+
+def _run_main(tts) -> list:
+    """Runs main and returns the lines it logged, without the stages."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        tts.main({}, None)
+    return [line for line in output.getvalue().splitlines() if not line.startswith('{')]
+
+
+@pytest.mark.parametrize('dispatch_mode, handled', [('false', 'processed'),
+                                                    ('true', 'dispatched')])
+def test_changed_lines_are_counted(services, load_function, dispatch_mode, handled):
+    services.spreadsheet.values = run_benchmark._build_sheet(ROWS, 2, 0)
+    _run_main(load_function('tts', INCREMENTAL_MODE='true'))
+    text_column = run_benchmark.HEADERS.index('text')
+    services.spreadsheet.values[2][text_column] = '<speak>Changed</speak>'
+    services.published.clear()
+
+    tts = load_function('tts', INCREMENTAL_MODE='true', DISPATCH_MODE=dispatch_mode)
+    logs = _run_main(tts)
+
+    assert f'Incremental mode: 1 lines {handled}, {ROWS - 1} unchanged lines skipped' in logs
+    messages = [json.loads(data) for unused_topic, data, unused_attrs in services.published]
+    assert len(messages) == 1
+    assert tts._METRICS.get_count('lines_processed') == (dispatch_mode == 'false')
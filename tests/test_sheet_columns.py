@@ -0,0 +1,99 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the columns written to the config sheet by generate_video_file."""
+
+import base64
+import contextlib
+import io
+import json
+
+import run_benchmark
+
+# A sheet with a column of the user after last_update, before the optional
+# columns of the previews
+HEADERS = run_benchmark.HEADERS + ['notes', 'render_mode', 'preview_file_url']
+
+
+def _sheet(render_mode: str):
+    row = ['campaign', 'topic', run_benchmark.BUCKET, '', '', '<speak>Hi</speak>',
+           'en-US-Neural2-A', '0', 'MP3', '', 'speech/line.mp3', '', 'TTS OK', '',
+           'keep me', render_mode, '']
+    return [list(HEADERS), row]
+
+
+def _message(services, render_mode: str) -> dict:
+    values = services.spreadsheet.values
+    message = dict(zip(HEADERS, values[1]), index=2, speech_duration_seconds=1.0)
+    del message['notes'], message['preview_file_url']
+    message['render_mode'] = render_mode
+    return message
+
+
+def _run_video(video, message):
+    with contextlib.redirect_stdout(io.StringIO()):
+        video.main({'data': base64.b64encode(json.dumps(message).encode('utf-8'))}, None)
+        video._STATUS_WRITER.flush()
+
+
+def test_columns_are_found_in_the_header_row(services, load_function):
+    services.spreadsheet.values = _sheet('preview')
+    video = load_function('video')
+
+    video._update_config_line({'index': 2, 'status': 'Preview OK',
+                               'preview_file_url': 'gs://bucket/preview.mp4',
+                               'render_mode': 'preview'})
+    video._STATUS_WRITER.flush()
+
+    row = dict(zip(HEADERS, services.spreadsheet.values[1]))
+    assert row['notes'] == 'keep me'
+    assert row['preview_file_url'] == 'gs://bucket/preview.mp4'
+    assert row['status'] == 'Preview OK'
+
+
+def test_fixed_column_overrides_the_header_row(services, load_function):
+    services.spreadsheet.values = _sheet('preview')
+    video = load_function('video', STATUS_COLUMN='O')
+
+    video._update_config_line({'index': 2, 'status': 'Video OK',
+                               'final_video_file_url': 'gs://bucket/video.mp4'})
+    video._STATUS_WRITER.flush()
+
+    row = dict(zip(HEADERS, services.spreadsheet.values[1]))
+    assert row['notes'] == 'Video OK'
+    assert row['final_video_file_url'] == 'gs://bucket/video.mp4'
+
+
+def test_unknown_render_mode_is_rejected(services, load_function):
+    services.spreadsheet.values = _sheet('aproved')
+    video = load_function('video')
+    rendered = []
+    video._mix_video_and_speech_group = lambda configs, preview=False: rendered.append(configs)
+
+    _run_video(video, _message(services, 'aproved'))
+    _run_video(video, _message(services, ''))
+
+    row = dict(zip(HEADERS, services.spreadsheet.values[1]))
+    assert not rendered
+    assert row['status'].startswith("Invalid render_mode ''")
+    assert row['final_video_file_url'] == '' and row['notes'] == 'keep me'
+
+
+def test_render_modes(services, load_function):
+    video = load_function('video')
+
+    assert video._get_render_mode({}) == 'full'
+    assert video._get_render_mode({'render_mode': ' Approved '}) == 'full'
+    assert video._get_render_mode({'render_mode': 'full'}) == 'full'
+    assert video._get_render_mode({'render_mode': 'preview'}) == 'preview'
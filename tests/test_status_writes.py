@@ -0,0 +1,107 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the status write-back of generate_tts_files."""
+
+import contextlib
+import io
+import json
+import time
+
+import pytest
+
+import run_benchmark
+
+ROWS = 120
+
+
+def _run_main(tts):
+    with contextlib.redirect_stdout(io.StringIO()):
+        tts.main({}, None)
+
+
+def _record_statuses_at_publication(services, tts):
+    """Records the status in the sheet of the lines of every message when it
+    is published."""
+    status_column = run_benchmark.HEADERS.index('status')
+    statuses = []
+    send_pub_sub = tts._send_pub_sub
+
+    def send(message, topic):
+        for line in message.get('rows', [message]):
+            statuses.append(services.spreadsheet.values[line['index'] - 1][status_column])
+        return send_pub_sub(message, topic)
+
+    tts._send_pub_sub = send
+    return statuses
+
+
+@pytest.mark.parametrize('group_mode', ['false', 'true'])
+def test_statuses_are_written_in_batches_before_publishing(
+        services, load_function, group_mode):
+    services.spreadsheet.values = run_benchmark._build_sheet(ROWS, 2, 0)
+    tts = load_function('tts', SHEETS_BATCH_SIZE='50', VIDEO_GROUP_MODE=group_mode)
+    statuses = _record_statuses_at_publication(services, tts)
+
+    _run_main(tts)
+
+    assert services.spreadsheet.requests['batchUpdate'] <= -(-ROWS // 50)
+    assert statuses == ['TTS OK'] * ROWS
+    published = [json.loads(data) for unused_topic, data, unused_attrs in services.published]
+    assert sum(len(message.get('rows', [message])) for message in published) == ROWS
+
+
+def test_buffer_is_flushed_by_its_timer(services, load_function):
+    services.spreadsheet.values = run_benchmark._build_sheet(3, 1, 0)
+    tts = load_function('tts', SHEETS_FLUSH_SECONDS='0.1')
+    written = []
+    writer = tts._StatusWriteBuffer(50, 0.1)
+
+    writer.add({'index': 2, 'status': 'TTS OK'}, lambda: written.append(2))
+
+    assert not written
+    for unused_attempt in range(50):
+        if written:
+            break
+        time.sleep(0.05)
+    assert written == [2]
+    assert services.spreadsheet.requests['batchUpdate'] == 1
+
+
+def test_complete_groups_are_published_before_the_end(services, load_function):
+    services.spreadsheet.values = run_benchmark._build_sheet(20, 1, 0)
+    tts = load_function('tts', VIDEO_GROUP_MODE='true', VIDEO_GROUP_MAX_SIZE='4',
+                        TTS_MAX_WORKERS='1', SHEETS_BATCH_SIZE='1')
+    processed = []
+    process_line = tts._process_line
+
+    def process(line, fingerprints=None):
+        processed.append(line['index'])
+        return process_line(line, fingerprints)
+
+    tts._process_line = process
+    sent_after = []
+    send_pub_sub = tts._send_pub_sub
+
+    def send(message, topic):
+        sent_after.append((len(message['rows']), len(processed)))
+        return send_pub_sub(message, topic)
+
+    tts._send_pub_sub = send
+
+    _run_main(tts)
+
+    # Lines with and without base audio form two groups of 10 lines
+    assert sorted(size for size, unused_processed in sent_after) == [2, 2, 4, 4, 4, 4]
+    assert min(count for unused_size, count in sent_after) < 20
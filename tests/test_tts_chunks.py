@@ -0,0 +1,124 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the synthesis of the texts longer than a TTS request."""
+
+import contextlib
+import io
+import os
+import stat
+from xml.etree import ElementTree
+
+import pytest
+
+PARAMS = {
+    'ssml': '<speak>' + 'A short sentence. ' * 20 + '</speak>',
+    'language_code': 'en-US',
+    'voice_name': 'en-US-Neural2-A',
+    'audio_encoding': 'MP3',
+}
+
+
+SSML = ('<speak><p>First sentence here. Second &amp; third sentence. '
+        '<say-as interpret-as="characters">ABCDEFGHIJ. KLMNOP</say-as> end.</p>'
+        '<p>Another <emphasis level="strong">emphasized sentence. And more words '
+        'here.</emphasis> Tail &lt;x&gt; text.</p><break time="1s"/>Last one.</speak>')
+
+
+def _text(ssml: str) -> str:
+    """Returns the text of a SSML document without its whitespace."""
+    return ''.join(''.join(ElementTree.fromstring(ssml).itertext()).split())
+
+
+def _fake_ffmpeg(tmp_path, monkeypatch, script: str):
+    """Puts on the PATH an ffmpeg running the given shell script."""
+    path = tmp_path / 'ffmpeg'
+    path.write_text('#!/bin/sh\n' + script + '\n')
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+
+
+def _synthesize_chunked(tts):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return tts._synthesize_chunked(dict(PARAMS))
+
+
+def test_encoder_error_is_reported(tmp_path, monkeypatch, load_function):
+    _fake_ffmpeg(tmp_path, monkeypatch,
+                 'cat > /dev/null; echo "Unknown encoder libmp3lame" >&2; exit 1')
+    tts = load_function('tts', TTS_CHUNK_MAX_BYTES='200')
+
+    with pytest.raises(RuntimeError, match='exited with code 1 .*Unknown encoder libmp3lame'):
+        _synthesize_chunked(tts)
+
+
+def test_encoder_is_stopped_after_its_timeout(tmp_path, monkeypatch, load_function):
+    _fake_ffmpeg(tmp_path, monkeypatch, 'exec sleep 30')
+    tts = load_function('tts', TTS_CHUNK_MAX_BYTES='200', TTS_ENCODE_TIMEOUT_SECONDS='0.5')
+
+    with pytest.raises(RuntimeError, match='did not encode the chunks in 0.5 seconds'):
+        _synthesize_chunked(tts)
+
+
+def test_encoder_output_is_returned(tmp_path, monkeypatch, load_function):
+    _fake_ffmpeg(tmp_path, monkeypatch, 'cat > /dev/null; printf encoded')
+    tts = load_function('tts', TTS_CHUNK_MAX_BYTES='200')
+
+    assert _synthesize_chunked(tts) == b'encoded'
+
+
+@pytest.mark.parametrize('max_bytes', [60, 80, 120, 5000])
+def test_chunks_are_valid_ssml_with_all_the_text(load_function, max_bytes):
+    tts = load_function('tts')
+
+    chunks = tts._split_ssml(SSML, max_bytes)
+
+    # Every chunk parses, so no tag or entity was cut
+    assert ''.join(_text(chunk) for chunk in chunks) == _text(SSML)
+    assert all(_text(chunk) for chunk in chunks)
+    assert (len(chunks) == 1) == (max_bytes >= len(SSML))
+
+
+def test_open_elements_are_reopened_in_the_next_chunk(load_function):
+    tts = load_function('tts')
+
+    chunks = tts._split_ssml(SSML, 80)
+
+    assert chunks[2:4] == [
+        '<speak><p>Another <emphasis level="strong">emphasized sentence. </emphasis></p></speak>',
+        '<speak><p><emphasis level="strong">And more words here.</emphasis></p></speak>',
+    ]
+
+
+def test_long_sentences_are_split_between_words(load_function):
+    tts = load_function('tts')
+    ssml = '<speak><prosody rate="slow">' + 'R&amp;D caf\u00e9 ' * 30 + '</prosody></speak>'
+
+    chunks = tts._split_ssml(ssml, 200)
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk.encode('utf-8')) <= 200
+        assert chunk.startswith('<speak><prosody rate="slow">R&amp;D')
+        assert chunk.endswith('</prosody></speak>')
+    assert ''.join(_text(chunk) for chunk in chunks) == _text(ssml)
+
+
+def test_unsplittable_elements_are_kept_whole(load_function):
+    tts = load_function('tts')
+    say_as = '<say-as interpret-as="characters">' + 'A. B ' * 20 + '</say-as>'
+
+    chunks = tts._split_ssml(f'<speak>Before. {say_as} After.</speak>', 60)
+
+    assert [chunk for chunk in chunks if say_as in chunk]
@@ -0,0 +1,97 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the outputs of generate_video_file."""
+
+import base64
+import contextlib
+import datetime
+import io
+import json
+
+import numpy as np
+import soundfile
+
+import run_benchmark
+
+# A line without video, whose audio is mixed without running ffmpeg
+MESSAGE = {
+    'index': 2, 'campaign': 'campaign', 'topic': 'topic',
+    'gcs_bucket': run_benchmark.BUCKET, 'video_file': '', 'base_audio_file': '',
+    'voice_id': 'en-US-Neural2-A', 'millisecond_start_audio': '0',
+    'audio_encoding': 'MP3', 'base_audio_vol_percent': '',
+    'tts_file_url': 'speech/line.wav', 'speech_duration_seconds': 1.0,
+    'status': 'TTS OK',
+}
+
+
+def _speech_file() -> bytes:
+    output = io.BytesIO()
+    samples = 0.1 * np.sin(np.linspace(0, 2000 * np.pi, 24000))
+    soundfile.write(output, samples, 24000, format='WAV')
+    return output.getvalue()
+
+
+def _run_video(video, message) -> str:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        video.main({'data': base64.b64encode(json.dumps(message).encode('utf-8'))}, None)
+        video._STATUS_WRITER.flush()
+    return output.getvalue()
+
+
+def _set_today(monkeypatch, video, day: int):
+    class Today(datetime.datetime):
+
+        @classmethod
+        def today(cls):
+            return cls(2024, 1, day)
+
+    monkeypatch.setattr(video, 'datetime', Today)
+
+
+def test_unchanged_job_is_copied_on_another_day(services, load_function, monkeypatch):
+    services.spreadsheet.values = run_benchmark._build_sheet(1, 1, 0)
+    services.put_object(run_benchmark.BUCKET, 'speech/line.wav', _speech_file())
+    video = load_function('video')
+
+    _set_today(monkeypatch, video, 1)
+    first = _run_video(video, dict(MESSAGE))
+    _set_today(monkeypatch, video, 2)
+    second = _run_video(video, dict(MESSAGE))
+
+    outputs = {name: stored for (unused_bucket, name), stored in services.objects.items()
+               if name.startswith('output/')}
+    assert sorted(name.split('/')[1] for name in outputs) == ['20240101', '20240102']
+    first_output, second_output = (outputs[name] for name in sorted(outputs))
+    assert second_output.data == first_output.data
+    assert '"stage": "audio_mix"' in first
+    assert '"stage": "audio_mix"' not in second
+    assert 'rendered by the same job' in second
+    status_column = run_benchmark.HEADERS.index('status')
+    assert services.spreadsheet.values[1][status_column] == 'Audio OK'
+
+
+def test_changed_job_is_rendered_again(services, load_function, monkeypatch):
+    services.spreadsheet.values = run_benchmark._build_sheet(1, 1, 0)
+    services.put_object(run_benchmark.BUCKET, 'speech/line.wav', _speech_file())
+    video = load_function('video')
+
+    _set_today(monkeypatch, video, 1)
+    _run_video(video, dict(MESSAGE))
+    _set_today(monkeypatch, video, 2)
+    second = _run_video(video, dict(MESSAGE, millisecond_start_audio='500'))
+
+    assert '"stage": "audio_mix"' in second
+    assert 'rendered by the same job' not in second
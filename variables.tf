@@ -60,32 +60,50 @@ variable "config_sheet_name" {
 
 variable "config_sheet_range" {
   type        = string
-  description = "Google Cloud Region"
-  default     = "config!A1:N"
+  description = "Range of the config sheet, including the header row and the optional columns"
+  default     = "config!A1:Z"
+}
+
+variable "config_source" {
+  type        = string
+  description = "Where the config lines are read from and their status written to, instead of the config sheet: a CSV or Parquet manifest (gs://bucket/path) or a sqlite:/// or postgresql:// database URL"
+  default     = ""
+}
+
+variable "config_table" {
+  type        = string
+  description = "Table of the config lines when config_source is a database"
+  default     = "config"
 }
 
 variable "tts_file_column" {
   type        = string
-  description = "Column of the TTS file in the config sheet"
-  default     = "K"
+  description = "Column of the TTS file in the config sheet, empty to find it by its name in the header row"
+  default     = ""
 }
 
 variable "final_video_file_column" {
   type        = string
-  description = "Column of the video file in the config sheet"
-  default     = "L"
+  description = "Column of the video file in the config sheet, empty to find it by its name in the header row"
+  default     = ""
 }
 
 variable "status_column" {
   type        = string
-  description = "Column for Status in the config sheet"
-  default     = "M"
+  description = "Column for Status in the config sheet, empty to find it by its name in the header row"
+  default     = ""
 }
 
 variable "last_update_column" {
   type        = string
-  description = "Column for last update in the config sheet"
-  default     = "N"
+  description = "Column for last update in the config sheet, empty to find it by its name in the header row"
+  default     = ""
+}
+
+variable "preview_file_column" {
+  type        = string
+  description = "Column of the preview file in the config sheet, empty to find it by its name in the header row"
+  default     = ""
 }
 
 variable "generate_tts_files_trigger_pubsub_topic" {
@@ -94,8 +112,121 @@ variable "generate_tts_files_trigger_pubsub_topic" {
   default     = "generate_tts_files_trigger"
 }
 
+variable "generate_tts_tasks_pubsub_topic" {
+  type        = string
+  description = "The name for the pubsusb topic to send the lines to the tts generation workers in dispatch mode"
+  default     = "generate_tts_tasks"
+}
+
 variable "generate_video_file_trigger_pubsub_topic" {
   type        = string
   description = "The name for the pubsusb topic to trigger the video generation cloud function"
   default     = "generate_video_file_trigger"
-}
\ No newline at end of file
+}
+
+variable "tts_max_workers" {
+  type        = number
+  description = "Number of config lines processed concurrently by the TTS generation"
+  default     = 8
+}
+
+variable "tts_requests_per_minute" {
+  type        = number
+  description = "Maximum number of TTS API requests per minute (0 means no limit)"
+  default     = 900
+}
+
+variable "sheets_requests_per_minute" {
+  type        = number
+  description = "Maximum number of Google Sheets API requests per minute (0 means no limit)"
+  default     = 55
+}
+
+variable "tts_cache_enabled" {
+  type        = bool
+  description = "Reuse the audio files already generated for the same text, voice and encoding"
+  default     = true
+}
+
+variable "tts_chunk_max_bytes" {
+  type        = number
+  description = "Texts longer than this number of bytes are synthesized in chunks, in parallel"
+  default     = 5000
+}
+
+variable "incremental_mode" {
+  type        = bool
+  description = "Only process the config lines that are new, modified or failed since the last execution"
+  default     = false
+}
+
+variable "dispatch_mode" {
+  type        = bool
+  description = "Send the lines to process to the tts generation workers instead of processing them in the scheduled execution"
+  default     = false
+}
+
+variable "tts_task_batch_size" {
+  type        = number
+  description = "Number of config lines sent in each task to the tts generation workers"
+  default     = 5
+}
+
+variable "tts_worker_max_instances" {
+  type        = number
+  description = "Maximum number of instances of the tts generation workers"
+  default     = 10
+}
+
+variable "streaming_mode" {
+  type        = bool
+  description = "Stream the video inputs and output from and to GCS instead of copying them to /tmp"
+  default     = false
+}
+
+variable "video_group_mode" {
+  type        = bool
+  description = "Generate all the videos sharing the same video and base audio files in a single ffmpeg pass"
+  default     = false
+}
+
+variable "gcs_transfer_chunk_mb" {
+  type        = number
+  description = "Size (MB) of the parts in which the large video files are downloaded and uploaded in parallel"
+  default     = 32
+}
+
+variable "gcs_transfer_max_workers" {
+  type        = number
+  description = "Number of parts of a video file transferred concurrently"
+  default     = 8
+}
+
+variable "audio_output_format" {
+  type        = string
+  description = "Format of the audio files generated for the lines without video file: wav, flac, ogg or mp3"
+  default     = "wav"
+}
+
+variable "media_cache_max_mb" {
+  type        = number
+  description = "Memory (MB) used to keep the master videos and base audio files between video generations (0 disables it)"
+  default     = 2048
+}
+variable "ffmpeg_max_jobs" {
+  type        = number
+  description = "Number of ffmpeg processes run at the same time by the video generation (0 means one per 4 CPUs)"
+  default     = 0
+}
+
+variable "ffmpeg_timeout_seconds" {
+  type        = number
+  description = "Maximum duration (seconds) of an ffmpeg process before it is stopped"
+  default     = 480
+}
+
+variable "auto_loudness" {
+  type        = bool
+  description = "Compute the volume of the speech and the base audio from their measured loudness for the lines without base_audio_vol_percent"
+  default     = false
+}